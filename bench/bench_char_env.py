@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# bench_char_env.py
+#
+# times plain-text runs through a deep CharacterEnvironment chain, once
+# merging the chain's bindings for every run (as default_handler used
+# to) and once with the cached stop characters.
+# Usage: bench_char_env.py [paragraphs]
+
+import os
+import sys
+import time
+
+import benchutil
+import parser
+import streams
+import textmarkup
+import hmath
+from environments import DefaultCharacterEnvironment, CharacterEnvironment
+from lazytokens import StringToken
+
+_paragraph = """A soft red glow nearly filled the darkened room, the fringes of the
+light eaten by the black walls.  Through the frosted window, vague
+figures flitted across the ``amorphous'' expanse.  A voice broke out
+from the darkness -- \\textit{where am I?}
+
+"""
+
+def merged_bindings(char_env) :
+    # CharacterEnvironment.get_bindings as it was before the bindings
+    # were cached: walks the chain and merges it every time
+    if isinstance(char_env, DefaultCharacterEnvironment) :
+        return dict()
+    bindings = merged_bindings(char_env.parent)
+    for key, val in char_env.bindings.iteritems() :
+        bindings[key] = val
+    return bindings
+
+def merging_default_handler(stream, char_env, escape_env, begin_stack) :
+    bound = merged_bindings(char_env)
+    return StringToken(stream.read_while_not(bound))
+
+def make_chain(default_handler) :
+    # mirrors global_char_env -> char_pretty_text -> a tabular or two
+    base = CharacterEnvironment(dict(parser.global_char_env.bindings),
+                                DefaultCharacterEnvironment(default_handler))
+    env = CharacterEnvironment(dict(textmarkup.char_pretty_text.bindings), base)
+    for i in range(0, 3) :
+        env = env.extend({"&" : textmarkup.default_col_break_handler})
+    return env
+
+def time_parse(char_env, text) :
+    stream = streams.StringStream(text)
+    start = time.time()
+    while stream.peek() != "" :
+        parser.parse_one(stream, char_env, parser.global_tokens, [])
+    return time.time() - start
+
+if __name__=="__main__" :
+    paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    text = _paragraph * paragraphs
+    for name, handler in [("merged per run", merging_default_handler),
+                          ("cached", parser.default_handler)] :
+        t = time_parse(make_chain(handler), text)
+        print "%-16s %6d paragraphs in %6.2fs" % (name, paragraphs, t)
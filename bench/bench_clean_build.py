@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# bench_clean_build.py
+#
+# builds a made-up site of many pages, each of which refers to the
+# next one (the one bench_incremental.py makes), from nothing: no
+# output directory and no .ref file.  Reports the best time of that
+# build, and checks that a second run over it writes the same pages,
+# that is, that one run was enough to get every reference right.
+# Usage: bench_clean_build.py [pages [runs]]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from bench_incremental import make_site
+from bench_jobs import same_files
+
+_runhm = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "runhm.py")
+
+def run(inpfile, outdir) :
+    subprocess.check_output([sys.executable, _runhm, inpfile, outdir])
+
+def clean_build(inpfile, outdir) :
+    if os.path.isdir(outdir) :
+        shutil.rmtree(outdir)
+    if os.path.isfile(inpfile + ".ref") :
+        os.remove(inpfile + ".ref")
+    start = time.time()
+    run(inpfile, outdir)
+    return time.time() - start
+
+if __name__=="__main__" :
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    directory = tempfile.mkdtemp()
+    inpfile = os.path.join(directory, "site.hm")
+    first = os.path.join(directory, "first")
+    second = os.path.join(directory, "second")
+    try :
+        make_site(directory, pages)
+        best = min(clean_build(inpfile, first) for i in range(0, runs))
+        print "%d pages, clean build: %.1fms" % (pages, 1000 * best)
+        shutil.copytree(first, second)
+        run(inpfile, second)
+        print "a second run %s" % ("wrote the same pages" if same_files(first, second) else "changed pages")
+    finally :
+        shutil.rmtree(directory)
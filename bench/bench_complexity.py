@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# bench_complexity.py
+#
+# runs each of the core operations which have been quadratic before
+# (adding up ListTokens and StringTokens, Stream.read_while on string
+# and file streams, ListToken.eval, rendering paragraphs, and parsing
+# and evaluating a tabular) at growing sizes, fits how their time
+# grows, n^k, and fails (exits 1) if k is more than TOLERANCE above
+# what n log n would give over the same sizes.  This is the check to
+# run after changing any of them (see README).
+# Usage: bench_complexity.py [--sizes 1000,10000,100000] [--tolerance k] [operation ...]
+
+import os
+import sys
+import gc
+import math
+import time
+import tempfile
+import optparse
+
+import benchutil
+import parser
+import streams
+import textmarkup
+from lazytokens import (StringToken, ListToken, LambdaToken, ParagraphToken, InhibitParagraphToken, const_string)
+
+# Each operation takes n, and returns a function which does the
+# operation on something of size n, so that making the input isn't
+# timed.
+
+def list_add(n) :
+    tokens = [StringToken("word ") if i % 3 else ParagraphToken() for i in xrange(n)]
+    def run() :
+        out = ListToken([])
+        for t in tokens :
+            out += t
+        return out
+    return run
+
+def string_add(n) :
+    pieces = [StringToken("x") for i in xrange(n)]
+    def run() :
+        out = const_string("")
+        for s in pieces :
+            out += s
+        return out.s
+    return run
+
+def string_stream_read_while(n) :
+    text = "ab " * (n // 3) + "."
+    def run() :
+        stream = streams.StringStream(text)
+        return stream.read_while("ab ")
+    return run
+
+_files = []
+
+def file_stream_read_while(n) :
+    (fd, filename) = tempfile.mkstemp(".hm")
+    f = os.fdopen(fd, "w")
+    f.write("ab " * (n // 3) + ".")
+    f.close()
+    _files.append(filename)
+    def run() :
+        stream = streams.fileStream(filename)
+        s = stream.read_while("ab ")
+        stream.read()
+        return s
+    return run
+
+def list_eval(n) :
+    def make(i) :
+        if i % 4 == 0 :
+            return ParagraphToken()
+        elif i % 4 == 1 :
+            return LambdaToken(lambda env : StringToken("lambda "))
+        elif i % 4 == 2 :
+            return ListToken([StringToken("nested "), InhibitParagraphToken()])
+        return StringToken("word ")
+    page = ListToken([make(i) for i in xrange(n)])
+    return lambda : page.eval({})
+
+def paragraphs(n) :
+    page = ListToken([StringToken("text ") if i % 5 else ParagraphToken() for i in xrange(n)])
+    return lambda : textmarkup.render_paragraphing(page).s
+
+def tabular(n) :
+    # n cells, in rows of ten
+    row = " & ".join(["c"] * 10) + " \\\\\n"
+    text = "\\begin{tabular}{" + "l" * 10 + "}\n" + row * max(1, n // 10) + "\\end{tabular}\n"
+    def run() :
+        stream = streams.StringStream(text)
+        return parser.parse_all(stream, textmarkup.char_pretty_text, parser.global_tokens, []).eval({})
+    return run
+
+OPERATIONS = [("ListToken +", list_add),
+              ("StringToken +", string_add),
+              ("StringStream.read_while", string_stream_read_while),
+              ("BufferedStream.read_while", file_stream_read_while),
+              ("ListToken.eval", list_eval),
+              ("render_paragraphing", paragraphs),
+              ("tabular", tabular)]
+
+# How far above the exponent of n log n (about 1.1 over the default
+# sizes) an operation may be.  Linear operations come out between 0.8
+# and 1.1 here, while a quadratic one comes out near 2, so this leaves
+# room for timing noise on a slow or busy machine without letting
+# quadratic behaviour through.  An operation over it is timed again,
+# and only fails if it is over it both times.
+TOLERANCE = 0.4
+
+def best_time(run, repeats=3) :
+    best = None
+    gc.disable()
+    try :
+        for i in range(0, repeats) :
+            start = time.time()
+            run()
+            elapsed = time.time() - start
+            if best is None or elapsed < best :
+                best = elapsed
+    finally :
+        gc.enable()
+    return best
+
+def fitted_exponent(sizes, times) :
+    """The k of the least squares fit of times to c*sizes^k."""
+    xs = [math.log(n) for n in sizes]
+    ys = [math.log(max(t, 1e-7)) for t in times]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    return sum((x - mx) * (y - my) for (x, y) in zip(xs, ys)) / sum((x - mx) ** 2 for x in xs)
+
+if __name__=="__main__" :
+    optparser = optparse.OptionParser(usage="%prog [options] [operation ...]")
+    optparser.add_option("--sizes", default="1000,10000,100000")
+    optparser.add_option("--tolerance", type="float", default=TOLERANCE,
+                         help="how far above the exponent of n log n an operation may be before it fails (default %default)")
+    (options, args) = optparser.parse_args()
+    sizes = [int(s) for s in options.sizes.split(",")]
+    allowed = fitted_exponent(sizes, [n * math.log(n) for n in sizes]) + options.tolerance
+    operations = [(name, f) for (name, f) in OPERATIONS if not args or name in args]
+    print "%-26s %s %8s" % ("operation", " ".join("%10s" % ("n=%d" % n) for n in sizes), "n^k")
+    failed = []
+    try :
+        for (name, f) in operations :
+            times = [best_time(f(n)) for n in sizes]
+            k = fitted_exponent(sizes, times)
+            if k > allowed :
+                # once more, in case the machine was busy
+                times = [best_time(f(n)) for n in sizes]
+                k = fitted_exponent(sizes, times)
+            if k > allowed :
+                failed.append(name)
+            print "%-26s %s %8.2f%s" % (name, " ".join("%9.4fs" % t for t in times), k,
+                                        "  worse than n log n" if k > allowed else "")
+    finally :
+        for filename in _files :
+            os.remove(filename)
+    print "allowed n^%.2f (n log n with tolerance %.2f)" % (allowed, options.tolerance)
+    if failed :
+        print "FAILED:", ", ".join(failed)
+        sys.exit(1)
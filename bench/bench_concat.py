@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# bench_concat.py
+#
+# parses and evaluates pages of increasing numbers of paragraphs to
+# show whether building up tokens with += scales linearly.
+# Usage: bench_concat.py [max paragraphs]
+
+import sys
+import time
+
+import benchutil
+import parser
+import streams
+import textmarkup
+
+_paragraph = """The younger muffin didn't know what to make of this.  What did
+being a \\textit{muffin} make him?  Well, surely a muffin -- but he
+wondered what it meant beyond this ``obvious'' fact.
+
+"""
+
+def time_page(paragraphs) :
+    stream = streams.StringStream(_paragraph * paragraphs)
+    start = time.time()
+    out = parser.parse_all(stream, textmarkup.char_pretty_text, parser.global_tokens, [])
+    parsed = time.time()
+    out.eval({})
+    return (parsed - start, time.time() - parsed)
+
+if __name__=="__main__" :
+    most = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    sizes = [most // 8, most // 4, most // 2, most]
+    print "%10s %10s %10s %14s" % ("paragraphs", "parse (s)", "eval (s)", "us/paragraph")
+    for n in sizes :
+        p, e = time_page(n)
+        print "%10d %10.3f %10.3f %14.1f" % (n, p, e, 1e6 * (p + e) / n)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# bench_deep_eval.py
+#
+# defines a chain of macros, each of which calls the one before it,
+# and times evaluating the deepest one.  Also reports the deepest
+# chain which can be evaluated at all.
+# Usage: bench_deep_eval.py [depth] [calls]
+
+import sys
+import time
+
+import benchutil
+import streams
+import parser
+
+def define_chain(prefix, depth) :
+    """Defines \\<prefix>0 ... \\<prefix><depth> and returns the parsed
+    (but not evaluated) call of the last one.  Each macro has its own
+    argument name, so the environment grows as the chain goes down."""
+    defs = ["\\def{%sa}{xa}{<\\var{xa}>}" % prefix]
+    for i in range(1, depth + 1) :
+        defs.append("\\def{%s%s}{x%s}{\\%s%s{%s}\\var{x%s}.}"
+                    % (prefix, name(i), name(i), prefix, name(i - 1), name(i), name(i)))
+    parser.global_parse(streams.StringStream("".join(defs)))
+    stream = streams.StringStream("\\%s%s{x}" % (prefix, name(depth)))
+    return parser.parse_one(stream, parser.global_char_env, parser.global_tokens, [])
+
+def name(i) :
+    # token names are letters only
+    s = ""
+    while True :
+        s = chr(ord("a") + i % 26) + s
+        i = i // 26
+        if i == 0 :
+            return s
+
+def deepest(limit) :
+    depth = 16
+    while depth <= limit :
+        call = define_chain("deep" + name(depth), depth)
+        try :
+            call.eval({})
+        except RuntimeError : # maximum recursion depth exceeded
+            return depth // 2
+        depth *= 2
+    return limit
+
+if __name__=="__main__" :
+    parser.macro_cache_size = 0 # time evaluating, not the memo
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    call = define_chain("chain", depth)
+    start = time.time()
+    for i in range(0, calls) :
+        call.eval({})
+    elapsed = time.time() - start
+    print "%d calls of a %d deep macro chain in %.3fs (%.1f us per call)" % (calls, depth, elapsed, 1e6 * elapsed / calls)
+    print "deepest chain evaluated (up to 4096): %d" % deepest(4096)
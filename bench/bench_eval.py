@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# bench_eval.py
+#
+# evaluates a synthetic page of many tokens (strings, paragraph
+# markers, lambdas and nested lists) with ListToken.eval and with a
+# reduce over +, which is how ListToken.eval used to work.
+# Usage: bench_eval.py [tokens]
+
+import sys
+import time
+
+import benchutil
+from lazytokens import (StringToken, ListToken, LambdaToken, ParagraphToken, InhibitParagraphToken)
+
+def make_page(ntokens) :
+    tokens = []
+    while len(tokens) < ntokens :
+        tokens.append(StringToken("Some text of a paragraph, "))
+        tokens.append(LambdaToken(lambda env : StringToken("<I>lazy</I>")))
+        tokens.append(ListToken([StringToken(" and "), InhibitParagraphToken(), StringToken("more")]))
+        tokens.append(StringToken(" text.\n"))
+        tokens.append(ParagraphToken())
+    return ListToken(tokens)
+
+def reduce_eval(listtoken, env) :
+    evaled = reduce(lambda lst, e : lst + e, [e.eval(env) for e in listtoken.tokens])
+    if type(evaled) == ListToken and len(evaled.tokens) == 1 :
+        return evaled.tokens[0]
+    else :
+        return evaled
+
+if __name__=="__main__" :
+    ntokens = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    page = make_page(ntokens)
+    for name, f in [("reduce", reduce_eval), ("ListToken.eval", ListToken.eval)] :
+        start = time.time()
+        f(page, {})
+        print "%-16s %8d tokens in %6.3fs" % (name, ntokens, time.time() - start)
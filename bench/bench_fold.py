@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# bench_fold.py
+#
+# builds a site of many small pages with a large page template and
+# some macros, with and without folding parsed trees (see
+# lazytokens.fold), and reports how many tokens were folded.
+# Usage: bench_fold.py [pages]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from benchutil import build
+import parser
+import lazytokens
+
+_template_part = """<DIV CLASS="nav">\\site{}: \\`a la carte, caf\\'e, na\\"ive,
+\\^ole, \\textit{\\'el\\`eve} \\sym{$x^2$} \\sym{$\\alpha+\\beta$}</DIV>
+"""
+
+_template = """<HTML><HEAD><TITLE>\\var{pagetitle}</TITLE>\\var{css}</HEAD>
+<BODY><H1>\\var{pagetitle}</H1>
+%s\\var{pagecontent}
+%s<P>Modified \\var{pagemodified}.</P></BODY></HTML>
+"""
+
+_defs = """\\def{site}{}{The \\textbf{Caf\\'e} \\textit{Na\\"ive} Site}
+\\def{sym}{s}{<SPAN CLASS="sym">\\var{s}</SPAN>}
+"""
+
+def make_site(dir, pages) :
+    f = open(os.path.join(dir, "template.hm"), "w")
+    f.write(_template % (_template_part * 20, _template_part * 20))
+    f.close()
+    f = open(os.path.join(dir, "site.hm"), "w")
+    f.write(_defs)
+    f.write("\\setpagetemplate{template.hm}\n")
+    for i in range(0, pages) :
+        f.write("\\begin{page}{page%d.html}\n" % i)
+        f.write("\\label{page%d}\n\\title{Page %d}\n\\modified{today}\n" % (i, i))
+        f.write("Some text with \\site{} in it.\n\n")
+        f.write("\\end{page}\n")
+    f.close()
+    return os.path.join(dir, "site.hm")
+
+if __name__=="__main__" :
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    dir = tempfile.mkdtemp()
+    try :
+        site = make_site(dir, pages)
+        for fold in [False, True] :
+            parser.partial_evaluation = fold
+            start = time.time()
+            build(site)
+            print "folding %-5s: %d pages in %.2fs" % (fold, pages, time.time() - start)
+        stats = lazytokens.fold_statistics()
+        print "folded %d of %d tokens looked at" % (stats["folded"], stats["visited"])
+    finally :
+        shutil.rmtree(dir)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# bench_incremental.py
+#
+# builds a made-up site of many pages, which refer to one another, in
+# full and then with --incremental, both with nothing changed and after
+# changing a line of one page, and reports the best time of each
+# along with how many pages the last run wrote.  Each build is a run of
+# runhm.py, since a run leaves counters and references behind.
+# Usage: bench_incremental.py [pages [runs]]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+_test = os.path.join(_root, "test")
+
+def page_source(i, pages, edit=0) :
+    parts = ["\\begin{page}{page%d.html}\n" % i,
+             "  \\label{page%d}\n" % i,
+             "  \\title{Page %d}\n" % i,
+             "  \\modified{1 Jan 2011}\n\n"]
+    for j in range(0, 4) :
+        parts.append("  \\section{Part %d}\n\n" % j)
+        parts.append("  This is \\textit{part} %d of page %d, which goes on to \\ref{page%d}.\n" % (j, i, (i + 1) % pages))
+        parts.append("  \\begin{itemize}\n  \\item One thing.\n  \\item And \\textbf{another}.\n  \\end{itemize}\n\n")
+    parts.append("  Edited %d times.\n" % edit)
+    parts.append("\\end{page}\n")
+    return "".join(parts)
+
+def make_site(directory, pages) :
+    shutil.copy(os.path.join(_test, "template.hm"), directory)
+    shutil.copy(os.path.join(_test, "default.css"), directory)
+    f = open(os.path.join(directory, "site.hm"), "w")
+    f.write("\\setstylesheet{default.css}\n\\setpagetemplate{template.hm}\n\n")
+    f.write("\\def{emph}{text}{\\textit{\\var{text}}}\n\n")
+    for i in range(0, pages) :
+        f.write("\\include{page%d.hm}\n" % i)
+    f.close()
+    for i in range(0, pages) :
+        write_page(directory, i, pages)
+
+def write_page(directory, i, pages, edit=0) :
+    f = open(os.path.join(directory, "page%d.hm" % i), "w")
+    f.write(page_source(i, pages, edit))
+    f.close()
+
+_written = [0] # pages written by the last run
+
+def run(inpfile, outdir, options=()) :
+    args = [sys.executable, os.path.join(_root, "runhm.py")] + list(options) + [inpfile, outdir]
+    output = subprocess.check_output(args)
+    _written[0] = sum(1 for line in output.splitlines() if line.startswith("Writing page"))
+
+def best_time(runs, f, setup=None) :
+    best = None
+    for i in range(0, runs) :
+        if setup is not None :
+            setup()
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        if best is None or elapsed < best :
+            best = elapsed
+    return best
+
+if __name__=="__main__" :
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    directory = tempfile.mkdtemp()
+    outdir = os.path.join(directory, "out")
+    inpfile = os.path.join(directory, "site.hm")
+    edits = [0]
+    def edit_one_page() :
+        edits[0] += 1
+        write_page(directory, pages // 2, pages, edits[0])
+    try :
+        make_site(directory, pages)
+        run(inpfile, outdir) # so the labels are right
+        print "%d pages" % pages
+        print "full             : %.1fms" % (1000 * best_time(runs, lambda : run(inpfile, outdir)))
+        incremental = lambda : run(inpfile, outdir, ["--incremental"])
+        incremental() # writes every page, since nothing is known about them
+        print "incremental, same: %.1fms" % (1000 * best_time(runs, incremental))
+        print "incremental, edit: %.1fms" % (1000 * best_time(runs, incremental, edit_one_page))
+        print "the last run wrote %d of %d pages" % (_written[0], pages)
+    finally :
+        shutil.rmtree(directory)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# bench_jobs.py
+#
+# builds a made-up site of many pages (the one bench_incremental.py
+# makes) with runhm.py -j N for a few N, and reports the best time of
+# each, how much faster it was than -j 1, and whether the pages came
+# out the same.
+# Usage: bench_jobs.py [pages [runs [N ...]]]
+
+import os
+import sys
+import time
+import shutil
+import filecmp
+import tempfile
+import multiprocessing
+import subprocess
+
+from bench_incremental import make_site
+
+_runhm = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "runhm.py")
+
+def run(inpfile, outdir, jobs) :
+    subprocess.check_output([sys.executable, _runhm, "-j", str(jobs), inpfile, outdir])
+
+def best_time(runs, f) :
+    best = None
+    for i in range(0, runs) :
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        if best is None or elapsed < best :
+            best = elapsed
+    return best
+
+def same_files(a, b) :
+    cmp = filecmp.dircmp(a, b)
+    if cmp.left_only or cmp.right_only :
+        return False
+    (match, mismatch, errors) = filecmp.cmpfiles(a, b, cmp.common_files, shallow=False)
+    if mismatch or errors :
+        return False
+    return all(same_files(os.path.join(a, d), os.path.join(b, d)) for d in cmp.common_dirs)
+
+if __name__=="__main__" :
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    jobs = [int(n) for n in sys.argv[3:]] or [1, 2, 4, 8]
+    directory = tempfile.mkdtemp()
+    inpfile = os.path.join(directory, "site.hm")
+    try :
+        make_site(directory, pages)
+        serial = os.path.join(directory, "out1")
+        run(inpfile, serial, 1) # so the labels are right
+        print "%d pages, %d cores" % (pages, multiprocessing.cpu_count())
+        base = None
+        for n in jobs :
+            outdir = os.path.join(directory, "out%d" % n)
+            elapsed = best_time(runs, lambda : run(inpfile, outdir, n))
+            if base is None :
+                base = elapsed
+            print "-j %-2d: %.1fms (%.2fx)%s" % (n, 1000 * elapsed, base / elapsed,
+                                                "" if same_files(serial, outdir) else ", pages differ")
+    finally :
+        shutil.rmtree(directory)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# bench_locations.py
+#
+# builds a site and counts how many ParseException and SourceLocation
+# objects were made along the way, plus the peak RSS.
+# Usage: bench_locations.py file.hm [file.hm ...]
+
+import sys
+import resource
+
+from benchutil import build
+import streams
+
+_counts = dict()
+
+def count_instances(cls) :
+    init = cls.__init__
+    def __init__(self, *args, **kwargs) :
+        _counts[cls.__name__] = _counts.get(cls.__name__, 0) + 1
+        init(self, *args, **kwargs)
+    cls.__init__ = __init__
+
+count_instances(streams.ParseException)
+if hasattr(streams, "SourceLocation") :
+    count_instances(streams.SourceLocation)
+
+if __name__=="__main__" :
+    for inpfile in sys.argv[1:] :
+        _counts.clear()
+        build(inpfile)
+        print "%s:" % inpfile
+        for name in sorted(_counts) :
+            print "  %-16s %8d" % (name, _counts[name])
+    print "peak RSS %d kB" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# bench_macro_cache.py
+#
+# builds a page which calls a few small math macros (like the ones in
+# test/test.hm) over and over, with the pure macro cache and without,
+# and reports how the cache did.
+# Usage: bench_macro_cache.py [paragraphs]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from benchutil import build
+import parser
+
+_defs = """\\def{R}{}{\\math{\\mathbf{R}}}
+\\def{Z}{}{\\math{\\mathbf{Z}}}
+\\def{abs}{v}{\\math{|\\,\\var{v}\\,|}}
+\\def{pmod}{n}{\\math{\\ (\\mathrm{mod}\\ \\var{n})}}
+"""
+
+_paragraph = """For $x\\in\\R$ we have $\\abs{x}=\\abs{-x}$ and $\\abs{x}\\leq\\abs{y}$,
+and for $a\\in\\Z$ that $a^2\\equiv b^2\\pmod{n}$ iff $a\\equiv\\pm b\\pmod{p}$
+when $n = p$ is prime, so $\\abs{a}$ and $\\abs{b}$ are in $\\Z$.
+
+"""
+
+def make_site(dir, paragraphs) :
+    f = open(os.path.join(dir, "template.hm"), "w")
+    f.write("<HTML><BODY>\\var{pagecontent}</BODY></HTML>\n")
+    f.close()
+    f = open(os.path.join(dir, "site.hm"), "w")
+    f.write("\\setpagetemplate{template.hm}\n")
+    f.write(_defs)
+    f.write("\\begin{page}{index.html}\n\\label{index}\n\\title{Macros}\n\\modified{today}\n")
+    f.write(_paragraph * paragraphs)
+    f.write("\\end{page}\n")
+    f.close()
+    return os.path.join(dir, "site.hm")
+
+if __name__=="__main__" :
+    paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    dir = tempfile.mkdtemp()
+    try :
+        site = make_site(dir, paragraphs)
+        for size in [0, parser.macro_cache_size] :
+            parser.macro_cache_size = size
+            parser.clear_macro_cache()
+            start = time.time()
+            build(site)
+            print "cache size %5d: %d paragraphs in %.2fs" % (size, paragraphs, time.time() - start)
+        stats = parser.macro_cache_statistics()
+        print "%d hits, %d misses, %d uncacheable, %d evictions, hit rate %.1f%%" % (
+            stats["hits"], stats["misses"], stats["uncacheable"], stats["evictions"], 100 * stats["hit_rate"])
+    finally :
+        shutil.rmtree(dir)
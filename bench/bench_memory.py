@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# bench_memory.py
+#
+# generates a site of math- and table-heavy pages, builds it, and
+# reports the peak RSS of the build.
+# Usage: bench_memory.py [pages] [paragraphs per page]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import resource
+
+from benchutil import build
+
+_template = """<HTML><HEAD><TITLE>\\var{pagetitle}</TITLE></HEAD>
+<BODY>\\var{pagecontent}</BODY></HTML>
+"""
+
+_paragraph = """Let $\\omega$ be a primitive root modulo $p$ and let $d$ be a divisor
+of $p-1$.  If $x$ is such that $x^d\\equiv 1$, then, since
+$x\\equiv\\omega^{k}$ for some $0\\leq k<p-1$, we have
+$\\omega^{dk}\\equiv1$.  ``So,'' he said -- \\textit{clearly} --
+\\begin{tabular}{|c|c|}
+  $i$ & $3^i$ \\\\ \\hline
+  1 & 3 \\\\
+  2 & 2 \\\\
+\\end{tabular}
+
+"""
+
+def make_site(dir, pages, paragraphs) :
+    f = open(os.path.join(dir, "template.hm"), "w")
+    f.write(_template)
+    f.close()
+    f = open(os.path.join(dir, "site.hm"), "w")
+    f.write("\\setpagetemplate{template.hm}\n")
+    for i in range(0, pages) :
+        f.write("\\begin{page}{page%d.html}\n" % i)
+        f.write("\\label{page%d}\n\\title{Page %d}\n\\modified{today}\n" % (i, i))
+        f.write(_paragraph * paragraphs)
+        f.write("\\end{page}\n")
+    f.close()
+    return os.path.join(dir, "site.hm")
+
+if __name__=="__main__" :
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    paragraphs = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    dir = tempfile.mkdtemp()
+    try :
+        site = make_site(dir, pages, paragraphs)
+        start = time.time()
+        build(site)
+        print "%d pages of %d paragraphs in %.2fs, peak RSS %d kB" % (
+            pages, paragraphs, time.time() - start,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    finally :
+        shutil.rmtree(dir)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# bench_parse_cache.py
+#
+# builds the documentation (doc/doc.hm, which includes doc_content.hm)
+# without the parse cache, with an empty one (cold, which parses and
+# saves every file) and with a full one (warm, which replays them), and
+# reports the best time of each.
+# Usage: bench_parse_cache.py [runs]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from benchutil import build
+import parser
+import parsecache
+
+_doc = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "doc", "doc.hm")
+
+def best_time(runs, setup=None) :
+    best = None
+    for i in range(0, runs) :
+        if setup is not None :
+            setup()
+        start = time.time()
+        build(_doc)
+        elapsed = time.time() - start
+        if best is None or elapsed < best :
+            best = elapsed
+    return best
+
+if __name__=="__main__" :
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    cachedir = tempfile.mkdtemp()
+    def empty_cache() :
+        shutil.rmtree(cachedir)
+        os.mkdir(cachedir)
+    try :
+        build(_doc) # so imports and the like aren't timed
+        print "no cache: %.1fms" % (1000 * best_time(runs))
+        parser.parse_cache_dir = cachedir
+        print "cold    : %.1fms" % (1000 * best_time(runs, empty_cache))
+        before = parsecache.parse_cache_statistics()
+        print "warm    : %.1fms" % (1000 * best_time(runs))
+        after = parsecache.parse_cache_statistics()
+        size = sum(os.path.getsize(os.path.join(cachedir, f)) for f in os.listdir(cachedir))
+        print "warm runs: %d hits, %d misses; %d entries, %d bytes" % (
+            after["hits"] - before["hits"], after["misses"] - before["misses"], len(os.listdir(cachedir)), size)
+    finally :
+        parser.parse_cache_dir = None
+        shutil.rmtree(cachedir)
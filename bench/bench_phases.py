@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# bench_phases.py
+#
+# builds a site from sitegen.py a few times in this process, timing the
+# phases of writing its pages from the spans tracing records (see
+# runhm.py --trace): parsing them, evaluating them, filling in the page
+# template, rendering the paragraphs and writing the files.  Prints, as
+# JSON, the times of the fastest build along with pages/s, MB/s of
+# input and output and the peak RSS, and what was built and with which
+# commit, so that runs on different commits can be compared.
+# Usage: bench_phases.py [pages [paragraphs per page]] [--mix kind=weight,...]
+#                        [--seed n] [--runs n] [-o file.json]
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import resource
+import optparse
+import subprocess
+import StringIO
+
+import benchutil
+import runhm
+import tracing
+import watch
+import sitegen
+
+# the spans which make up each phase; the time spent in a span which
+# is in another of these is only put down to the inner one
+PHASES = {"parse" : "parse",
+          "evaluate" : "eval",
+          "fill template" : "template",
+          "render_paragraphing" : "render_paragraphing",
+          "write" : "write"}
+
+def phase_times(events) :
+    """Adds up the time of the spans in events by phase, in seconds."""
+    times = dict((phase, 0.0) for phase in PHASES.itervalues())
+    stacks = dict()
+    for e in events :
+        stack = stacks.setdefault(e["pid"], [])
+        if e["ph"] == "B" :
+            stack.append([e.get("name"), e["ts"], 0.0])
+        elif e["ph"] == "E" :
+            (name, start, inner) = stack.pop()
+            elapsed = (e["ts"] - start) / 1e6
+            phase = PHASES.get(name)
+            if phase is not None :
+                times[phase] += elapsed - inner
+                elapsed_in_phases = elapsed
+            else :
+                elapsed_in_phases = inner
+            if stack :
+                stack[-1][2] += elapsed_in_phases
+    return times
+
+def directory_size(directory) :
+    return sum(os.path.getsize(os.path.join(d, f)) for (d, ds, fs) in os.walk(directory) for f in fs)
+
+def build_once(inpfile, outdir) :
+    watch.reset()
+    tracing.take_events()
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    start = time.time()
+    try :
+        runhm.runhm(inpfile, outdir)
+    finally :
+        sys.stdout = stdout
+    return (time.time() - start, phase_times(tracing.take_events()))
+
+def commit() :
+    try :
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, "w")).strip()
+    except Exception :
+        return None
+
+if __name__=="__main__" :
+    optparser = optparse.OptionParser(usage="%prog [options] [pages [paragraphs per page]]")
+    optparser.add_option("--mix", default="", help="weights of the kinds of paragraphs (see sitegen.py)")
+    optparser.add_option("--seed", type="int", default=0)
+    optparser.add_option("--runs", type="int", default=3)
+    optparser.add_option("-o", "--output", metavar="FILE", help="write the results into FILE rather than print them")
+    (options, args) = optparser.parse_args()
+    pages = int(args[0]) if len(args) > 0 else 100
+    paragraphs = int(args[1]) if len(args) > 1 else 20
+    mix = sitegen.parse_mix(options.mix) or sitegen.DEFAULT_MIX
+    directory = tempfile.mkdtemp()
+    try :
+        inpfile = sitegen.make_site(os.path.join(directory, "site"), pages, paragraphs, mix, options.seed)
+        outdir = os.path.join(directory, "out")
+        tracing.enabled = True
+        (total, times) = min(build_once(inpfile, outdir) for i in range(0, options.runs))
+        input_bytes = directory_size(os.path.dirname(inpfile)) - os.path.getsize(inpfile + ".ref")
+        output_bytes = directory_size(outdir)
+        times["other"] = total - sum(times.itervalues())
+        times["total"] = total
+        results = {"commit" : commit(),
+                   "python" : sys.version.split()[0],
+                   "site" : {"pages" : pages, "paragraphs" : paragraphs, "mix" : mix, "seed" : options.seed},
+                   "runs" : options.runs,
+                   "input_bytes" : input_bytes,
+                   "output_bytes" : output_bytes,
+                   "seconds" : times,
+                   "pages_per_second" : pages / total,
+                   "input_mb_per_second" : input_bytes / total / 1e6,
+                   "output_mb_per_second" : output_bytes / total / 1e6,
+                   "peak_rss_kb" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        text = json.dumps(results, indent=1, sort_keys=True)
+        if options.output is None :
+            print text
+        else :
+            f = open(options.output, "w")
+            f.write(text + "\n")
+            f.close()
+    finally :
+        shutil.rmtree(directory)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# bench_streams.py
+#
+# compares parse throughput of the character-at-a-time PeekStream with
+# the block-reading BufferedStream.  Usage: bench_streams.py [megabytes]
+
+import os
+import sys
+import tempfile
+import time
+
+import benchutil
+import parser
+import streams
+import textmarkup
+
+_paragraph = """``Hello everyone,'' he said.  Here is an expression
+$-3x^2 -\\lambda x+2$ and some \\textit{italic} and \\textbf{bold}
+text -- with a dash --- and a longer one, plus a \\verb|verbatim| bit.
+
+"""
+
+def make_source(nbytes) :
+    reps = nbytes // len(_paragraph) + 1
+    fd, filename = tempfile.mkstemp(suffix=".hm")
+    f = os.fdopen(fd, "w")
+    f.write(_paragraph * reps)
+    f.close()
+    return filename
+
+def time_parse(make_stream, filename) :
+    stream = make_stream(filename)
+    start = time.time()
+    # parse_one directly so that token concatenation doesn't dominate
+    while stream.peek() != "" :
+        parser.parse_one(stream, textmarkup.char_pretty_text, parser.global_tokens, [])
+    return time.time() - start
+
+def peek_stream(filename) :
+    stream = streams.PeekStream(open(filename, "r"))
+    stream.name = filename
+    return stream
+
+if __name__=="__main__" :
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    filename = make_source(int(megabytes * 1024 * 1024))
+    try :
+        size = os.path.getsize(filename) / (1024.0 * 1024.0)
+        for name, make_stream in [("PeekStream", peek_stream),
+                                  ("BufferedStream", streams.fileStream)] :
+            t = time_parse(make_stream, filename)
+            print "%-16s %6.2f MB in %6.2fs = %6.2f MB/s" % (name, size, t, size / t)
+    finally :
+        os.remove(filename)
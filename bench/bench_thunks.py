@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# bench_thunks.py
+#
+# calls a macro which mentions its argument three times, with an
+# argument which counts how many times it is evaluated, and times
+# parsing and evaluating the calls.  An argument is evaluated once per
+# call (it was once per mention, 3 times a call, before arguments were
+# bound as thunks).
+# Usage: bench_thunks.py [calls]
+
+import sys
+import time
+
+import benchutil
+import streams
+import parser
+from lazytokens import LambdaToken, const_string
+
+_evaluations = [0]
+
+def counted_handler(stream, char_env, escape_env, begin_stack) :
+    def _handler(env) :
+        _evaluations[0] += 1
+        return const_string("x")
+    return LambdaToken(_handler)
+
+if __name__=="__main__" :
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    parser.global_tokens["counted"] = counted_handler
+    parser.global_parse(streams.StringStream("\\def{thrice}{v}{(\\var{v}, \\var{v}, \\var{v})}"))
+    stream = streams.StringStream("\\thrice{\\counted}" * calls)
+    start = time.time()
+    out = parser.global_parse(stream).eval({})
+    elapsed = time.time() - start
+    print "%d calls in %.3fs, argument evaluated %d times, output %d characters" % (
+        calls, elapsed, _evaluations[0], len(out.s))
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# bench_token_env.py
+#
+# builds sites and reports how the TokenEnvironment lookup memo did.
+# Usage: bench_token_env.py file.hm [file.hm ...]
+
+import sys
+import time
+
+from benchutil import build
+import environments
+
+if __name__=="__main__" :
+    for inpfile in sys.argv[1:] :
+        start = time.time()
+        build(inpfile)
+        print "%s: built in %.3fs" % (inpfile, time.time() - start)
+    stats = environments.lookup_statistics()
+    print "lookups: %d hits, %d misses, hit rate %.1f%%, average depth on a miss %.2f" % (
+        stats["hits"], stats["misses"], 100 * stats["hit_rate"], stats["average_depth"])
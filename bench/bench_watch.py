@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# bench_watch.py
+#
+# builds a made-up site of many pages (the one bench_incremental.py
+# makes), then changes a line of one page and builds it again, both
+# with a new run of runhm.py --incremental and in the same process, as
+# runhm.py --watch does.  Reports the best time of each, and whether
+# the pages came out the same.
+# Usage: bench_watch.py [pages [runs]]
+
+import os
+import sys
+import shutil
+import tempfile
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_incremental import make_site, write_page, run, best_time
+from bench_jobs import same_files
+import runhm
+import pagedeps
+import watch
+
+def build_in_process(inpfile, outdir) :
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try :
+        watch.build_once(lambda : runhm.runhm(inpfile, outdir))
+    finally :
+        sys.stdout = stdout
+
+if __name__=="__main__" :
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    directory = tempfile.mkdtemp()
+    inpfile = os.path.join(directory, "site.hm")
+    edits = [0]
+    def edit_one_page() :
+        edits[0] += 1
+        write_page(directory, pages // 2, pages, edits[0])
+    try :
+        make_site(directory, pages)
+        separate = os.path.join(directory, "separate")
+        same = os.path.join(directory, "same")
+        run(inpfile, separate, ["--incremental"])
+        print "%d pages" % pages
+        print "new process: %.1fms" % (1000 * best_time(runs, lambda : run(inpfile, separate, ["--incremental"]), edit_one_page))
+        pagedeps.enabled = True
+        build_in_process(inpfile, same)
+        print "in process : %.1fms" % (1000 * best_time(runs, lambda : build_in_process(inpfile, same), edit_one_page))
+        run(inpfile, separate, ["--incremental"])
+        print "the pages %s" % ("are the same" if same_files(separate, same) else "differ")
+    finally :
+        shutil.rmtree(directory)
@@ -0,0 +1,29 @@
+# benchutil.py
+#
+# shared helpers for the benchmark scripts.  Importing this puts the
+# htmacros sources on the path.
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import runhm
+
+def build(inpfile, quiet=True) :
+    """Runs runhm on inpfile into a scratch output directory, which is
+    removed afterwards along with the .ref file the run leaves."""
+    inpfile = os.path.abspath(inpfile)
+    outdir = tempfile.mkdtemp()
+    stdout = sys.stdout
+    if quiet :
+        sys.stdout = open(os.devnull, "w")
+    try :
+        runhm.runhm(inpfile, outdir)
+    finally :
+        sys.stdout = stdout
+        shutil.rmtree(outdir)
+        if os.path.isfile(inpfile + ".ref") :
+            os.remove(inpfile + ".ref")
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# check_forward_refs.py
+#
+# checks that --incremental gets a reference to a label made after it
+# right in a single run: page one refers to page two, whose title is
+# changed between builds, and one.html must have the new title at once
+# (and must still be skipped when nothing changed).  Each build is a
+# run of runhm.py, with and without -j.  Exits 1 if it goes wrong.
+# Usage: check_forward_refs.py
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+_template = "<HTML><HEAD><TITLE>\\var{pagetitle}</TITLE></HEAD><BODY>\\var{pagecontent}</BODY></HTML>\n"
+
+def write_site(directory, title) :
+    f = open(os.path.join(directory, "template.hm"), "w")
+    f.write(_template)
+    f.close()
+    f = open(os.path.join(directory, "site.hm"), "w")
+    f.write("\\setpagetemplate{template.hm}\n\n"
+            "\\begin{page}{one.html}\n  \\label{p1}\\title{One}\\modified{1 Jan 2011}\n\n"
+            "  See \\ref{p2}.\n\\end{page}\n\n"
+            "\\begin{page}{two.html}\n  \\label{p2}\\title{%s}\\modified{1 Jan 2011}\n\n"
+            "  The second page.\n\\end{page}\n" % title)
+    f.close()
+
+def build(directory, jobs) :
+    output = subprocess.check_output([sys.executable, os.path.join(_root, "runhm.py"), "--incremental", "-j", str(jobs),
+                                      os.path.join(directory, "site.hm"), os.path.join(directory, "out")])
+    f = open(os.path.join(directory, "out", "one.html"))
+    try :
+        return (output, f.read())
+    finally :
+        f.close()
+
+def check(jobs) :
+    directory = tempfile.mkdtemp()
+    failures = []
+    try :
+        write_site(directory, "Two")
+        build(directory, jobs)
+        write_site(directory, "Deux")
+        (output, one) = build(directory, jobs)
+        if ">Deux</A>" not in one :
+            failures.append("one.html doesn't have the new title: " + repr(one))
+        (output, one) = build(directory, jobs)
+        if ">Deux</A>" not in one :
+            failures.append("one.html lost the new title when nothing changed: " + repr(one))
+        if jobs == 1 and "Writing page" in output :
+            failures.append("a page was written when nothing changed:\n" + output)
+    finally :
+        shutil.rmtree(directory)
+    return failures
+
+if __name__=="__main__" :
+    failed = False
+    for jobs in (1, 2) :
+        failures = check(jobs)
+        print "-j %d: %s" % (jobs, "ok" if not failures else "FAILED")
+        for f in failures :
+            print "  " + f
+        failed = failed or bool(failures)
+    if failed :
+        sys.exit(1)
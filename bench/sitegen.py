@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# sitegen.py
+#
+# writes a made-up site for the benchmarks: a main file with a few
+# \def macros which \include's one file per page.  Each page is made
+# of paragraphs of kinds picked at random by weight (see KINDS), from a
+# seeded random number generator, so the same arguments always give the
+# same site.
+# Usage: sitegen.py directory [pages [paragraphs per page]]
+#                   [--mix kind=weight,...] [--seed n]
+
+import os
+import sys
+import random
+import optparse
+
+# the kinds of paragraphs, and how much of each there is by default
+KINDS = ["prose", "macro", "inline_math", "display_math", "tabular", "itemize", "footnote", "ref"]
+DEFAULT_MIX = {"prose" : 4, "macro" : 2, "inline_math" : 2, "display_math" : 1,
+               "tabular" : 1, "itemize" : 1, "footnote" : 1, "ref" : 2}
+
+_words = ("the of a site page which is in that for as with each macro text "
+          "environment token label number table list item reference program "
+          "output input written more than when where so it this one two").split()
+
+_template = """<HTML><HEAD><TITLE>\\var{pagetitle}</TITLE>\\var{css}</HEAD>
+<BODY><H1>\\var{pagetitle}</H1>
+\\var{pagecontent}
+<P>Modified \\var{pagemodified}.</P></BODY></HTML>
+"""
+
+_css = "body { font-family: serif; }\n"
+
+_defs = """\\def{term}{t}{\\textbf{\\var{t}}}
+\\def{pair}{a,b}{(\\var{a}, \\var{b})}
+\\def{note}{}{\\textit{Note:}}
+"""
+
+def parse_mix(text) :
+    """Turns "prose=3,tabular=1" into a dict of weights.  Kinds left
+    out get no weight."""
+    mix = dict()
+    for part in text.split(",") :
+        if part.strip() == "" :
+            continue
+        (kind, weight) = part.split("=")
+        kind = kind.strip()
+        if kind not in KINDS :
+            raise ValueError("No such kind of paragraph "+repr(kind)+"; the kinds are "+", ".join(KINDS)+".")
+        mix[kind] = int(weight)
+    return mix
+
+class Generator(object) :
+    def __init__(self, pages, mix, seed) :
+        self.pages = pages
+        self.mix = mix
+        self.random = random.Random(seed)
+    def words(self, n) :
+        return " ".join(self.random.choice(_words) for i in range(0, n))
+    def sentence(self) :
+        s = self.words(self.random.randint(6, 14))
+        r = self.random.random()
+        if r < 0.2 :
+            s += " \\textit{" + self.words(2) + "}"
+        elif r < 0.3 :
+            s += " ``" + self.words(3) + "''"
+        return s[0].upper() + s[1:] + "."
+    def prose(self) :
+        return " ".join(self.sentence() for i in range(0, self.random.randint(3, 6)))
+    def macro(self) :
+        return "%s \\note{} \\term{%s} is %s, and \\pair{%s}{%s}." % (
+            self.sentence(), self.words(1), self.words(4), self.random.randint(0, 99), self.words(1))
+    def inline_math(self) :
+        return "%s Let $x^%d+\\alpha_%d\\leq\\frac{p-1}{%d}$ and $\\omega^{k}\\equiv1$, %s." % (
+            self.sentence(), self.random.randint(2, 9), self.random.randint(0, 9), self.random.randint(2, 9), self.words(5))
+    def display_math(self) :
+        return "%s\n\\begin{equation*}\n  f(x)=%d\\cdot x^%d+\\frac{1}{x}\n\\end{equation*}" % (
+            self.sentence(), self.random.randint(2, 9), self.random.randint(2, 9))
+    def tabular(self) :
+        rows = ["  %s & $%d$ & %s \\\\" % (self.words(1), self.random.randint(0, 999), self.words(2))
+                for i in range(0, self.random.randint(3, 8))]
+        return "\\begin{tabular}{|l|r|c|}\n  \\hline\n" + "\n".join(rows) + "\n  \\hline\n\\end{tabular}"
+    def itemize(self) :
+        items = ["  \\item %s" % self.sentence() for i in range(0, self.random.randint(2, 6))]
+        return "\\begin{itemize}\n" + "\n".join(items) + "\n\\end{itemize}"
+    def footnote(self) :
+        return "%s\\footnote{%s} %s" % (self.sentence(), self.sentence(), self.sentence())
+    def ref(self) :
+        return "%s See \\ref{page%d}, or \\ref{page%d}." % (
+            self.sentence(), self.random.randrange(self.pages), self.random.randrange(self.pages))
+    def paragraph(self) :
+        kinds = [k for k in KINDS if self.mix.get(k, 0) > 0]
+        pick = self.random.randrange(sum(self.mix[k] for k in kinds))
+        for kind in kinds :
+            pick -= self.mix[kind]
+            if pick < 0 :
+                return getattr(self, kind)()
+    def page(self, i, paragraphs) :
+        parts = ["\\begin{page}{page%d.html}\n" % i,
+                 "\\label{page%d}\n\\title{Page %d}\n\\modified{1 Jan 2011}\n\n" % (i, i)]
+        for j in range(0, paragraphs) :
+            if j % 5 == 0 :
+                parts.append("\\section{Part %d}\n\n" % (j // 5))
+            parts.append(self.paragraph() + "\n\n")
+        parts.append("\\end{page}\n")
+        return "".join(parts)
+
+def make_site(directory, pages, paragraphs=20, mix=None, seed=0) :
+    """Writes the site into directory, and returns the name of its main
+    file."""
+    if mix is None :
+        mix = DEFAULT_MIX
+    if not os.path.isdir(directory) :
+        os.makedirs(directory)
+    generator = Generator(pages, mix, seed)
+    for (name, text) in [("template.hm", _template), ("site.css", _css)] :
+        f = open(os.path.join(directory, name), "w")
+        f.write(text)
+        f.close()
+    f = open(os.path.join(directory, "site.hm"), "w")
+    f.write("\\setstylesheet{site.css}\n\\setpagetemplate{template.hm}\n\n" + _defs + "\n")
+    for i in range(0, pages) :
+        f.write("\\include{page%d.hm}\n" % i)
+    f.close()
+    for i in range(0, pages) :
+        f = open(os.path.join(directory, "page%d.hm" % i), "w")
+        f.write(generator.page(i, paragraphs))
+        f.close()
+    return os.path.join(directory, "site.hm")
+
+if __name__=="__main__" :
+    optparser = optparse.OptionParser(usage="%prog [options] directory [pages [paragraphs per page]]")
+    optparser.add_option("--mix", default="", help="weights of the kinds of paragraphs, like prose=3,tabular=1 (kinds: "+", ".join(KINDS)+")")
+    optparser.add_option("--seed", type="int", default=0)
+    (options, args) = optparser.parse_args()
+    if not 1 <= len(args) <= 3 :
+        optparser.print_usage()
+        sys.exit(1)
+    pages = int(args[1]) if len(args) > 1 else 50
+    paragraphs = int(args[2]) if len(args) > 2 else 20
+    print make_site(args[0], pages, paragraphs, parse_mix(options.mix) or None, options.seed)
@@ -1,21 +1,43 @@
 # environments.py
 
+from streams import char_class
+
+# The merged bindings of a CharacterEnvironment are cached along with
+# _char_generation, which setting a binding in any of them bumps, so
+# checking a cache doesn't walk the chain.  Handlers are set when
+# modules are loaded, and environments are only extended after that.
+_char_generation = 0
+
 class CharacterEnvironment(object) :
     def __init__(self, bindings, parent) :
         self.bindings = bindings
         self.parent = parent
+        self._flat = None # (generation, flattened bindings, stop chars)
     def __getitem__(self, key) :
         if self.bindings.has_key(key) :
             return self.bindings[key]
         else :
             return self.parent[key]
     def __setitem__(self, key, value) :
+        global _char_generation
         self.bindings[key] = value
+        _char_generation += 1
+    def flat_bindings(self) :
+        """Returns the bindings of this environment merged with those of
+        its parents.  This is cached until a binding is set, so it must
+        not be modified."""
+        if self._flat is None or self._flat[0] != _char_generation :
+            bindings = dict(self.parent.flat_bindings())
+            bindings.update(self.bindings)
+            self._flat = (_char_generation, bindings, char_class(bindings))
+        return self._flat[1]
+    def stop_chars(self) :
+        """Returns the CharClass of characters which have handlers, that
+        is, those which end a run of plain text."""
+        self.flat_bindings()
+        return self._flat[2]
     def get_bindings(self) :
-        bindings = self.parent.get_bindings()
-        for key, val in self.bindings.iteritems() :
-            bindings[key] = val
-        return bindings
+        return dict(self.flat_bindings())
     def extend(self, extendWith=None) :
         if extendWith==None :
             extendWith = {}
@@ -24,12 +46,17 @@ class CharacterEnvironment(object) :
         return "<CharacterEnvironment bindings="+repr(self.bindings)+" parent="+repr(self.parent)+">"
 
 class DefaultCharacterEnvironment(CharacterEnvironment) :
+    parent = None
     def __init__(self, handler) :
         self.handler = handler
     def __getitem__(self, key) :
         return self.handler
     def __setitem__(self, key, value) :
         raise Exception("Default character environment can not be set.")
+    def flat_bindings(self) :
+        return dict()
+    def stop_chars(self) :
+        return char_class("")
     def get_bindings(self) :
         return dict()
     def extend(self, extendWith=None) :
@@ -51,35 +78,131 @@ def add_token_handler(token_env, name) :
         return f
     return add_handler
 
+def impure(f) :
+    """Marks a token handler (or the begin handler of an environment)
+    as having side effects, like setting counters or labels, or as
+    depending on more than its arguments.  Macros using it are then
+    never memoized.  Goes below add_token_handler."""
+    f.pure = False
+    return f
+
+# Lookups in TokenEnvironments are memoized per environment.  Any
+# binding being set anywhere bumps _generation, which throws away every
+# memo.  Sets are rare compared to lookups (a \def, a \title), so this
+# is simpler than tracking which environments are below the one set.
+_generation = 0
+_unbound = object()
+_lookup_counts = {"hits" : 0, "misses" : 0, "depth" : 0}
+
+def lookup_statistics() :
+    """Returns a dict of how the TokenEnvironment memo has done: hits,
+    misses, hit_rate, and the average chain depth walked on a miss."""
+    hits = _lookup_counts["hits"]
+    misses = _lookup_counts["misses"]
+    return {"hits" : hits,
+            "misses" : misses,
+            "hit_rate" : float(hits) / (hits + misses) if hits + misses else 0.0,
+            "average_depth" : float(_lookup_counts["depth"]) / misses if misses else 0.0}
+
 class TokenEnvironment(object) :
     def __init__(self, bindings, parent=None) :
         self.bindings = bindings
         self.parent = parent
+        self._memo = None
+        self._memo_generation = _generation
+    def lookup(self, key) :
+        """Returns the value bound to key here or in a parent, or
+        _unbound if there is none, walking the chain at most once."""
+        if self._memo is None or self._memo_generation != _generation :
+            self._memo = dict()
+            self._memo_generation = _generation
+        elif key in self._memo :
+            _lookup_counts["hits"] += 1
+            return self._memo[key]
+        env = self
+        depth = 1
+        while True :
+            if key in env.bindings :
+                value = env.bindings[key]
+                break
+            env = env.parent
+            if env is None :
+                value = _unbound
+                break
+            depth += 1
+        _lookup_counts["misses"] += 1
+        _lookup_counts["depth"] += depth
+        self._memo[key] = value
+        return value
     def __getitem__(self, key) :
-        if self.bindings.has_key(key) :
-            return self.bindings[key]
-        elif self.parent is not None :
-            return self.parent[key]
-        else :
-            print self
+        value = self.lookup(key)
+        if value is _unbound :
             raise KeyError(key)
+        return value
     def has_key(self, key) :
-        if self.bindings.has_key(key) :
-            return True
-        elif self.parent is not None :
-            return self.parent.has_key(key)
-        else :
-            return False
+        return self.lookup(key) is not _unbound
     def __setitem__(self, key, value) :
+        global _generation
         self.bindings[key] = value
+        _generation += 1
     def get(self, k, d=None) :
-        try :
-            return self[k]
-        except KeyError :
+        value = self.lookup(k)
+        if value is _unbound :
             return d
+        return value
     def extend(self, extendWith=None) :
         if extendWith==None :
             extendWith = {}
         return TokenEnvironment(extendWith, self)
+    def snapshot(self) :
+        """Returns the bindings of this environment and its parents as
+        they are now, for restore_snapshot."""
+        snapshot = []
+        env = self
+        while env is not None :
+            snapshot.append((env, dict(env.bindings)))
+            env = env.parent
+        return snapshot
     def __repr__(self) :
         return "<TokenEnvironment bindings="+repr(self.bindings)+" parent="+repr(self.parent)+">"
+
+def restore_snapshot(snapshot) :
+    """Puts back the bindings from TokenEnvironment.snapshot."""
+    global _generation
+    for (env, bindings) in snapshot :
+        env.bindings.clear()
+        env.bindings.update(bindings)
+    _generation += 1
+
+# The environment of \var bindings which tokens are evaluated in.  A
+# macro call puts its arguments on top of the caller's environment
+# rather than copying it, so a call costs as much as its arguments.
+# The bottom of a chain can be a plain dict, which is what eval is
+# usually handed.
+class EvalEnvironment(object) :
+    __slots__ = ("bindings", "parent")
+    def __init__(self, bindings, parent=None) :
+        self.bindings = bindings
+        self.parent = parent
+    def __getitem__(self, key) :
+        env = self
+        while type(env) is EvalEnvironment :
+            if key in env.bindings :
+                return env.bindings[key]
+            env = env.parent
+        if env is None :
+            raise KeyError(key)
+        return env[key]
+    def has_key(self, key) :
+        try :
+            self[key]
+            return True
+        except KeyError :
+            return False
+    def get(self, key, d=None) :
+        try :
+            return self[key]
+        except KeyError :
+            return d
+    def __repr__(self) :
+        return "<EvalEnvironment bindings="+repr(self.bindings)+" parent="+repr(self.parent)+">"
@@ -2,7 +2,8 @@
 
 from lazytokens import (StringToken, LambdaToken, ListToken, VariableToken, SelfEvaluatingToken)
 from parser import (make_handler, global_char_env, parse_one, parse_all, read_bracket_args)
-from environments import (CharacterEnvironment, add_char_handler, add_token_handler)
+from environments import (CharacterEnvironment, add_char_handler, add_token_handler, impure)
+import pagedeps
 import shutil
 import os.path
 import subprocess
@@ -14,8 +15,8 @@ environment_handlers = dict()
 
 # handles \file[link name]{filename}.
 @add_token_handler(token_handlers, "file")
+@impure
 def fileref_handler(stream, char_env, token_env, begin_stack) :
-    poss_err = stream.failure()
     barg = read_bracket_args(stream, char_env, token_env, begin_stack)
     filename = parse_one(stream, char_env, token_env, begin_stack)
     
@@ -28,6 +29,7 @@ def fileref_handler(stream, char_env, token_env, begin_stack) :
 
         fn2 = os.path.abspath(os.path.join(token_env["_global_input_dir"], fn))
         outfile = os.path.abspath(os.path.join(token_env["_curr_out_dir"], fn))
+        pagedeps.record_file(fn2)
         
         print "Copying",repr(fn2),"to",repr(outfile),
         
@@ -39,6 +41,7 @@ def fileref_handler(stream, char_env, token_env, begin_stack) :
         else :
             print
             shutil.copy(fn2, outfile)
+        pagedeps.record_output(outfile)
         
         relout = os.path.relpath(outfile, token_env["_curr_out_dir"])
         return StringToken("<A HREF=\""+relout+"\">"+linktext+"</A>")
@@ -47,8 +50,8 @@ def fileref_handler(stream, char_env, token_env, begin_stack) :
 
 # handles a reference to an absolute path in the output directory
 @add_token_handler(token_handlers, "relref")
+@impure
 def relref_handler(stream, char_env, token_env, begin_stack) :
-    poss_err = stream.failure()
     filename = parse_one(stream, char_env, token_env, begin_stack)
 
     def _handler(env) :
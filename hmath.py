@@ -4,7 +4,7 @@
 # for more information on handling html math stuff see
 # http://www.cs.tut.fi/~jkorpela/math/
 
-from lazytokens import (StringToken, LambdaToken, ListToken, VariableToken, SelfEvaluatingToken, Token, ParagraphToken, InhibitParagraphToken, ColumnBreakToken, LineBreakToken)
+from lazytokens import (StringToken, LambdaToken, ListToken, VariableToken, SelfEvaluatingToken, Token, ParagraphToken, InhibitParagraphToken, ColumnBreakToken, LineBreakToken, ThenToken, self_evaluating, const_string)
 from parser import (make_handler, global_char_env, parse_one, parse_all, read_bracket_args, open_brace_handler)
 from environments import (CharacterEnvironment, add_char_handler, add_token_handler)
 import string
@@ -16,22 +16,31 @@ environment_handlers = dict()
 
 math_char_env = CharacterEnvironment({}, global_char_env)
 
+# parts names the slots of a math token which hold tokens that are
+# evaluated when it is rendered (see pure_math).
+@self_evaluating
 class MathToken(Token) :
+    __slots__ = ()
+    parts = ()
     def eval(self, env) :
         return self
     def render(self, env) :
         self.fail("Math token "+repr(self)+" has not implemented a render method.")
 
 class MathNoToken(MathToken) :
-    pass
+    __slots__ = ()
 
 class MathPassThroughToken(MathToken) :
+    __slots__ = ("obj",)
+    parts = ("obj",)
     def __init__(self, obj) :
+        MathToken.__init__(self, None)
         self.obj = obj
     def render(self, env) :
         return render_math(self.obj, env)
 
 class MathOrdToken(MathToken) :
+    __slots__ = ("display_text",)
     def __init__(self, stream, display_text) :
         Token.__init__(self, stream)
         self.display_text = display_text
@@ -41,6 +50,7 @@ class MathOrdToken(MathToken) :
         return StringToken(self.display_text)
 
 class MathOpToken(MathToken) :
+    __slots__ = ("display_text", "trailingspace")
     def __init__(self, stream, display_text) :
         Token.__init__(self, stream)
         self.display_text = display_text
@@ -48,12 +58,14 @@ class MathOpToken(MathToken) :
     def __repr__(self) :
         return "<MathOpToken "+repr(self.display_text)+">"
     def render(self, env) :
-        return StringToken(self.display_text)+StringToken(self.trailingspace)
+        return StringToken(self.display_text)+const_string(self.trailingspace)
 
 class MathBraceStartToken(MathToken) :
     """See math_open_brace_handler."""
+    __slots__ = ()
 
 class MathBinToken(MathToken) :
+    __slots__ = ("display_text",)
     def __init__(self, stream, display_text) :
         Token.__init__(self, stream)
         self.display_text = display_text
@@ -63,11 +75,12 @@ class MathBinToken(MathToken) :
         return StringToken(" "+self.display_text+" ")
     def coerce_down(self) : # takes a binary operator and coerces it into a prefix operator
         t = MathOpToken(None, self.display_text)
-        t.streamerr = self.streamerr
+        t.location = self.location
         t.trailingspace = "" # no trailing space for a coerced binary operator
         return t
 
 class MathRelToken(MathToken) :
+    __slots__ = ("display_text",)
     def __init__(self, stream, display_text) :
         Token.__init__(self, stream)
         self.display_text = display_text
@@ -77,6 +90,8 @@ class MathRelToken(MathToken) :
         return StringToken("&ensp;"+self.display_text+"&ensp;")
 
 class MathOpenToken(MathToken) :
+    __slots__ = ("display_text", "insides", "close")
+    parts = ("insides", "close")
     def __init__(self, stream, display_text) :
         Token.__init__(self, stream)
         self.display_text = display_text
@@ -89,18 +104,19 @@ class MathOpenToken(MathToken) :
         insides = self.insides.eval(env)
         close = self.close.eval(env)
         new = MathOpenToken(None, self.display_text)
-        new.streamerr = self.streamerr
+        new.location = self.location
         new.insides = insides
         new.close = close
         return new
     def render(self, env) :
         if self.insides == None :
-            self.insides = StringToken("")
+            self.insides = const_string("")
         if self.close == None :
             self.fail("Missing closing delimeter to match "+repr(self)+".")
         return (StringToken(self.display_text) + render_math(self.insides, env) + render_math(self.close, env))
 
 class MathCloseToken(MathToken) :
+    __slots__ = ("display_text",)
     def __init__(self, stream, display_text) :
         Token.__init__(self, stream)
         self.display_text = display_text
@@ -128,15 +144,15 @@ def unrendered_math_handler(stream, char_env, escape_env, begin_stack) :
 
 @add_char_handler(char_handlers, '$')
 def inline_math_handler(stream, char_env, escape_env, begin_stack) :
-    possible_start_failure = stream.failure("Missing closing '$ for math mode.")
+    start = stream.location()
     stream.read()
     if stream.peek() == '$' :
-        raise possible_start_failure.with_message("Math mode '$$' is empty.")
+        raise start.failure("Math mode '$$' is empty.")
     begin_stack2 = begin_stack + ["$"]
     out = parse_one(stream, math_char_env, escape_env, begin_stack2)
     while stream.peek() != '$' :
         if stream.peek() == "" :
-            raise possible_start_failure
+            raise start.failure("Missing closing '$ for math mode.")
         else :
             out += parse_one(stream, math_char_env, escape_env, begin_stack2)
     stream.read() # read the final '$'
@@ -145,7 +161,7 @@ def inline_math_handler(stream, char_env, escape_env, begin_stack) :
 # but still wanna write $ sometimes
 @add_token_handler(token_handlers, '$')
 def escape_dollar_handler(stream, char_env, escape_env, begin_stack) :
-    return StringToken("$")
+    return const_string("$")
 
 
 ###
@@ -154,7 +170,7 @@ def escape_dollar_handler(stream, char_env, escape_env, begin_stack) :
 def begin_equation_s_environment(stream, char_env, token_env) :
     return (math_char_env, token_env)
 def end_equation_s_environment(char_env, escape_env, outer_token_env, out) :
-    return ParagraphToken() + InhibitParagraphToken() + (StringToken("<CENTER>") + make_render_math(out) + StringToken("</CENTER>\n")) + ParagraphToken()
+    return ParagraphToken() + InhibitParagraphToken() + (const_string("<CENTER>") + make_render_math(out) + const_string("</CENTER>\n")) + ParagraphToken()
 # the following forgets to create a paragraph break after the math
 #    return InhibitParagraphToken()+StringToken("<CENTER>") + make_render_math(out) + StringToken("</CENTER>\n")
 environment_handlers["equation*"] = (begin_equation_s_environment, end_equation_s_environment)
@@ -166,7 +182,7 @@ environment_handlers["equation*"] = (begin_equation_s_environment, end_equation_
 def begin_aligns_environment(stream, char_env, token_env) :
     return (math_char_env, token_env)
 def end_aligns_environment(char_env, escape_env, outer_token_env, out) :
-    return InhibitParagraphToken()+StringToken("<CENTER>") + out + StringToken("</CENTER>\n")
+    return InhibitParagraphToken()+const_string("<CENTER>") + out + const_string("</CENTER>\n")
 environment_handlers["align*"] = (begin_aligns_environment, end_aligns_environment)
 
 ###
@@ -179,39 +195,39 @@ def begin_matrix_environment(stream, char_env, token_env) :
     return (math_char_env.extend({"&" : col_break_handler}),
             token_env)
 def end_matrix_environment(char_env, escape_env, outer_token_env, out) :
-    table = StringToken("<TABLE CLASS=\"mathmatrix\">\n")
+    table = const_string("<TABLE CLASS=\"mathmatrix\">\n")
     if type(out) is ListToken :
         inrow = False
         incolumn = False
         for token in out.tokens :
             if type(token) is LineBreakToken :
                 if incolumn :
-                    table += StringToken("</TD>")
+                    table += const_string("</TD>")
                 if inrow :
-                    table += StringToken("</TR>\n")
+                    table += const_string("</TR>\n")
                 else :
                     token.fail("Line break in matrix for no elements.")
                 inrow = False
                 incolumn = False
             elif type(token) is ColumnBreakToken :
                 if incolumn :
-                    table += StringToken("</TD>")
+                    table += const_string("</TD>")
                 incolumn = False
             else :
                 if not inrow :
-                    table += StringToken("<TR>")
+                    table += const_string("<TR>")
                 if not incolumn :
-                    table += StringToken("<TD>")
+                    table += const_string("<TD>")
                 inrow = True
                 incolumn = True
                 table += token
         if incolumn :
-            table += StringToken("</TD>")
+            table += const_string("</TD>")
         if inrow :
-            table += StringToken("</TR>\n")
+            table += const_string("</TR>\n")
     else :
-        table += StringToken("<TR><TD>")+out+StringToken("</TD></TR>")
-    table += StringToken("</TABLE>")
+        table += const_string("<TR><TD>")+out+const_string("</TD></TR>")
+    table += const_string("</TABLE>")
     print "table",table
     return MathPassThroughToken(table)
 environment_handlers["matrix"] = (begin_matrix_environment, end_matrix_environment)
@@ -233,8 +249,8 @@ environment_handlers["pmatrix"] = (begin_pmatrix_environment, end_pmatrix_enviro
 def math_frac_handler(stream, char_env, token_env, begin_stack) :
     num = parse_one(stream, char_env, token_env, begin_stack)
     denom = parse_one(stream, char_env, token_env, begin_stack)
-    table = StringToken('<TABLE CLASS="mathfrac"><TR CLASS="mathfracnum"><TD>')
-    table += num + StringToken("</TD></TR><TR><TD>") + denom + StringToken("</TD></TR></TABLE>")
+    table = const_string('<TABLE CLASS="mathfrac"><TR CLASS="mathfracnum"><TD>')
+    table += num + const_string("</TD></TR><TR><TD>") + denom + const_string("</TD></TR></TABLE>")
     return MathPassThroughToken(table)
 
 
@@ -242,19 +258,21 @@ def math_frac_handler(stream, char_env, token_env, begin_stack) :
 
 def render_math(math_tokens, env) :
 #    print "* render_math *",math_tokens
-    mts = math_tokens.eval(env)
+    return render_evaluated_math(math_tokens.eval(env), env)
+
+def render_evaluated_math(mts, env) :
 #    print "* render_math evaled *",mts
     if isinstance(mts, MathToken) :
         if type(mts) == MathBinToken :
             return mts.coerce_down().render(env)
         elif type(mts) == MathBraceStartToken or type(mts) == MathNoToken :
-            return StringToken("")
+            return const_string("")
         elif isinstance(mts, MathToken) :
             return mts.render(env)
         else :
             mts.fail("Non-math token "+repr(mts)+" found in math mode.")
     elif type(mts) is ListToken :
-        out = StringToken("")
+        out = const_string("")
         first = True
         for t in mts.tokens :
             if type(t) == MathBraceStartToken :
@@ -267,7 +285,7 @@ def render_math(math_tokens, env) :
                 out += t.render(env)
                 first = False
             elif type(t) == StringToken :
-                out += t #MathOrdToken(t.streamerr, t.s)
+                out += t #MathOrdToken(t.location, t.s)
             else :
                 mts.fail("Non-math token "+repr(t)+" found in math mode.")
 #        print "* rendered *",out
@@ -275,15 +293,38 @@ def render_math(math_tokens, env) :
     else :
         return mts
 
-class MathRenderToken(Token) :
+def pure_math(token) :
+    """Whether rendering token evaluates only strings and math tokens,
+    so can't have side effects or depend on the environment.  What a
+    math token holds (like the numerator of a \frac) could be
+    anything, such as a \ref."""
+    if type(token) is ListToken :
+        for t in token.tokens :
+            if not pure_math(t) :
+                return False
+        return True
+    elif isinstance(token, MathToken) :
+        for name in token.parts :
+            if not pure_math(getattr(token, name)) :
+                return False
+        return True
+    else :
+        return type(token) is StringToken
+
+class MathRenderToken(ThenToken) :
     """A token from which the math stuff can be retrieved, but when
     evaled does the rendering."""
+    __slots__ = ()
     def __init__(self, math) :
-        Token.__init__(self, None)
-        self.math = math
-    def eval(self, env) :
-#        print "math",self.math
-        return render_math(self.math, env).eval(env)
+        ThenToken.__init__(self, math)
+    @property
+    def math(self) :
+        return self.token
+    def then(self, mts, env) :
+        return render_evaluated_math(mts, env)
+    @property
+    def pure(self) :
+        return pure_math(self.token)
 
 # makes a handler for these tokens
 def make_render_math(math_tokens) :
@@ -304,45 +345,49 @@ def space_handler(stream, char_env, escape_env, begin_stack) :
 # but provide escaping spaces (this is global)
 @add_token_handler(token_handlers, " ") # normal space
 def space_handler(stream, char_env, escape_env, begin_stack) :
-    return StringToken(" ")
+    return const_string(" ")
 
 @add_token_handler(token_handlers, ",") # thin space
 @add_token_handler(token_handlers, "thinspace")
 def space_handler(stream, char_env, escape_env, begin_stack) :
-    return StringToken("&#8202;")
+    return const_string("&#8202;")
 
 @add_token_handler(token_handlers, ":")
 @add_token_handler(token_handlers, "midspace")
 def space_handler(stream, char_env, escape_env, begin_stack) :
-    return StringToken("&thinsp;")
+    return const_string("&thinsp;")
 
 @add_token_handler(token_handlers, "quad")
 def space_handler(stream, char_env, escape_env, begin_stack) :
-    return StringToken("&nbsp;&nbsp;&nbsp;&nbsp;") # <- maybe not the right way to do this?
+    return const_string("&nbsp;&nbsp;&nbsp;&nbsp;") # <- maybe not the right way to do this?
 
 ###
 ### Positioning
 ###
 
 class MathSupToken(MathToken) :
+    __slots__ = ("supscript_obj",)
+    parts = ("supscript_obj",)
     def __init__(self, obj) :
         MathToken.__init__(self, None)
-        self.streamerr = obj.streamerr
+        self.location = obj.location
         self.supscript_obj = obj
     def render(self, env) :
-        return (StringToken("<sup>")
+        return (const_string("<sup>")
                 +render_math(MathBraceStartToken(None)+self.supscript_obj, env)
-                +StringToken("</sup>"))
+                +const_string("</sup>"))
 
 class MathSubToken(MathToken) :
+    __slots__ = ("subscript_obj",)
+    parts = ("subscript_obj",)
     def __init__(self, obj) :
         MathToken.__init__(self, None)
-        self.streamerr = obj.streamerr
+        self.location = obj.location
         self.subscript_obj = obj
     def render(self, env) :
-        return (StringToken("<sub>")
+        return (const_string("<sub>")
                 +render_math(MathBraceStartToken(None)+self.subscript_obj, env)
-                +StringToken("</sub>"))
+                +const_string("</sub>"))
 
 @add_char_handler(math_char_env, "^")
 def sup_handler(stream, char_env, escape_env, begin_stack) :
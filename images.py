@@ -2,7 +2,9 @@
 
 from lazytokens import (StringToken, LambdaToken, ListToken, VariableToken, SelfEvaluatingToken)
 from parser import (make_handler, global_char_env, parse_one, parse_all, read_bracket_args)
-from environments import (CharacterEnvironment, add_char_handler, add_token_handler)
+from environments import (CharacterEnvironment, add_char_handler, add_token_handler, impure)
+import pagedeps
+import tracing
 import shutil
 import os.path
 import subprocess
@@ -14,8 +16,8 @@ environment_handlers = dict()
 
 # handles \includegraphics[width=xxx,height=xxx,ext=xxx,alt=xxx]{filename}.
 @add_token_handler(token_handlers, "includegraphics")
+@impure
 def includegraphics_handler(stream, char_env, token_env, begin_stack) :
-    poss_err = stream.failure()
     barg = read_bracket_args(stream, char_env, token_env, begin_stack)
     filename = parse_one(stream, char_env, token_env, begin_stack)
     
@@ -28,6 +30,7 @@ def includegraphics_handler(stream, char_env, token_env, begin_stack) :
 
         fn2 = os.path.abspath(os.path.join(token_env["_global_input_dir"], fn))
         outdir = os.path.abspath(os.path.join(token_env["_curr_out_dir"], os.path.split(fn)[0]))
+        pagedeps.record_file(fn2)
         args = [[x.strip() for x in y.split("=") if x.strip() != ""] for y in args.split(",")]
         args = [x for x in args if x != []]
 #        print args
@@ -68,10 +71,12 @@ def includegraphics_handler(stream, char_env, token_env, begin_stack) :
                 print "... already converted."
             else :
                 print ["convert", fn2, resize_arg, outfile]
-                retcode = subprocess.call(["convert", fn2+pagemod] + resize_arg + [outfile])
+                with tracing.span("convert "+fn, "image", file=fn2, output=outfile) :
+                    retcode = subprocess.call(["convert", fn2+pagemod] + resize_arg + [outfile])
                 if retcode != 0 :
                     raise Exception("Retcode was "+str(retcode))
                 print "... done"
+        pagedeps.record_output(outfile)
         relout = os.path.relpath(outfile, token_env["_curr_out_dir"])
         return StringToken("<IMG ALT=\""+altstring+"\""+dimstring+"SRC=\""+relout+"\">")
     return LambdaToken(_handler)
@@ -4,19 +4,21 @@
 
 import streams
 
+# Tokens use __slots__ since there are a great many of them.  Every
+# subclass must declare its own __slots__ (even if empty) or it gets a
+# __dict__ again.
 class Token(object) :
-    line = 0
-    streamname = "*unknown*"
+    __slots__ = ("location",)
     def __init__(self, stream=None) :
         if stream is not None :
-            self.streamerr = stream.failure() # save it for later
+            self.location = stream.location() # save it for later
         else :
-            self.streamerr = None
+            self.location = None
     def fail(self, message) :
-        if self.streamerr == None :
+        if self.location is None :
             raise Exception(message)
         else :
-            raise self.streamerr.with_message(message)
+            raise self.location.failure(message)
     def eval(self, env) :
         """Should return itself in simplified form.  The env variable
         is a dictionary which can be used by the tokens for
@@ -27,54 +29,195 @@ class Token(object) :
             return ListToken([self] + token2.tokens)
         else :
             return ListToken([self, token2])
+    def structure(self) :
+        """Returns something hashable which is equal for tokens of the
+        same type with equal contents, or None if the token holds
+        something which can't be compared that way (like a function).
+        Where the token is from is not part of it."""
+        parts = [type(self)]
+        for name in _slot_names(type(self)) :
+            value = _structure(getattr(self, name, None))
+            if value is None :
+                return None
+            parts.append(value)
+        return tuple(parts)
+
+_slot_names_memo = dict()
+
+def _slot_names(cls) :
+    try :
+        return _slot_names_memo[cls]
+    except KeyError :
+        names = []
+        for c in reversed(cls.__mro__) :
+            for name in c.__dict__.get("__slots__", ()) :
+                if name != "location" :
+                    names.append(name)
+        _slot_names_memo[cls] = names
+        return names
+
+_plain_types = (str, unicode, int, long, float, bool)
+
+def _structure(value) :
+    # like Token.structure, but for what a token's slots can hold.  None
+    # is a fine value to hold, so it is wrapped.
+    if value is None :
+        return (None,)
+    elif isinstance(value, Token) :
+        return value.structure()
+    elif isinstance(value, _plain_types) :
+        return value
+    elif isinstance(value, (list, tuple)) :
+        parts = []
+        for v in value :
+            s = _structure(v)
+            if s is None :
+                return None
+            parts.append(s)
+        return tuple(parts)
+    else :
+        return None
+
+def is_data(token) :
+    """Whether token is made only of tokens and plain values, and not
+    of functions or environments, so that it can be pickled and used
+    again in a later run."""
+    if hasattr(token, "__getstate__") :
+        # only what would be pickled matters
+        values = token.__getstate__().values()
+    else :
+        values = [getattr(token, name, None) for name in _slot_names(type(token))]
+    for value in values :
+        if not _is_data(value) :
+            return False
+    return True
+
+def _is_data(value) :
+    if value is None or isinstance(value, _plain_types) :
+        return True
+    elif isinstance(value, Token) :
+        return is_data(value)
+    elif isinstance(value, (list, tuple)) :
+        for v in value :
+            if not _is_data(v) :
+                return False
+        return True
+    else :
+        return False
 
 class SelfEvaluatingToken(Token) :
+    __slots__ = ()
     def eval(self, env) :
         return self
     def __eq__(self, other) :
         return type(self) == type(other)
 
+# Strings are kept as a list of pieces which is only joined when .s is
+# asked for.  Adding to a StringToken appends a piece in place when
+# the StringToken is the newest one made from its piece list, so
+# building a string with += is linear.  StringTokens are still
+# immutable: each one only looks at the first n pieces.  A plain
+# StringToken(s) never has its piece list appended to, so it can be
+# shared freely (see const_string).
 class StringToken(SelfEvaluatingToken) :
+    __slots__ = ("_pieces", "_n", "_s")
     def __init__(self, s) :
         SelfEvaluatingToken.__init__(self, None)
-        self.s = s
+        self._pieces = [s]
+        self._n = 1
+        self._s = s
+    @property
+    def s(self) :
+        if self._s is None :
+            self._s = "".join(self._pieces[:self._n])
+        return self._s
     def __add__(self, token2) :
         if type(token2) == StringToken :
-            return StringToken(self.s + token2.s)
-        elif type(token2) == ListToken and len(token2.tokens) > 0 and type(token2.tokens[0]) == StringToken :
-            return (self + token2.tokens[0]) + ListToken(token2.tokens[1:])
+            pieces = self._pieces
+            if self._n == 1 :
+                pieces = [self.s]
+            elif len(pieces) != self._n : # someone else already appended
+                pieces = pieces[:self._n]
+            pieces.append(token2.s)
+            new = StringToken.__new__(StringToken)
+            new.location = None
+            new._pieces = pieces
+            new._n = len(pieces)
+            new._s = None
+            return new
+        elif type(token2) == ListToken and token2._length() > 0 and type(token2._first()) == StringToken :
+            tokens = token2.tokens
+            return (self + tokens[0]) + ListToken(tokens[1:])
         else :
             return Token.__add__(self, token2)
+    def structure(self) :
+        return (StringToken, self.s)
+    def __getstate__(self) :
+        return {"s" : self.s}
+    def __setstate__(self, state) :
+        self.__init__(state["s"])
     def __repr__(self) :
         return "<StringToken name="+repr(self.s)+">"
     def __eq__(self, other) :
         return (type(other) == StringToken) and (self.s == other.s)
 
-class ParagraphToken(SelfEvaluatingToken) :
-    pass
+_const_strings = dict()
 
-class InhibitParagraphToken(SelfEvaluatingToken) :
-    pass
+def const_string(s) :
+    """Returns a shared StringToken for s.  For the fixed bits of markup
+    which handlers produce over and over, like "<P>" or "</TD>", and not
+    for text from the document, since each one is kept for good."""
+    try :
+        return _const_strings[s]
+    except KeyError :
+        t = StringToken(s)
+        _const_strings[s] = t
+        return t
 
-class EOFToken(SelfEvaluatingToken) :
-    pass
+# A token with no state, of which there only needs to be one.  Calling
+# the class returns the same instance every time.
+class MarkerToken(SelfEvaluatingToken) :
+    __slots__ = ()
+    def __new__(cls) :
+        instance = cls.__dict__.get("_instance")
+        if instance is None :
+            instance = SelfEvaluatingToken.__new__(cls)
+            instance.location = None
+            cls._instance = instance
+        return instance
+    def __init__(self) :
+        pass
+    def __repr__(self) :
+        return "<"+type(self).__name__+">"
+
+class ParagraphToken(MarkerToken) :
+    __slots__ = ()
+
+class InhibitParagraphToken(MarkerToken) :
+    __slots__ = ()
+
+class EOFToken(MarkerToken) :
+    __slots__ = ()
 
 class ItemToken(SelfEvaluatingToken) :
+    __slots__ = ("textlabel",)
     def __init__(self, stream, textlabel) :
         SelfEvaluatingToken.__init__(self, stream)
         self.textlabel = textlabel
 
-class ColumnBreakToken(SelfEvaluatingToken) :
-    pass
+class ColumnBreakToken(MarkerToken) :
+    __slots__ = ()
 
-class LineBreakToken(SelfEvaluatingToken) :
-    pass
+class LineBreakToken(MarkerToken) :
+    __slots__ = ()
 
-class HorizontalLineToken(SelfEvaluatingToken) :
-    pass
+class HorizontalLineToken(MarkerToken) :
+    __slots__ = ()
 
 class EndEnvToken(SelfEvaluatingToken) :
+    __slots__ = ("name",)
     def __init__(self, name) :
+        SelfEvaluatingToken.__init__(self, None)
         self.name = name
     def __eq__(self, other) :
         if type(other) == EndEnvToken :
@@ -85,50 +228,435 @@ class EndEnvToken(SelfEvaluatingToken) :
         return "<EndEnvToken name="+repr(self.name)+">"
 
 class VariableToken(Token) :
+    __slots__ = ("n",)
     def __init__(self, name) :
+        Token.__init__(self, None)
         self.n = name
     def eval(self, env) :
-        if env.has_key(self.n) :
+        value = self.eval_unforced(env)
+        if type(value) is Thunk :
+            return value.force()
+        return value
+    def eval_unforced(self, env) :
+        # what the variable is bound to, which may be a Thunk
+        try :
             return env[self.n]
+        except KeyError :
+            pass
+        if self.location is not None :
+            raise AttributeError(str(self.location.failure("No binding for "+repr(self.n)+".")))
         else :
-            raise AttributeError("Line "+str(self.line)+" in "+repr(self.streamname)+". No binding for "+repr(self.n)+".")
+            raise AttributeError("No binding for "+repr(self.n)+".")
+    def structure(self) :
+        return None # it depends on the environment
     def __repr__(self) :
         return "<VariableToken name="+repr(self.n)+">"
 
+def evaluates_to_itself(token) :
+    """Whether evaluating token just gives token back."""
+    return type(token).eval.im_func in _itself_evals
+
+_itself_evals = set([SelfEvaluatingToken.eval.im_func])
+
+def self_evaluating(cls) :
+    """Class decorator for a token class whose eval gives back the
+    token itself, for classes which can't be SelfEvaluatingTokens
+    (which are all equal to each other)."""
+    _itself_evals.add(cls.eval.im_func)
+    return cls
+
+# An argument of a macro call, which is evaluated in the environment of
+# the call the first time the macro asks for it, and not again.
+class Thunk(object) :
+    __slots__ = ("token", "env", "value")
+    def __init__(self, token, env) :
+        self.token = token
+        self.env = env
+        self.value = _unforced
+    def force(self) :
+        if self.value is _unforced :
+            self.value = evaluate(self.token, self.env)
+            self.env = None # nothing else needs it now
+        return self.value
+    def __repr__(self) :
+        return "<Thunk token="+repr(self.token)+">"
+
+_unforced = object()
+
 class LambdaToken(Token) :
-    def __init__(self, f) :
-        """f must be a lambda of one variable: the environment."""
+    __slots__ = ("f", "inputs")
+    def __init__(self, f, inputs=None) :
+        """f must be a lambda of one variable: the environment.  If f
+        has no side effects and only depends on some tokens (and not on
+        the environment), inputs can be a list of those tokens, so that
+        fold can evaluate it early."""
         Token.__init__(self, None)
         self.f = f
+        self.inputs = inputs
     def eval(self, env) :
-        return self.f(env).eval(env)
+        return evaluate(self, env)
 
+# A ListToken is the first n tokens of a buffer, plus a last token kept
+# outside the buffer.  The buffer may be shared with the ListTokens this
+# one was made from or added to, but only the first n entries are ever
+# looked at, and the buffer is only appended to in place when it has
+# exactly n entries, so ListTokens are still immutable while += on a
+# ListToken is amortized O(1).  Keeping the last token out of the buffer
+# lets adjacent StringTokens be merged without touching the buffer.
 class ListToken(Token) :
+    __slots__ = ("_buf", "_n", "_last")
     def __init__(self, tokens) :
         Token.__init__(self, None)
-        self.tokens = list(tokens)
-    def eval(self, env) :
-        evaled = reduce(lambda lst, e : lst + e, [e.eval(env) for e in self.tokens])
-        if type(evaled) == ListToken and len(evaled.tokens) == 1 :
-            return evaled.tokens[0]
+        tokens = list(tokens)
+        if tokens :
+            self._last = tokens.pop()
+        else :
+            self._last = None
+        self._buf = tokens
+        self._n = len(tokens)
+    @staticmethod
+    def _view(buf, n, last) :
+        new = ListToken.__new__(ListToken)
+        new.location = None
+        new._buf = buf
+        new._n = n
+        new._last = last
+        return new
+    @property
+    def tokens(self) :
+        if self._last is None :
+            return []
+        tokens = self._buf[:self._n]
+        tokens.append(self._last)
+        return tokens
+    def _length(self) :
+        if self._last is None :
+            return 0
+        return self._n + 1
+    def _first(self) :
+        if self._n > 0 :
+            return self._buf[0]
+        return self._last
+    def _appendable(self) :
+        # returns a buffer of the first n tokens and the last token which
+        # may be appended to
+        if len(self._buf) == self._n :
+            buf = self._buf
         else :
-            return evaled
+            buf = self._buf[:self._n]
+        buf.append(self._last)
+        return buf
+    def eval(self, env) :
+        return evaluate(self, env)
     def __add__(self, token2) :
-        if len(self.tokens) == 0 :
+        if self._last is None :
             return token2
         elif type(token2) == ListToken :
-            return ListToken(self.tokens + token2.tokens)
-        elif type(token2) == StringToken and len(self.tokens) > 0 and type(self.tokens[-1]) == StringToken :
-            return ListToken(self.tokens[:-1]) + (self.tokens[-1] + token2)
+            if token2._last is None :
+                return ListToken._view(self._buf, self._n, self._last)
+            buf = self._appendable()
+            buf.extend(token2._buf[:token2._n])
+            return ListToken._view(buf, len(buf), token2._last)
+        elif type(token2) == StringToken and type(self._last) == StringToken :
+            if self._n == 0 :
+                return self._last + token2
+            return ListToken._view(self._buf, self._n, self._last + token2)
         else :
-            return ListToken(self.tokens + [token2])
+            buf = self._appendable()
+            return ListToken._view(buf, len(buf), token2)
+    def structure(self) :
+        parts = [ListToken]
+        for t in self.tokens :
+            s = t.structure()
+            if s is None :
+                return None
+            parts.append(s)
+        return tuple(parts)
+    def __getstate__(self) :
+        return {"tokens" : self.tokens}
+    def __setstate__(self, state) :
+        self.__init__(state["tokens"])
     def __repr__(self) :
         return "<ListToken tokens="+repr(self.tokens)+">"
 
 class ArgumentToken(Token) :
+    __slots__ = ("token",)
     def __init__(self, token) :
+        Token.__init__(self, None)
         self.token = token
     def eval(self, env) :
-        return ArgumentToken(self.token.eval(env))
+        return evaluate(self, env)
     def __repr__(self) :
         return "<ArgumentToken token="+repr(self.token)+">"
+
+# A token which is evaluated in its own environment rather than the
+# one it is evaluated in.  For macros, which evaluate their body in an
+# environment extended by their arguments.
+class BoundToken(Token) :
+    __slots__ = ("token", "env")
+    def __init__(self, token, env) :
+        Token.__init__(self, None)
+        self.token = token
+        self.env = env
+    def eval(self, env) :
+        return evaluate(self, env)
+    def __repr__(self) :
+        return "<BoundToken token="+repr(self.token)+">"
+
+# A token which evaluates to value as it is, for handing back something
+# which has already been evaluated.
+class ValueToken(Token) :
+    __slots__ = ("value",)
+    def __init__(self, value) :
+        Token.__init__(self, None)
+        self.value = value
+    def eval(self, env) :
+        return self.value
+    def __repr__(self) :
+        return "<ValueToken value="+repr(self.value)+">"
+
+# A token which evaluates token, then hands the result to then(value,
+# env), and evaluates what that returns.  This lets a handler work on
+# an evaluated subtree without calling eval itself, so the evaluation
+# stays on the stack in evaluate.  If evaluate_then is False, what then
+# returns is the value, and is not evaluated again.  Subclasses whose
+# then has no side effects and doesn't use env can set pure, so that
+# fold can evaluate them early.
+class ThenToken(Token) :
+    __slots__ = ("token", "f")
+    evaluate_then = True
+    pure = False
+    def __init__(self, token, f=None) :
+        Token.__init__(self, None)
+        self.token = token
+        self.f = f
+    def then(self, value, env) :
+        return self.f(value, env)
+    def eval(self, env) :
+        return evaluate(self, env)
+
+def _list_result(out) :
+    if not out :
+        return ListToken([])
+    elif len(out) == 1 :
+        return out[0]
+    last = out.pop()
+    return ListToken._view(out, len(out), last)
+
+def evaluate(token, env) :
+    """Evaluates token in env.  This is what eval does for the tokens
+    which contain other tokens, but rather than recursing it keeps
+    ListTokens, ArgumentTokens, BoundTokens and ThenTokens which are
+    part way through on a stack, and follows what LambdaTokens return
+    in a loop.  So evaluation is only as deep as memory allows."""
+    # A ListToken part way through is a list [tokens, next index, out,
+    # single, env] on the stack.  Its evaluated tokens are added up into
+    # out, which is the same as adding them left to right with +, but
+    # into a single list.  single is whether the sum so far is out[0]
+    # itself rather than a ListToken of out.  Anything else on the
+    # stack is a tuple (owner, env), where owner is a ThenToken, a Thunk
+    # being forced, or None for an ArgumentToken.
+    stack = []
+    t = token
+    while True :
+        # go down to a token which evaluates to a value by itself
+        tt = type(t)
+        if tt is StringToken :
+            value = t
+        elif tt is LambdaToken :
+            t = t.f(env)
+            continue
+        elif tt is ListToken :
+            if t._last is not None :
+                tokens = t.tokens
+                stack.append([tokens, 1, [], False, env])
+                t = tokens[0]
+                continue
+            value = ListToken([])
+        elif tt is ArgumentToken :
+            stack.append((None, env))
+            t = t.token
+            continue
+        elif tt is BoundToken :
+            env = t.env
+            t = t.token
+            continue
+        elif tt is VariableToken :
+            value = t.eval_unforced(env)
+            if type(value) is Thunk :
+                if value.value is _unforced :
+                    stack.append((value, env))
+                    env = value.env
+                    t = value.token
+                    continue
+                value = value.value
+        elif isinstance(t, ThenToken) :
+            stack.append((t, env))
+            t = t.token
+            continue
+        else :
+            value = t.eval(env)
+        # and back up until there is another token to go down to
+        while stack :
+            frame = stack[-1]
+            if type(frame) is not list :
+                stack.pop()
+                owner, env = frame
+                if owner is None :
+                    value = ArgumentToken(value)
+                    continue
+                if type(owner) is Thunk :
+                    owner.value = value
+                    owner.env = None
+                    continue
+                if not owner.evaluate_then :
+                    value = owner.then(value, env)
+                    continue
+                t = owner.then(value, env)
+                break
+            tokens, i, out, single, env = frame
+            down = False
+            while True :
+                # add value to the sum so far
+                te = type(value)
+                if single :
+                    a = out[0]
+                    if type(a) == StringToken and te == StringToken :
+                        out[0] = a + value
+                    else :
+                        single = False
+                        if te == ListToken :
+                            etokens = value.tokens
+                            j = 0
+                            if type(a) == StringToken :
+                                while j < len(etokens) and type(etokens[j]) == StringToken :
+                                    a = a + etokens[j]
+                                    j += 1
+                                out[0] = a
+                            out.extend(etokens[j:])
+                        else :
+                            out.append(value)
+                elif not out :
+                    if te == ListToken :
+                        out = value.tokens
+                    else :
+                        out.append(value)
+                        single = True
+                elif te == ListToken :
+                    out.extend(value.tokens)
+                elif te == StringToken and type(out[-1]) == StringToken :
+                    out[-1] = out[-1] + value
+                    single = len(out) == 1
+                else :
+                    out.append(value)
+                if i == len(tokens) :
+                    break
+                # tokens which need the stack are gone down to, and the
+                # rest are evaluated right here
+                t = tokens[i]
+                i += 1
+                while type(t) is LambdaToken :
+                    t = t.f(env)
+                tt = type(t)
+                if tt is StringToken :
+                    value = t
+                elif tt is VariableToken :
+                    value = t.eval_unforced(env)
+                    if type(value) is Thunk :
+                        if value.value is _unforced :
+                            down = True
+                            break
+                        value = value.value
+                elif tt in _stacked_types or isinstance(t, ThenToken) :
+                    down = True
+                    break
+                else :
+                    value = t.eval(env)
+            if down :
+                frame[1] = i
+                frame[2] = out
+                frame[3] = single
+                break
+            stack.pop()
+            value = _list_result(out)
+        else :
+            return value
+
+_stacked_types = frozenset([ListToken, ArgumentToken, BoundToken])
+
+###
+### Partial evaluation
+###
+
+# Parsed trees which are evaluated many times (macro bodies, the page
+# template) are folded once first: every part which neither depends on
+# the environment nor has side effects is evaluated then and there.
+# Only LambdaTokens with inputs and pure ThenTokens are known to be
+# like that; other LambdaTokens, VariableTokens and anything which
+# fails to evaluate are left for later.
+
+_fold_counts = {"visited" : 0, "folded" : 0}
+
+def fold_statistics() :
+    """Returns a dict of how many tokens fold has looked at (visited)
+    and how many it replaced with their values (folded)."""
+    return dict(_fold_counts)
+
+def is_static(token) :
+    """Whether token is already a value: evaluating it would give
+    something equal to it."""
+    if type(token) is ListToken :
+        # evaluating merges adjacent strings and unwraps a list of one
+        tokens = token.tokens
+        if len(tokens) == 1 :
+            return False
+        string_before = False
+        for t in tokens :
+            is_string = type(t) is StringToken
+            if (is_string and string_before) or not evaluates_to_itself(t) :
+                return False
+            string_before = is_string
+        return True
+    return evaluates_to_itself(token)
+
+def fold(token) :
+    """Returns a token which evaluates the same as token, with what
+    could be evaluated early already evaluated."""
+    _fold_counts["visited"] += 1
+    tt = type(token)
+    if tt is StringToken or evaluates_to_itself(token) :
+        return token
+    elif tt is ListToken :
+        # Only a whole list can be replaced by its value.  Putting the
+        # value of a run of its tokens in their place would be wrong,
+        # since adding ListTokens doesn't merge the strings where they
+        # meet but adding the tokens one at a time does.
+        tokens = [fold(t) for t in token.tokens]
+        folded = ListToken(tokens)
+        for t in tokens :
+            if not is_static(t) :
+                return folded
+        return _fold_value(token, folded)
+    elif tt is ArgumentToken :
+        return ArgumentToken(fold(token.token))
+    elif tt is LambdaToken and token.inputs is not None :
+        for t in token.inputs :
+            if not is_static(fold(t)) :
+                return token
+        return _fold_value(token, token)
+    elif isinstance(token, ThenToken) and token.pure and is_static(fold(token.token)) :
+        return _fold_value(token, token)
+    else :
+        return token
+
+def _fold_value(token, evaluable) :
+    # evaluates evaluable, which evaluates the same as token, and
+    # returns the value if it is static, or else evaluable
+    try :
+        value = evaluate(evaluable, {})
+    except Exception :
+        return evaluable # so the error comes when it would have
+    if not is_static(value) :
+        return evaluable
+    _fold_counts["folded"] += 1
+    return value
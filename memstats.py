@@ -0,0 +1,164 @@
+# memstats.py
+#
+# counts what is held in memory while each page is written, for
+# runhm.py --memstats: the live tokens by class, the bytes of the
+# strings the StringTokens hold, the footnotes of the page, how deep
+# its TokenEnvironment is, and the RSS of the process before and after
+# writing it.  Once end_page_environment has returned, nothing should
+# refer to the tokens of a page any more; those pages which still are
+# are pointed out, along with what refers to them.
+
+import gc
+import sys
+import json
+import resource
+
+from lazytokens import (Token, StringToken, ListToken, LambdaToken)
+
+# whether pages are measured (runhm.py --memstats)
+enabled = False
+
+# What was measured of one page.
+class PageStats(object) :
+    def __init__(self, path) :
+        self.path = path
+        self.tokens = dict()
+        self.string_bytes = 0
+        self.footnotes = 0
+        self.environment_depth = 0
+        self.rss_before = None
+        self.rss_after = None
+        # the types of what still referred to the page's tokens, if
+        # anything did
+        self.held_by = None
+    def as_dict(self) :
+        return {"path" : self.path,
+                "tokens" : self.tokens,
+                "string_bytes" : self.string_bytes,
+                "footnotes" : self.footnotes,
+                "environment_depth" : self.environment_depth,
+                "rss_before_kb" : self.rss_before,
+                "rss_after_kb" : self.rss_after,
+                "held_by" : self.held_by}
+
+_pages = []
+
+# the tokens of the pages whose end_page_environment has returned,
+# with their PageStats, until check looks at them
+_ended = []
+
+def _rss(field="VmRSS") :
+    # the resident set size in kB (or its peak, VmHWM), or the peak one
+    # where /proc isn't
+    try :
+        f = open("/proc/self/status")
+        try :
+            for line in f :
+                if line.startswith(field + ":") :
+                    return int(line.split()[1])
+        finally :
+            f.close()
+    except IOError :
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _kind(token) :
+    if type(token).__module__ == "hmath" :
+        return "math"
+    for cls in (StringToken, ListToken, LambdaToken) :
+        if type(token) == cls :
+            return cls.__name__
+    return "other"
+
+def _count_tokens(stats) :
+    strings = dict()
+    for o in gc.get_objects() :
+        if isinstance(o, Token) :
+            kind = _kind(o)
+            stats.tokens[kind] = stats.tokens.get(kind, 0) + 1
+            if type(o) == StringToken :
+                # pieces are shared between StringTokens, so each string
+                # is only counted once
+                for s in [o._s] + o._pieces :
+                    if s is not None :
+                        strings[id(s)] = len(s)
+    stats.string_bytes = sum(strings.itervalues())
+
+def _environment_depth(env) :
+    depth = 0
+    while env is not None :
+        depth += 1
+        env = env.parent
+    return depth
+
+class page(object) :
+    """Measures the writing of the page in token_env, in a with
+    block."""
+    def __init__(self, token_env) :
+        self.token_env = token_env
+    def __enter__(self) :
+        if enabled :
+            check()
+            self.stats = PageStats(self.token_env["_page_path"])
+            self.stats.environment_depth = _environment_depth(self.token_env)
+            _count_tokens(self.stats)
+            self.stats.rss_before = _rss()
+            _pages.append(self.stats)
+    def __exit__(self, type, value, traceback) :
+        if enabled :
+            self.stats.rss_after = _rss()
+            self.stats.footnotes = len(self.token_env["_page_footnotes"])
+
+def page_ended(token_env, tokens) :
+    """Called when end_page_environment is done with the tokens of the
+    page in token_env, so that check can tell whether they are let go."""
+    if enabled :
+        path = token_env["_page_path"]
+        for stats in reversed(_pages) :
+            if stats.path == path :
+                break
+        else :
+            # the page wasn't written (--incremental)
+            stats = PageStats(path)
+            _pages.append(stats)
+        _ended.append((stats, tokens))
+
+def check() :
+    """Points out the pages whose tokens something still refers to."""
+    if not _ended :
+        return
+    gc.collect()
+    ended = list(_ended)
+    del _ended[:]
+    # what refers to the tokens here doesn't count
+    ours = set(id(e) for e in ended)
+    ours.add(id(sys._getframe()))
+    for (stats, tokens) in ended :
+        referrers = [r for r in gc.get_referrers(tokens) if id(r) not in ours]
+        if referrers :
+            stats.held_by = sorted(set(type(r).__name__ for r in referrers))
+        del referrers
+
+def report(filename) :
+    """Prints a table of the pages, and saves it in filename as
+    JSON."""
+    check()
+    kinds = ["StringToken", "ListToken", "LambdaToken", "math", "other"]
+    print "\n%-32s %s %12s %9s %6s %10s %10s  %s" % ("page", " ".join("%11s" % k for k in kinds), "string bytes",
+                                                      "footnotes", "depth", "RSS kB", "after kB", "still held by")
+    for s in _pages :
+        if s.rss_before is None :
+            print ("%-32s %-129s  %s" % (s.path[-32:], "(not written)", ", ".join(s.held_by or []))).rstrip()
+        else :
+            print "%-32s %s %12d %9d %6d %10d %10d  %s" % (s.path[-32:], " ".join("%11d" % s.tokens.get(k, 0) for k in kinds),
+                                                           s.string_bytes, s.footnotes, s.environment_depth,
+                                                           s.rss_before, s.rss_after, ", ".join(s.held_by or []))
+    held = [s for s in _pages if s.held_by]
+    if held :
+        print "%d pages still had their tokens referred to after end_page_environment" % len(held)
+    print "Peak RSS %dkB; saved in %s" % (_rss("VmHWM"), filename)
+    f = open(filename, "w")
+    try :
+        json.dump({"pages" : [s.as_dict() for s in _pages]}, f, indent=1)
+    finally :
+        f.close()
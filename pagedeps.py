@@ -0,0 +1,222 @@
+# pagedeps.py
+#
+# keeps track of what each page depended on when it was written, so
+# that an incremental build can leave alone the pages for which none
+# of that has changed.
+
+import os
+import hashlib
+import cPickle as pickle
+
+import pagepool
+
+# whether pages are only written when what they depend on has changed
+# (runhm.py --incremental)
+enabled = False
+
+# What a page depends on comes in three kinds:
+#  - inputs, known before the page is evaluated: the digests of its
+#    source text, of each macro it calls, of the page template and
+#    stylesheet, and its page number and breadcrumbs.
+#  - references, found while it is evaluated: what each label it
+#    refers to looked like, and likewise for each anchor it put in
+#    (which are looked up by id).
+#  - files, also found while it is evaluated: the size and modification
+#    time of each file it includes or copies.
+# Along with those, it keeps the references it made (so that they can
+# be made again when the page is skipped), the files it copied into the
+# output directory and a digest of what was written, so that a page
+# whose output was changed or removed is written again.
+class PageDependencies(object) :
+    def __init__(self, path, inputs) :
+        self.path = path
+        self.inputs = inputs
+        self.references = dict()
+        self.anchors = dict()
+        self.files = dict()
+        self.labels = []
+        self.outputs = set()
+        self.output = None
+    def __repr__(self) :
+        return "<PageDependencies "+repr(self.path)+">"
+
+# the page being evaluated, which what is found is recorded into
+current = None
+
+def record_reference(name, ref) :
+    """Records that the current page looked up the label name and got
+    ref (None if there was no such label)."""
+    if current is not None and name not in current.references :
+        current.references[name] = reference_fingerprint(ref)
+
+def record_anchor(id, ref) :
+    """Likewise, for the anchor of what has the given id."""
+    if current is not None and id not in current.anchors :
+        current.anchors[id] = reference_fingerprint(ref)
+
+def record_file(filename) :
+    if current is not None :
+        current.files[filename] = file_stamp(filename)
+    else :
+        record_read(filename)
+
+# the files read outside of any page, like the page template, the
+# stylesheet and those included between pages
+_read = set()
+
+def record_read(filename) :
+    """Records that the build read filename, for runhm.py --watch,
+    without the current page depending on it."""
+    if enabled :
+        _read.add(filename)
+
+def files_read() :
+    """Returns the files read in this run: those the pages depend on,
+    and those read outside of any page."""
+    files = set(_read)
+    for deps in _pages.itervalues() :
+        files.update(deps.files)
+    return files
+
+def record_output(filename) :
+    if current is not None :
+        current.outputs.add(filename)
+
+def record_label(lr) :
+    if current is not None :
+        current.labels.append(lr)
+
+def reference_fingerprint(ref) :
+    """What a reference to ref depends on, or None if it can't be told
+    (the autoname is something which can't be compared)."""
+    if ref is None :
+        return ("missing",)
+    autoname = ref.autoname
+    if not isinstance(autoname, basestring) :
+        autoname = autoname.structure()
+        if autoname is None :
+            return None
+    return (ref.dir, ref.filename, ref.anchor, autoname)
+
+def file_stamp(filename) :
+    try :
+        st = os.stat(filename)
+    except OSError :
+        return None
+    return (st.st_size, st.st_mtime)
+
+def file_digest(filename) :
+    try :
+        f = open(filename, "rb")
+    except IOError :
+        return None
+    try :
+        return hashlib.sha1(f.read()).hexdigest()
+    finally :
+        f.close()
+
+def digest(text, handlers=()) :
+    """Returns a digest of text along with those of the macros among
+    handlers (which were used parsing it), or None if text is None or
+    one of those macros has no digest."""
+    if text is None :
+        return None
+    h = hashlib.sha1(text)
+    for name, d in sorted(macro_digests(handlers).iteritems()) :
+        if d is None :
+            return None
+        h.update("\0" + name + "\0" + d)
+    return h.hexdigest()
+
+def macro_digests(handlers) :
+    """Returns a dict of the name of each macro among handlers to its
+    digest."""
+    return dict((h.name, h.digest) for h in handlers if hasattr(h, "digest"))
+
+###
+### The pages written in the last run, and in this one
+###
+
+_database_outdir = None
+_last_pages = dict()
+_pages = dict()
+
+def load_database(filename, outdir) :
+    """Reads what the pages written into outdir depended on in the last
+    run, which was saved in filename."""
+    global _database_outdir, _last_pages
+    _database_outdir = os.path.abspath(outdir)
+    _last_pages = dict()
+    _pages.clear()
+    if os.path.isfile(filename) :
+        f = open(filename, "rb")
+        try :
+            (last_outdir, pages) = pickle.load(f)
+        finally :
+            f.close()
+        if last_outdir == _database_outdir :
+            _last_pages = pages
+
+def reset() :
+    """Forgets the pages of the last run."""
+    global current, _last_pages
+    current = None
+    _last_pages = dict()
+    _pages.clear()
+    _read.clear()
+
+def save_database(filename) :
+    f = open(filename, "wb")
+    try :
+        pickle.dump((_database_outdir, _pages), f, pickle.HIGHEST_PROTOCOL)
+    finally :
+        f.close()
+
+def unchanged(deps, lookup_reference, lookup_anchor, made) :
+    """Returns (last, reason, waiting).  last is what the page deps.path
+    depended on when it was last written if none of it has changed
+    since, and otherwise None, with reason saying what changed.
+    lookup_reference(name) and lookup_anchor(id) give what a label and
+    an anchor now refer to, and made(name) whether the label name has
+    been made yet in this run.  Labels which haven't been can't be
+    compared until every page has been parsed, so those the page
+    referred to are given in waiting, for recheck."""
+    last = _last_pages.get(deps.path)
+    if last is None :
+        return (None, "it wasn't written before", [])
+    for name in sorted(set(deps.inputs) | set(last.inputs)) :
+        new = deps.inputs.get(name)
+        if new is None or new != last.inputs.get(name) :
+            return (None, "its "+name+" changed", [])
+    waiting = []
+    for name, fingerprint in sorted(last.references.iteritems()) :
+        if fingerprint is not None and not made(name) :
+            waiting.append(name)
+        elif fingerprint is None or fingerprint != reference_fingerprint(lookup_reference(name)) :
+            return (None, "label "+repr(name)+" changed", [])
+    for id, fingerprint in sorted(last.anchors.iteritems()) :
+        if fingerprint is None or fingerprint != reference_fingerprint(lookup_anchor(id)) :
+            return (None, "anchor "+repr(id)+" changed", [])
+    for filename, stamp in sorted(last.files.iteritems()) :
+        if stamp is None or stamp != file_stamp(filename) :
+            return (None, "file "+repr(filename)+" changed", [])
+    for filename in sorted(last.outputs) :
+        if not os.path.isfile(filename) :
+            return (None, "file "+repr(filename)+" is missing", [])
+    if last.output is None or last.output != file_digest(deps.path) :
+        return (None, "its output file changed or is missing", [])
+    return (last, "nothing it depends on changed", waiting)
+
+def recheck(last, waiting, lookup_reference) :
+    """Once every label has been made, returns why the page of last
+    must be written after all if one of the labels in waiting has
+    changed, and otherwise None."""
+    for name in waiting :
+        if last.references[name] != reference_fingerprint(lookup_reference(name)) :
+            return "label "+repr(name)+" changed"
+    return None
+
+def keep(deps) :
+    """Remembers deps as what its page depends on in this run."""
+    _pages[deps.path] = deps
+    pagepool.effect(keep, deps)
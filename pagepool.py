@@ -0,0 +1,221 @@
+# pagepool.py
+#
+# evaluates and writes pages in other processes (runhm.py -j), while
+# the main process goes on parsing the rest of the input.
+
+import sys
+import traceback
+import multiprocessing
+import StringIO
+import cPickle as pickle
+
+import environments
+
+# how many processes may be writing pages at once.  With 1, pages are
+# written where their \end{page} is, as before.
+jobs = 1
+
+# how many pages each process writes.  Forking costs about as much as
+# writing a small page, so pages are handed out a few at a time.
+pages_per_process = 8
+
+# Tokens hold closures, so a page can't be sent to a worker.  Instead,
+# pages are written by processes forked from the main one, which start
+# out with everything it knew.  Since the main process has gone on
+# parsing since a page's \end{page}, what the page is written with is
+# saved there and put back before the page is written: the bindings of
+# its environment, and things like counters by the functions given to
+# keep_state.
+#
+# What writing a page does which the main process needs to know about
+# is sent back, and done again there, a page at a time in the order
+# the pages came in:
+#  - effects: calls like references.add_reference, recorded by effect.
+#  - lookups: what each call like references.find_reference returned,
+#    recorded by lookup.  A page written while pages before it were
+#    still being written didn't see their labels, so if one of its
+#    lookups now comes out differently, the page is written again in
+#    the main process, just as it would have been without -j.
+#  - what it printed.
+# So the pages, and the references saved for the next run, are the
+# same as without -j.
+
+# the pages waiting for a process, as (write, token_env, bindings,
+# state)
+_waiting = []
+
+# the processes writing pages, oldest first, as (pages, process,
+# reader)
+_pending = []
+
+# (save, restore) pairs of functions, from keep_state
+_states = []
+
+# what the page being written in this process has done, if this is a
+# forked process
+_effects = None
+_lookups = None
+
+# whether the results of pages are being taken in, which is when
+# effects are done again
+_settling = False
+
+def effect(f, *args) :
+    """Records that f(*args) was done, so that it is done again in the
+    main process.  f must be a function at the top level of a module."""
+    if _effects is not None :
+        _effects.append((f, args))
+
+def differs(then, now) :
+    # not !=, since some classes only have __eq__
+    return not (then == now)
+
+def lookup(f, arg, value, changed=differs) :
+    """Records that f(arg) returned value.  The page is written again
+    if changed(value, f(arg)) when the main process takes it in.
+    changed must be a function at the top level of a module."""
+    if _lookups is not None :
+        _lookups.append((f, arg, value, changed))
+
+def keep_state(save, restore) :
+    """Has save() called at the end of each page which is written
+    later, and restore(what save returned) called before it is
+    written."""
+    _states.append((save, restore))
+
+def _save_state() :
+    return [save() for (save, restore) in _states]
+
+def _restore_state(state) :
+    for ((save, restore), s) in zip(_states, state) :
+        restore(s)
+
+def render(write, token_env) :
+    """Calls write(), which evaluates and writes a page in token_env,
+    either now or in another process."""
+    if jobs <= 1 or _effects is not None :
+        write()
+        return
+    _waiting.append(keep_for_later(write, token_env))
+    if len(_waiting) >= pages_per_process :
+        _start()
+
+def settle() :
+    """Waits for every page being written and takes in what was done.
+    References and such in the main process are only up to date after
+    this."""
+    if _settling :
+        return
+    if _waiting :
+        _start()
+    while _pending :
+        _take_oldest()
+
+def reset() :
+    """Throws away the pages of a run which failed, so that the next
+    run doesn't take them in."""
+    global _waiting, _settling
+    _waiting = []
+    while _pending :
+        (pages, process, reader) = _pending.pop(0)
+        reader.close()
+        process.join()
+    _settling = False
+
+def _start() :
+    global _waiting
+    while len(_pending) >= jobs :
+        _take_oldest()
+    pages = _waiting
+    _waiting = []
+    sys.stdout.flush() # or the new process would print it again
+    (reader, writer) = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_child, args=(pages, writer))
+    process.start()
+    writer.close()
+    _pending.append((pages, process, reader))
+
+def _take_oldest() :
+    global _settling
+    (pages, process, reader) = _pending.pop(0)
+    try :
+        results = pickle.loads(reader.recv_bytes())
+    except EOFError :
+        results = []
+    reader.close()
+    process.join()
+    _settling = True
+    try :
+        for (i, page) in enumerate(pages) :
+            if i >= len(results) or _stale(results[i]["lookups"]) :
+                write_later(page)
+                continue
+            result = results[i]
+            sys.stdout.write(result["output"])
+            if result["error"] is not None :
+                raise result["error"]
+            for (f, args) in result["effects"] :
+                f(*args)
+    finally :
+        _settling = False
+
+def _stale(lookups) :
+    for (f, arg, value, changed) in lookups :
+        if changed(value, f(arg)) :
+            return True
+    return False
+
+def keep_for_later(write, token_env) :
+    """Returns what write_later needs to call write() as if it were
+    called now."""
+    return (write, token_env, token_env.snapshot(), _save_state())
+
+def in_other_process() :
+    """Whether this is a process writing pages for the main one."""
+    return _effects is not None
+
+def write_later(page) :
+    """Calls the write of what keep_for_later returned, in this
+    process, with everything as it was then."""
+    (write, token_env, bindings, state) = page
+    now = (token_env.snapshot(), _save_state())
+    environments.restore_snapshot(bindings)
+    _restore_state(state)
+    try :
+        write()
+    finally :
+        environments.restore_snapshot(now[0])
+        _restore_state(now[1])
+
+def _child(pages, writer) :
+    # Writes pages, sending back a list of what each did.  The list
+    # stops short at a page which failed, or whose results can't be
+    # pickled, and then the main process writes the rest itself.
+    global _effects, _lookups, _pending, _waiting
+    _pending = []
+    _waiting = []
+    results = []
+    for (write, token_env, bindings, state) in pages :
+        environments.restore_snapshot(bindings)
+        _restore_state(state)
+        _effects = []
+        _lookups = []
+        output = StringIO.StringIO()
+        sys.stdout = output
+        error = None
+        try :
+            write()
+        except Exception, e :
+            error = e
+            output.write(traceback.format_exc())
+        result = {"output" : output.getvalue(), "error" : error,
+                  "effects" : _effects, "lookups" : _lookups}
+        try :
+            pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except Exception :
+            break
+        results.append(result)
+        if error is not None :
+            break
+    writer.send_bytes(pickle.dumps(results, pickle.HIGHEST_PROTOCOL))
+    writer.close()
@@ -0,0 +1,322 @@
+# parsecache.py
+#
+# saves what parsing a file did, so that a later run can replay it
+# rather than read the file character by character again.
+
+import os
+import sys
+import hashlib
+import tempfile
+import cPickle as pickle
+
+import streams
+import lazytokens
+import parser
+
+# A parsed file can't be saved as its tokens, since handlers make
+# LambdaTokens holding closures.  What is saved instead is a tape of
+# what the parse did, one list of events per call of parse_one:
+#
+#   (method, value)          what a stream method (read, peek,
+#                            read_while, read_while_not, read_while_p,
+#                            tell) returned
+#   ("location", location)   what stream.location() returned
+#   ("token", token, names)  a call of parse_one which only used
+#                            handlers without side effects and whose
+#                            result is data (see lazytokens.is_data),
+#                            along with the \var names it used
+#   ("call", char, events)   a call of parse_one which ran the handler
+#                            for char, where events are what that
+#                            handler did.  Which escape token it was is
+#                            in events, as what was read after the
+#                            backslash.
+#
+# Replaying a tape runs the handlers of the "call" events again, in
+# the same order and in the same environments, handing them what they
+# read the first time, and puts the saved tokens of the "token" events
+# in place without running anything.  So side effects at parse time
+# (like \begin{page} writing out its page) still happen, and
+# evaluating what was parsed is done as before.
+#
+# A tape is only good for the file it was made from, in the handlers
+# it was made with, so entries are keyed by the file's name and
+# contents, the character and escape handlers in place (by name, and
+# by the number of arguments for macros), and the source of the
+# modules defining those handlers.  Macros a file gets from the files
+# it includes aren't in place yet when it starts, so each entry also
+# lists the files parsed while it was being parsed, and is thrown away
+# if any of them has changed.
+
+_version = 2
+
+_cache_counts = {"hits" : 0, "misses" : 0, "stale" : 0}
+
+def parse_cache_statistics() :
+    """Returns a dict of how the parse cache has done: hits, misses (no
+    entry), stale (an entry for which an included file had changed)."""
+    return dict(_cache_counts)
+
+# the dependency lists of the files being recorded, outermost first
+_recording = []
+
+def parse_file(directory, filename, char_env, escape_env, execute) :
+    """Parses the file filename like parser.parse_all, replaying the
+    entry for it in directory if there is a good one, and otherwise
+    parsing it and saving an entry."""
+    filename = os.path.abspath(filename)
+    f = open(filename, "rb")
+    text = f.read()
+    f.close()
+    digest = hashlib.sha1(text).hexdigest()
+    for deps in _recording :
+        deps.append((filename, digest))
+    path = os.path.join(directory, entry_key(filename, digest, char_env, escape_env, execute) + ".parse")
+    entry = _load_entry(path)
+    if entry is not None :
+        if _dependencies_current(entry["deps"]) :
+            _cache_counts["hits"] += 1
+            for deps in _recording :
+                deps.extend(entry["deps"])
+            stream = ReplayStream(filename, entry["tape"], text)
+            return parser.parse_all(stream, char_env, escape_env, [], execute)
+        _cache_counts["stale"] += 1
+    else :
+        _cache_counts["misses"] += 1
+    inner = streams.StringStream(text)
+    inner.name = filename
+    stream = RecordingStream(inner)
+    deps = []
+    _recording.append(deps)
+    try :
+        out = parser.parse_all(stream, char_env, escape_env, [], execute)
+    finally :
+        _recording.pop()
+    _save_entry(directory, path, {"filename" : filename, "deps" : deps, "tape" : stream.tape})
+    return out
+
+def entry_key(filename, digest, char_env, escape_env, execute) :
+    """Returns the name of the cache entry for parsing the file filename,
+    whose contents have the given digest, in these environments."""
+    handlers = _handler_names(char_env, escape_env)
+    modules = set(m for (name, (m, h)) in handlers if m is not None)
+    key = (_version, filename, digest, execute, handlers, _code_digest(modules))
+    return hashlib.sha1(repr(key)).hexdigest()
+
+def _handler_names(char_env, escape_env) :
+    # the handlers in char_env and escape_env as sorted (name, handler
+    # id) pairs
+    bindings = dict()
+    env = escape_env
+    while env is not None :
+        for name, value in env.bindings.iteritems() :
+            if name not in bindings :
+                bindings[name] = value
+        env = env.parent
+    handlers = [("\\" + name, _handler_id(value)) for name, value in bindings.iteritems() if callable(value)]
+    handlers.extend((c, _handler_id(h)) for c, h in char_env.flat_bindings().iteritems())
+    env = char_env
+    while env.parent is not None :
+        env = env.parent
+    handlers.append((None, _handler_id(env.handler)))
+    handlers.extend(("begin " + name, _handler_id(h[0])) for name, h in parser.environment_handlers.iteritems())
+    handlers.sort()
+    return tuple(handlers)
+
+def _handler_id(handler) :
+    # what a handler is across runs.  For a macro, only how many
+    # arguments it takes matters to the parse.
+    arguments = getattr(handler, "arguments", None)
+    if arguments is not None :
+        return (None, arguments)
+    return (getattr(handler, "__module__", None), getattr(handler, "__name__", None))
+
+_code_digests = dict()
+
+def _code_digest(modules) :
+    # a digest of the source of modules, along with this module and
+    # those the parser itself is made of
+    modules = frozenset(modules) | frozenset(["streams", "environments", "lazytokens", "parser", __name__])
+    try :
+        return _code_digests[modules]
+    except KeyError :
+        pass
+    h = hashlib.sha1()
+    for name in sorted(modules) :
+        module = sys.modules.get(name)
+        filename = getattr(module, "__file__", None)
+        if filename is None :
+            continue
+        if filename.endswith((".pyc", ".pyo")) and os.path.isfile(filename[:-1]) :
+            filename = filename[:-1]
+        f = open(filename, "rb")
+        h.update(name)
+        h.update(f.read())
+        f.close()
+    _code_digests[modules] = h.hexdigest()
+    return _code_digests[modules]
+
+def _file_digest(filename) :
+    try :
+        f = open(filename, "rb")
+    except IOError :
+        return None
+    try :
+        return hashlib.sha1(f.read()).hexdigest()
+    finally :
+        f.close()
+
+def _dependencies_current(deps) :
+    for filename, digest in deps :
+        if _file_digest(filename) != digest :
+            return False
+    return True
+
+def _load_entry(path) :
+    if not os.path.isfile(path) :
+        return None
+    try :
+        f = open(path, "rb")
+        try :
+            return pickle.load(f)
+        finally :
+            f.close()
+    except Exception :
+        return None # an old or damaged entry is just parsed again
+
+def _save_entry(directory, path, entry) :
+    if not os.path.isdir(directory) :
+        os.makedirs(directory, 0755)
+    # written to the side and renamed, so a run which is stopped
+    # partway through doesn't leave half an entry
+    (fd, temp) = tempfile.mkstemp(".tmp", "", directory)
+    f = os.fdopen(fd, "wb")
+    try :
+        pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+    finally :
+        f.close()
+    os.chmod(temp, 0644) # mkstemp makes it private
+    os.rename(temp, path)
+
+# Passes everything through to the stream being parsed, writing down
+# what it returned in tape.
+class RecordingStream(streams.Stream) :
+    taped = True
+    def __init__(self, inner) :
+        streams.Stream.__init__(self, inner.name)
+        self.inner = inner
+        self.tape = []
+        self._events = self.tape
+    def read(self) :
+        c = self.inner.read()
+        self._events.append(("read", c))
+        return c
+    def peek(self) :
+        c = self.inner.peek()
+        self._events.append(("peek", c))
+        return c
+    def read_while(self, chars) :
+        s = self.inner.read_while(chars)
+        self._events.append(("read_while", s))
+        return s
+    def read_while_not(self, chars) :
+        s = self.inner.read_while_not(chars)
+        self._events.append(("read_while_not", s))
+        return s
+    def read_while_p(self, predicate) :
+        s = self.inner.read_while_p(predicate)
+        self._events.append(("read_while_p", s))
+        return s
+    def location(self) :
+        location = self.inner.location()
+        self._events.append(("location", location))
+        return location
+    def failure(self, msg="Unknown error.") :
+        # only made when parsing fails, which isn't saved
+        return self.inner.failure(msg)
+    def tell(self) :
+        offset = self.inner.tell()
+        self._events.append(("tell", offset))
+        return offset
+    def source(self) :
+        return self.inner.source()
+    def text(self, start, end) :
+        return self.inner.text(start, end)
+    def parse_one(self, char_env, escape_env, begin_stack) :
+        c = self.inner.peek()
+        outer = self._events
+        self._events = events = []
+        uses = parser.ParseUses()
+        parser._parse_uses.append(uses)
+        try :
+            token = char_env[c](self, char_env, escape_env, begin_stack)
+        finally :
+            parser._parse_uses.pop()
+            self._events = outer
+        if parser._parse_uses :
+            parser._parse_uses[-1].update(uses)
+        if uses.effect_free() and lazytokens.is_data(token) :
+            outer.append(("token", token, tuple(uses.variables)))
+        else :
+            outer.append(("call", c, events))
+        return token
+
+# Hands the handlers what a RecordingStream wrote down.  The text of
+# the file is only needed for Stream.text.
+class ReplayStream(streams.Stream) :
+    taped = True
+    def __init__(self, name, tape, text=None) :
+        streams.Stream.__init__(self, name)
+        self._events = iter(tape)
+        self._location = None
+        self._text = text
+    def _next(self, method) :
+        event = next(self._events, None)
+        if event is None or event[0] != method :
+            raise self._mismatch()
+        return event[1]
+    def _mismatch(self) :
+        return streams.ParseException("The parse cache entry for this file doesn't match what its handlers do."
+                                      "  Remove the parse cache directory and run again.",
+                                      name=self.name)
+    def read(self) :
+        return self._next("read")
+    def peek(self) :
+        return self._next("peek")
+    def read_while(self, chars) :
+        return self._next("read_while")
+    def read_while_not(self, chars) :
+        return self._next("read_while_not")
+    def read_while_p(self, predicate) :
+        return self._next("read_while_p")
+    def location(self) :
+        self._location = self._next("location")
+        return self._location
+    def failure(self, msg="Unknown error.") :
+        # as near as is known to where the handler was
+        if self._location is None :
+            return streams.ParseException(msg, name=self.name)
+        return self._location.failure(msg)
+    def tell(self) :
+        return self._next("tell")
+    def source(self) :
+        return self._text
+    def parse_one(self, char_env, escape_env, begin_stack) :
+        event = next(self._events, None)
+        if event is None :
+            raise self._mismatch()
+        elif event[0] == "token" :
+            if parser._parse_uses :
+                parser._parse_uses[-1].variables.update(event[2])
+            return event[1]
+        elif event[0] == "call" :
+            outer = self._events
+            self._events = iter(event[2])
+            try :
+                token = char_env[event[1]](self, char_env, escape_env, begin_stack)
+                if next(self._events, None) is not None :
+                    raise self._mismatch()
+            finally :
+                self._events = outer
+            return token
+        else :
+            raise self._mismatch()
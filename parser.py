@@ -4,14 +4,19 @@
 
 import streams
 import environments
-from environments import (CharacterEnvironment, DefaultCharacterEnvironment, TokenEnvironment, add_char_handler, add_token_handler)
+from environments import (CharacterEnvironment, DefaultCharacterEnvironment, TokenEnvironment, EvalEnvironment, add_char_handler, add_token_handler, impure)
+import pagedeps
+import tracing
 import lazytokens
-from lazytokens import (StringToken, LambdaToken, ListToken, VariableToken, ArgumentToken, EndEnvToken)
+from lazytokens import (StringToken, LambdaToken, ListToken, VariableToken, ArgumentToken, EndEnvToken, BoundToken, ThenToken, ValueToken, Thunk, evaluates_to_itself, fold, const_string)
 import os.path
+import collections
 
 tokenNameChars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
 def parse_one(stream, char_env, escape_env, begin_stack) :
+    if stream.taped :
+        return stream.parse_one(char_env, escape_env, begin_stack)
     return char_env[stream.peek()](stream, char_env, escape_env, begin_stack)
 
 # for global-level parsing, maybe (and testing)
@@ -26,12 +31,29 @@ def parse_all(stream, char_env, escape_env, begin_stack, execute = False) :
         else : out += a
     return out
 
+# whether macro bodies and the page template are folded (see
+# lazytokens.fold) after they are parsed
+partial_evaluation = True
+
 def global_parse(stream) :
     return parse_all(stream, global_char_env, global_tokens, [], execute = True)
 
+# the directory in which parsed files are saved so that later runs can
+# replay them rather than parse them again (see parsecache), or None
+parse_cache_dir = None
+
+def parse_file(filename, char_env, escape_env, execute = False) :
+    """Like parse_all on the file filename, but through the parse cache
+    if there is one."""
+    if parse_cache_dir is None :
+        return parse_all(streams.fileStream(filename), char_env, escape_env, [], execute)
+    return parsecache.parse_file(parse_cache_dir, filename, char_env, escape_env, execute)
+
+def global_parse_file(filename) :
+    return parse_file(filename, global_char_env, global_tokens, execute = True)
+
 def default_handler(stream, char_env, escape_env, begin_stack) :
-    bound = char_env.get_bindings()
-    return StringToken(stream.read_while_not(bound))
+    return StringToken(stream.read_while_not(char_env.stop_chars()))
 
 global_char_env = CharacterEnvironment({}, DefaultCharacterEnvironment(default_handler))
 global_tokens = TokenEnvironment({})
@@ -51,7 +73,7 @@ def eof_handler(stream, char_env, escape_env, begin_stack) :
 @global_char_handler('%')
 def comment_handler(stream, char_env, escape_env, begin_stack) :
     stream.read_while_not("\n")
-    return StringToken("")
+    return const_string("")
 
 # handles \escape tokens
 @global_char_handler('\\')
@@ -63,44 +85,87 @@ def token_handler(stream, char_env, escape_env, begin_stack) :
         if c == "" :
             raise stream.failure("End of file reached for token.  Expecting name.")
         else :
-            if escape_env.has_key(c) :
-                handler = escape_env[c]
-            else :
+            handler = escape_env.get(c)
+            if handler is None :
                 raise stream.failure("No such single character escape token "+repr(c)+".")
     else :
-        if escape_env.has_key(name) :
-            handler = escape_env[name]
-        else :
+        handler = escape_env.get(name)
+        if handler is None :
             raise stream.failure("No such escape token "+repr(name)+".")
         stream.read_while(" ") # gobble spaces (only if non-symbol escape token)
+    if _parse_uses :
+        _parse_uses[-1].handlers.add(handler)
     return handler(stream, char_env, escape_env, begin_stack)
 
+# What the body of a \def uses, gathered while it is parsed, to tell
+# whether the macro is pure (see def_token).  variables holds the
+# names given to \var, or None for a name which isn't a plain string.
+class ParseUses(object) :
+    def __init__(self) :
+        self.handlers = set()
+        self.variables = set()
+    def update(self, other) :
+        self.handlers.update(other.handlers)
+        self.variables.update(other.variables)
+    def effect_free(self) :
+        """Whether none of the handlers used has side effects."""
+        for handler in self.handlers :
+            if not getattr(handler, "pure", True) :
+                return False
+        return True
+    def pure(self, args) :
+        """Whether a body using these, with arguments named args, only
+        depends on its arguments and has no side effects."""
+        return self.effect_free() and self.variables.issubset(args)
+
+_parse_uses = []
+
 # for supporting \var{name}
 @global_token("var")
 def var_token(stream, char_env, escape_env, begin_stack) :
-    possible_error = stream.failure("Variable name must be string.")
+    location = stream.location()
     arg = parse_one(stream, global_char_env, escape_env, begin_stack)
+    if _parse_uses :
+        _parse_uses[-1].variables.add(arg.s if type(arg) == StringToken else None)
+    if type(arg) == StringToken :
+        # the name is already known
+        v = VariableToken(arg.s)
+        v.location = location
+        return v
     def eval_var(env) :
         e = arg.eval(env)
         if type(e) == StringToken :
             v = VariableToken(e.s)
-            v.streamname = stream.name
-            v.line = stream.row
+            v.location = location
             return v
         else :
-            raise possible_error
+            raise location.failure("Variable name must be string.")
     return LambdaToken(eval_var)
 
 # for supporting \def{test}{arg}{got argument \var{arg}}
 @global_token("def")
+@impure
 def def_token(stream, char_env, escape_env, begin_stack) :
-    possible_error_name = stream.failure()
+    start = stream.tell()
+    possible_error_name = stream.location()
     name = parse_one(stream, char_env, escape_env, begin_stack)
     stream.read_while(" ")
-    possible_error_args = stream.failure()
+    possible_error_args = stream.location()
     args = parse_one(stream, char_env, escape_env, begin_stack)
     stream.read_while(" ")
-    val = parse_one(stream, char_env, escape_env, begin_stack)
+    _parse_uses.append(ParseUses())
+    try :
+        val = parse_one(stream, char_env, escape_env, begin_stack)
+    finally :
+        uses = _parse_uses.pop()
+    if _parse_uses :
+        _parse_uses[-1].update(uses)
+    end = stream.tell()
+    if partial_evaluation :
+        val = fold(val)
+    # for telling whether pages calling the macro need to be written
+    # again (see pagedeps)
+    digest = pagedeps.digest(stream.text(start, end), uses.handlers) if pagedeps.enabled else None
 #    print "def args =",args,"val =",val
     # this is a LambdaToken for ultimately putting the definition into
     # the escape_env
@@ -114,31 +179,109 @@ def def_token(stream, char_env, escape_env, begin_stack) :
         try :
             a = args.eval(env)
         except AttributeError :
-            raise possible_error1.with_message("Cannot evaluate args for def.")
+            raise possible_error_args.with_message("Cannot evaluate args for def.")
         if type(a) != StringToken :
-            raise possible_error_name.with_message("Argument list for def must be string.")
+            raise possible_error_args.with_message("Argument list for def must be string.")
         if a.s.strip() == "" :
             myargs = []
         else :
             myargs = [x.strip() for x in a.s.split(",")]
+        pure = uses.pure(myargs)
+        macro = (n.s, next(_macro_serial))
         # this is the handler which is put in the escape_env
         def this_def_handler(stream, char_env, escape_env, begin_stack) :
             arguments = dict()
             for a in myargs :
                 arguments[a] = parse_one(stream, char_env, escape_env, begin_stack)
+            # arguments which evaluate to themselves are bound as they
+            # are, and the rest are evaluated at most once per call
+            lazy = [(key, value) for key, value in arguments.iteritems() if not evaluates_to_itself(value)]
             # and this is what is executed when defined token is called
             def _this_def_handler(env) :
-                env2 = dict()
-                for key, value in env.iteritems() :
-                    env2[key] = value
-                for key, value in arguments.iteritems() :
-                    env2[key] = value
-                return val.eval(env2)
+                if not arguments :
+                    body = BoundToken(val, env)
+                elif not lazy :
+                    body = BoundToken(val, EvalEnvironment(arguments, env))
+                else :
+                    bindings = dict(arguments)
+                    for key, value in lazy :
+                        bindings[key] = Thunk(value, env)
+                    body = BoundToken(val, EvalEnvironment(bindings, env))
+                if pure and macro_cache_size > 0 :
+                    return memoized_expansion(macro, myargs, arguments, body)
+                return body
+            if pure :
+                return LambdaToken(_this_def_handler, arguments.values())
             return LambdaToken(_this_def_handler)
+        this_def_handler.pure = pure
+        this_def_handler.arguments = tuple(myargs) # for parsecache
+        this_def_handler.name = n.s
+        this_def_handler.digest = digest
+        if profiling.enabled :
+            this_def_handler = profiling.wrap_handler("\\"+n.s, this_def_handler)
         escape_env[n.s] = this_def_handler
-        return StringToken("")
+        return const_string("")
     return LambdaToken(eval_def)
 
+# Expansions of pure macros are remembered in a least recently used
+# cache, keyed by the macro and the structure of the arguments it was
+# called with.  The arguments are what \var hands over, which is what
+# was parsed, not evaluated, so calls whose arguments hold something
+# without a structure (like a call of another macro) aren't cached.
+# Each definition of a macro gets its own serial number so redefining
+# one doesn't pick up the old expansions.
+macro_cache_size = 4096
+_macro_cache = collections.OrderedDict()
+_macro_serial = iter(xrange(1, 1 << 62))
+_macro_cache_counts = {"hits" : 0, "misses" : 0, "uncacheable" : 0, "evictions" : 0}
+
+def memoized_expansion(macro, argnames, arguments, body) :
+    """Returns a token which evaluates to what body does, remembering
+    it the first time for the next call with the same arguments."""
+    key = [macro]
+    for a in argnames :
+        s = arguments[a].structure()
+        if s is None :
+            _macro_cache_counts["uncacheable"] += 1
+            return body
+        key.append(s)
+    key = tuple(key)
+    try :
+        value = _macro_cache.pop(key)
+    except KeyError :
+        _macro_cache_counts["misses"] += 1
+        return _MacroCacheStore(body, key)
+    _macro_cache[key] = value # now the most recently used
+    _macro_cache_counts["hits"] += 1
+    return ValueToken(value)
+
+# evaluates body and puts the value in the cache under key
+class _MacroCacheStore(ThenToken) :
+    __slots__ = ("key",)
+    evaluate_then = False
+    def __init__(self, body, key) :
+        ThenToken.__init__(self, body)
+        self.key = key
+    def then(self, value, env) :
+        _macro_cache[self.key] = value
+        if len(_macro_cache) > macro_cache_size :
+            _macro_cache.popitem(last=False)
+            _macro_cache_counts["evictions"] += 1
+        return value
+
+def macro_cache_statistics() :
+    """Returns a dict of how the pure macro cache has done: hits,
+    misses, uncacheable (calls of pure macros with arguments which
+    couldn't be keyed), evictions, hit_rate and size."""
+    counts = dict(_macro_cache_counts)
+    lookups = counts["hits"] + counts["misses"]
+    counts["hit_rate"] = float(counts["hits"]) / lookups if lookups else 0.0
+    counts["size"] = len(_macro_cache)
+    return counts
+
+def clear_macro_cache() :
+    _macro_cache.clear()
+
 # for handling { and }
 @global_char_handler('}')
 def close_brace_handler(stream, char_env, escape_env, begin_stack) :
@@ -146,16 +289,16 @@ def close_brace_handler(stream, char_env, escape_env, begin_stack) :
 
 @global_char_handler('{')
 def open_brace_handler(stream, char_env, escape_env, begin_stack) :
-    possible_start_failure = stream.failure("Missing closing brace for '{'.")
+    start = stream.location()
     stream.read()
     if stream.peek() == '}' :
         stream.read()
-        return StringToken("")
+        return const_string("")
     begin_stack2 = begin_stack + ["{"]
     out = parse_one(stream, char_env, escape_env, begin_stack2)
     while stream.peek() != '}' :
         if stream.peek() == "" :
-            raise possible_start_failure
+            raise start.failure("Missing closing brace for '{'.")
         else :
             out += parse_one(stream, char_env, escape_env, begin_stack2)
     stream.read()
@@ -166,21 +309,21 @@ def open_brace_handler(stream, char_env, escape_env, begin_stack) :
 def close_bracket_handler(stream, char_env, escape_env, begin_stack) :
     """Close brackets are normal text when not being used as an argument."""
     stream.read()
-    return StringToken("]")
+    return const_string("]")
 
 # this should be called when an [args] is necessary. See read_bracket_args
 # @global_char_handler('[')
 def open_bracket_handler(stream, char_env, escape_env, begin_stack) :
-    possible_start_failure = stream.failure("Missing closing bracket for '['.")
+    start = stream.location()
     stream.read()
     if stream.peek() == ']' :
         stream.read()
-        return ArgumentToken(StringToken(""))
+        return ArgumentToken(const_string(""))
     begin_stack2 = begin_stack + ["["]
     out = parse_one(stream, char_env, escape_env, begin_stack2)
     while stream.peek() != ']' :
         if stream.peek() == "" :
-            raise possible_start_failure
+            raise start.failure("Missing closing bracket for '['.")
         else :
             out += parse_one(stream, char_env, escape_env, begin_stack2)
     stream.read()
@@ -215,6 +358,8 @@ def begin_handler(stream, char_env, escape_env, begin_stack) :
         raise stream.failure("Environment name must be a string.")
     name = name.s
     begin_stack2 = begin_stack + [name]
+    if _parse_uses :
+        _parse_uses[-1].handlers.add(environment_handlers[name][0])
     (char_env2, escape_env2) = environment_handlers[name][0](stream, char_env, escape_env)
     token = parse_one(stream, char_env2, escape_env2, begin_stack2)
     if type(token) == lazytokens.EOFToken :
@@ -229,7 +374,7 @@ def begin_handler(stream, char_env, escape_env, begin_stack) :
             out += token
         token = parse_one(stream, char_env2, escape_env2, begin_stack2)
     if out == None :
-        return environment_handlers[name][1](char_env2, escape_env2, escape_env, StringToken(""))
+        return environment_handlers[name][1](char_env2, escape_env2, escape_env, const_string(""))
     else : return environment_handlers[name][1](char_env2, escape_env2, escape_env, out)
 
 # this is a helper for tokens which want a bracketed argument.  It
@@ -263,7 +408,7 @@ def make_handler(nargs, bargs=False) :
 @global_token("#")
 @make_handler(0)
 def hash_escape_handler() :
-    return StringToken("#")
+    return const_string("#")
 
 ###
 ### external definitions of parsing beyond the core parser.
@@ -285,6 +430,8 @@ import filerefs
 insert_module(filerefs)
 import hmath
 insert_module(hmath)
+import parsecache
+import profiling
 
 ###
 ### handling knowing where we're outputting and inputting
@@ -297,6 +444,7 @@ def set_output_dir(dir, tenv=global_tokens) :
     if os.path.relpath(tenv["_curr_out_dir"], tenv["_global_base_out_dir"]).startswith("..") :
         raise Exception("Going into directory "+repr(dir)+" which is not in global output directory "+repr(tenv["_global_base_out_dir"]))
 @global_token("setoutputdir")
+@impure
 def setoutputdirhandler(stream, char_env, token_env, begin_stack) :
     dir = parse_one(stream, char_env, token_env, begin_stack)
     try :
@@ -305,7 +453,7 @@ def setoutputdirhandler(stream, char_env, token_env, begin_stack) :
         raise Exception("Can't change to unexecutable directory name "+repr(dir)+".")
     if type(dir) == StringToken :
         set_output_dir(dir.s)
-        return StringToken("")
+        return const_string("")
     else :
         raise Exception("Can't change to non-string directory name "+repr(dir)+".")
 
@@ -315,6 +463,7 @@ def set_input_dir(dir) :
 global_tokens["_fluid_let"] = ["_global_input_dir", "_curr_out_dir"]
 
 @global_token("include")
+@impure
 def include_handler(stream, char_env, token_env, begin_stack) :
     file = parse_one(stream, char_env, token_env, begin_stack)
     def _handler(env) :
@@ -325,12 +474,14 @@ def include_handler(stream, char_env, token_env, begin_stack) :
         if type(f) == StringToken :
             filename = os.path.abspath(os.path.join(token_env["_global_input_dir"], f.s))
             if os.path.isfile(filename) :
+                pagedeps.record_file(filename)
                 fluid_letted = dict()
                 for name in token_env["_fluid_let"] :
                     fluid_letted[name] = token_env[name]
 #                print "fluid",fluid_letted
                 token_env["_global_input_dir"] = os.path.split(filename)[0]
-                ret = global_parse(streams.fileStream(filename))
+                with tracing.span("\\include{"+f.s+"}", file=filename) :
+                    ret = global_parse_file(filename)
                 for key,value in fluid_letted.iteritems() :
                     token_env[key] = value
                 return ret
@@ -339,3 +490,22 @@ def include_handler(stream, char_env, token_env, begin_stack) :
         else :
             raise stream.failure("Filename must be a string in include.")
     return LambdaToken(_handler)
+
+###
+### building again
+###
+
+# what global_tokens held before anything was parsed, so that a \def
+# or a \setpagetemplate of one run isn't there in the next
+_initial_tokens = global_tokens.snapshot()
+_initial_fluid_let = list(global_tokens["_fluid_let"])
+
+def reset() :
+    """Forgets the macros and such of the last run, for building again
+    in the same process (runhm.py --watch)."""
+    environments.restore_snapshot(_initial_tokens)
+    # \addbreadcrumb adds to the list itself
+    global_tokens["_fluid_let"] = list(_initial_fluid_let)
+    _macro_cache.clear()
+    del _parse_uses[:]
+    del parsecache._recording[:]
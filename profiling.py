@@ -0,0 +1,227 @@
+# profiling.py
+#
+# times each handler, both parsing and evaluating what it made, for
+# runhm.py --profile.  Nothing is timed unless install is called, which
+# puts wrapped handlers in place of the ones registered, so a run
+# without --profile pays nothing for this.
+
+import time
+import json
+
+import lazytokens
+from lazytokens import (StringToken, ListToken, ThenToken)
+import parser
+import textmarkup
+import hmath
+
+# whether install has been called
+enabled = False
+
+# how many of the slowest calls of each handler are kept
+slowest_kept = 5
+
+# What is known about the calls of one handler in one phase: "parse"
+# for calls of the handler itself, and "eval" for evaluations of the
+# LambdaTokens it made.  Time spent in calls of other handlers is taken
+# out of own_time, and a call inside a call of the same handler isn't
+# added to cumulative_time again.  bytes is how much of the input a
+# parse read, and how much text an evaluation gave.
+class Stat(object) :
+    def __init__(self, name, phase) :
+        self.name = name
+        self.phase = phase
+        self.calls = 0
+        self.cumulative_time = 0.0
+        self.own_time = 0.0
+        self.bytes = 0
+        self.active = 0
+        self.slowest = [] # (elapsed, location), slowest first
+    def add(self, elapsed, children, nbytes, location) :
+        self.calls += 1
+        self.own_time += elapsed - children
+        if self.active == 0 :
+            self.cumulative_time += elapsed
+        self.bytes += nbytes
+        if len(self.slowest) < slowest_kept or elapsed > self.slowest[-1][0] :
+            self.slowest.append((elapsed, location))
+            self.slowest.sort(key=lambda s : -s[0])
+            del self.slowest[slowest_kept:]
+    def as_dict(self) :
+        return {"name" : self.name,
+                "phase" : self.phase,
+                "calls" : self.calls,
+                "cumulative_time" : self.cumulative_time,
+                "self_time" : self.own_time,
+                "bytes" : self.bytes,
+                "slowest" : [dict(zip(("file", "line"), _where(location)), time=elapsed)
+                             for (elapsed, location) in self.slowest]}
+
+_stats = dict()
+
+def _stat(name, phase) :
+    key = (name, phase)
+    if key not in _stats :
+        _stats[key] = Stat(name, phase)
+    return _stats[key]
+
+# the calls being timed, innermost last, as [stat, start, time spent in
+# the calls inside it, location]
+_stack = []
+
+def _enter(stat, location) :
+    frame = [stat, time.time(), 0.0, location]
+    stat.active += 1
+    _stack.append(frame)
+    return frame
+
+def _leave(frame, nbytes) :
+    elapsed = time.time() - frame[1]
+    # what is above frame was left by a handler which raised
+    while _stack.pop() is not frame :
+        pass
+    stat = frame[0]
+    stat.active -= 1
+    stat.add(elapsed, frame[2], nbytes, frame[3])
+    if _stack :
+        _stack[-1][2] += elapsed
+
+def _untaped(stream) :
+    # a stream which can say where it is without it going on a parse
+    # cache tape, or None for a stream replaying a tape
+    if not stream.taped :
+        return stream
+    return getattr(stream, "inner", None)
+
+def _where(location) :
+    if location is None :
+        return (None, None)
+    return (location.name, location.position()[0])
+
+def _copy_attributes(wrapper, f) :
+    # so the wrapper passes for f with parser, parsecache and pagedeps
+    wrapper.__dict__.update(getattr(f, "__dict__", {}))
+    wrapper.__name__ = getattr(f, "__name__", wrapper.__name__)
+    wrapper.__module__ = getattr(f, "__module__", None)
+    wrapper.__doc__ = getattr(f, "__doc__", None)
+    return wrapper
+
+def wrap_handler(name, handler) :
+    """Returns a handler which does what the character or escape token
+    handler handler does, timing it under name."""
+    stat = _stat(name, "parse")
+    def profiled_handler(stream, char_env, escape_env, begin_stack) :
+        inner = _untaped(stream)
+        start = inner.tell() if inner is not None else None
+        frame = _enter(stat, inner.location() if inner is not None else None)
+        try :
+            return handler(stream, char_env, escape_env, begin_stack)
+        finally :
+            _leave(frame, inner.tell() - start if inner is not None else 0)
+    return _copy_attributes(profiled_handler, handler)
+
+def wrap_environment(name, handlers) :
+    """Likewise for the (begin, end) handlers of an environment."""
+    (begin, end) = handlers
+    begin_stat = _stat("\\begin{"+name+"}", "parse")
+    end_stat = _stat("\\end{"+name+"}", "parse")
+    def profiled_begin(stream, char_env, escape_env) :
+        inner = _untaped(stream)
+        frame = _enter(begin_stat, inner.location() if inner is not None else None)
+        try :
+            return begin(stream, char_env, escape_env)
+        finally :
+            _leave(frame, 0)
+    def profiled_end(char_env, token_env, outer_token_env, out) :
+        frame = _enter(end_stat, None)
+        try :
+            return end(char_env, token_env, outer_token_env, out)
+        finally :
+            _leave(frame, 0)
+    return (_copy_attributes(profiled_begin, begin), _copy_attributes(profiled_end, end))
+
+# Ends the timing of an evaluation once what the LambdaToken returned
+# has been evaluated too, which evaluate does after the LambdaToken
+# itself has returned.
+class _EndEvaluation(ThenToken) :
+    __slots__ = ("frame",)
+    evaluate_then = False
+    def __init__(self, token, frame) :
+        ThenToken.__init__(self, token)
+        self.frame = frame
+    def then(self, value, env) :
+        _leave(self.frame, _text_bytes(value))
+        return value
+
+def _text_bytes(value) :
+    if type(value) is StringToken :
+        return len(value.s)
+    elif type(value) is ListToken :
+        return sum(len(t.s) for t in value.tokens if type(t) is StringToken)
+    return 0
+
+_original_lambda_init = lazytokens.LambdaToken.__init__
+
+def _profiled_lambda_init(self, f, inputs=None) :
+    # a LambdaToken made while a handler is being timed is put down to
+    # that handler
+    if _stack :
+        (stat, start, children, location) = _stack[-1]
+        stat = _stat(stat.name, "eval")
+        untimed = f
+        def f(env) :
+            frame = _enter(stat, location)
+            try :
+                token = untimed(env)
+            except :
+                _leave(frame, 0)
+                raise
+            return _EndEvaluation(token, frame)
+    _original_lambda_init(self, f, inputs)
+
+_start_time = None
+
+def install() :
+    """Wraps every handler in place, along with those \\def makes from
+    now on, and starts timing."""
+    global enabled, _start_time
+    enabled = True
+    _start_time = time.time()
+    for char_env in [parser.global_char_env, textmarkup.char_pretty_text, hmath.math_char_env] :
+        for c, handler in char_env.bindings.items() :
+            char_env[c] = wrap_handler("char "+repr(c), handler)
+    default = parser.global_char_env.parent
+    default.handler = wrap_handler("text", default.handler)
+    tokens = parser.global_tokens
+    for name, handler in tokens.bindings.items() :
+        if callable(handler) :
+            tokens[name] = wrap_handler("\\"+name, handler)
+    # so parser.reset puts back the wrapped handlers
+    parser._initial_tokens = tokens.snapshot()
+    for name, handlers in parser.environment_handlers.items() :
+        parser.environment_handlers[name] = wrap_environment(name, handlers)
+    lazytokens.LambdaToken.__init__ = _profiled_lambda_init
+
+def statistics() :
+    """Returns the Stats of the handlers which were called, those
+    taking the most time of their own first."""
+    stats = [s for s in _stats.itervalues() if s.calls > 0]
+    stats.sort(key=lambda s : (-s.own_time, s.name, s.phase))
+    return stats
+
+def report(filename) :
+    """Prints a table of the statistics, and saves them in filename as
+    JSON."""
+    stats = statistics()
+    elapsed = time.time() - _start_time
+    print "\n%-32s %-5s %8s %10s %10s %10s  %s" % ("handler", "phase", "calls", "cumul. ms", "self ms", "bytes", "slowest call")
+    for s in stats :
+        (name, line) = _where(s.slowest[0][1]) if s.slowest else (None, None)
+        where = "" if name is None else "%s:%s" % (name, line)
+        print "%-32s %-5s %8d %10.1f %10.1f %10d  %s" % (s.name[:32], s.phase, s.calls, 1000 * s.cumulative_time,
+                                                        1000 * s.own_time, s.bytes, where)
+    print "Total time %.1fms; saved in %s" % (1000 * elapsed, filename)
+    f = open(filename, "w")
+    try :
+        json.dump({"total_time" : elapsed, "handlers" : [s.as_dict() for s in stats]}, f, indent=1)
+    finally :
+        f.close()
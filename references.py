@@ -2,10 +2,14 @@
 #
 # handles references and counters
 
-from lazytokens import (StringToken, LambdaToken, ListToken, VariableToken, InhibitParagraphToken)
-from environments import (add_char_handler, add_token_handler)
+from lazytokens import (StringToken, LambdaToken, ListToken, VariableToken, InhibitParagraphToken, LineBreakToken, HorizontalLineToken, const_string)
+from environments import (add_char_handler, add_token_handler, impure)
 from parser import (parse_one, read_bracket_args, global_char_env)
+import pagedeps
+import pagepool
 import pickle
+import re
+import os
 import os.path
 import urllib
 
@@ -76,7 +80,7 @@ class LinkReference(object) :
         path = os.path.join(os.path.relpath(self.dir, fromdir), self.filename)
         return StringToken("<A HREF=\"" + path + ("" if self.anchor is None
                                                   else ("#"+urllib.quote_plus(self.anchor)))
-                           +"\">") + insides + StringToken("</A>")
+                           +"\">") + insides + const_string("</A>")
     def make_anchor(self) :
         return StringToken("<A NAME=\"" + urllib.quote_plus(self.anchor) + "\"></A>")
     def get_name(self) :
@@ -118,24 +122,112 @@ def set_anchor_reference(token_env, id, autoname) :
     else :
         raise Exception("No page reference given, so can't create anchor for id "+repr(id))
 
+# what a page being written in another process started out with (see
+# pagepool)
+def _save_page_state() :
+    counts = [(c, c.i) for c in _counters.itervalues()]
+    return (dict(_counters), counts, _last_object_for_label)
+def _restore_page_state(state) :
+    global _counters, _last_object_for_label
+    (counters, counts, _last_object_for_label) = state
+    _made_by_page.clear()
+    _counters = dict(counters)
+    for (c, i) in counts :
+        c.i = i
+pagepool.keep_state(_save_page_state, _restore_page_state)
+
+def reset() :
+    """Forgets the counts, labels and references of the last run, for
+    building again in the same process (runhm.py --watch)."""
+    global _last_object_for_label, _old_references, _old_id_to_reference_name
+    for c in _counters.itervalues() :
+        c.reset()
+    _last_object_for_label = None
+    _references.clear()
+    _id_to_reference_name.clear()
+    _old_references = dict()
+    _old_id_to_reference_name = dict()
+    _links.clear()
+
+# The labels and ids which the page being written in a process of
+# pagepool made.  Looking them up isn't recorded: the main process only
+# checks the lookups of a page before making its labels again, and
+# would find them missing.
+_made_by_page = set()
+
+def _lookup(f, kind, arg, value, changed=pagepool.differs) :
+    if (kind, arg) not in _made_by_page :
+        pagepool.lookup(f, arg, value, changed)
+
+# A page which found a label not made yet put in a placeholder for it,
+# which comes out as the link would have once the label is made, so
+# only a label made then and missing now would make it wrong.
+def _unmade_since(then, now) :
+    return then and not now
+
 def get_anchor_by_id(id) :
+    pagepool.settle()
+    if not id_made(id) :
+        # the label usually comes after what it labels
+        return StringToken(placeholder(PendingLink("anchor", id)))
+    ref = find_reference_by_id(id)
+    pagedeps.record_anchor(id, ref)
+    return ref.make_anchor()
+
+def find_reference_by_id(id) :
+    """Like find_reference, but for the id of what was labeled."""
+    pagepool.settle()
     if _id_to_reference_name.has_key(id) :
-        return _references[_id_to_reference_name[id]].make_anchor()
+        ref = _references[_id_to_reference_name[id]]
     elif _old_id_to_reference_name.has_key(id) :
-        return _old_references[_old_id_to_reference_name[id]].make_anchor()
+        ref = _old_references[_old_id_to_reference_name[id]]
     else :
-        #print "No such reference with id "+repr(id) # this happens when the object never gets a label
-        return StringToken("")
+        ref = None
+    _lookup(find_reference_by_id, "id", id, ref)
+    return ref
 
 def get_autoname_by_ref_name(ref) :
-    if _references.has_key(ref) :
-        return _references[ref].autoname
-    elif _old_references.has_key(ref) :
-        return _old_references[ref].autoname
-    else :
-        return StringToken("<B>(?? reference ??)</B>")
+    pagepool.settle()
+    if not label_made(ref) :
+        return StringToken(placeholder(PendingLink("autoname", ref)))
+    r = find_reference(ref)
+    pagedeps.record_reference(ref, r)
+    return r.autoname
+
+def find_reference(name) :
+    """Returns the LinkReference for the label name made so far in this
+    run, or else in the last run, or None."""
+    pagepool.settle()
+    ref = _references.get(name)
+    if ref is None :
+        ref = _old_references.get(name)
+    _lookup(find_reference, "label", name, ref)
+    return ref
+
+def label_made(name) :
+    """Whether the label name has been made yet in this run."""
+    pagepool.settle()
+    made = _references.has_key(name)
+    _lookup(label_made, "label", name, made, _unmade_since)
+    return made
+
+def id_made(id) :
+    """Whether what has the given id has been labeled yet in this run."""
+    pagepool.settle()
+    made = _id_to_reference_name.has_key(id)
+    _lookup(id_made, "id", id, made, _unmade_since)
+    return made
+
+def add_reference(lr) :
+    pagepool.settle()
+    _references[lr.get_name()] = lr
+    _id_to_reference_name[lr.id] = lr.get_name()
+    if pagepool.in_other_process() :
+        _made_by_page.add(("label", lr.get_name()))
+        _made_by_page.add(("id", lr.id))
+    pagedeps.record_label(lr)
+    pagepool.effect(add_reference, lr)
 
-_labels_changed = False
 _references = dict()
 _id_to_reference_name = dict()
 
@@ -143,25 +235,24 @@ _old_references = dict()
 _old_id_to_reference_name = dict()
 
 def serialize_link_references(filename) :
-    global _labels_changed
-    if not ((_references == _old_references) and (_id_to_reference_name == _old_id_to_reference_name)) :
-        _labels_changed = True
-    file = open(filename + ".ref", "w")
-    pickle.dump([_references, _id_to_reference_name], file)
+    file = open(filename + ".ref", "wb")
+    # protocol 2 since tokens use __slots__
+    pickle.dump([_references, _id_to_reference_name], file, pickle.HIGHEST_PROTOCOL)
     file.close()
 
 def unserialize_link_references(filename) :
     global _old_references, _old_id_to_reference_name
     if os.path.isfile(filename + ".ref") :
-        file = open(filename + ".ref", "r")
+        file = open(filename + ".ref", "rb")
         rs = pickle.load(file)
         _old_references = rs[0]
         _old_id_to_reference_name = rs[1]
         file.close()
 
 @add_token_handler(token_handlers, "label")
+@impure
 def label_handler(stream, char_env, token_env, begin_stack) :
-    poss_failure = stream.failure()
+    poss_failure = stream.location()
     name = parse_one(stream, global_char_env, token_env, begin_stack)
     def _handler(env) :
         global _last_object_for_label
@@ -180,8 +271,7 @@ def label_handler(stream, char_env, token_env, begin_stack) :
             token_env["_curr_page_reference"] = lr
             token_env["_curr_page_label"] = labelname
         _last_object_for_label = False
-        _references[lr.get_name()] = lr
-        _id_to_reference_name[lr.id] = lr.get_name()
+        add_reference(lr)
         return InhibitParagraphToken()
     return LambdaToken(_handler)
 
@@ -191,12 +281,11 @@ def make_label(token_env, labelname, id, autoname) :
     else :
         raise Exception("No page reference given, so can't create anchor for id "+repr(id))
     lr = lr.make_link_reference(labelname)
-    _references[lr.get_name()] = lr
-    _id_to_reference_name[lr.id] = lr.get_name()
+    add_reference(lr)
 
 @add_token_handler(token_handlers, "ref")
+@impure
 def ref_handler(stream, char_env, token_env, begin_stack) :
-    poss_err = stream.failure()
     barg = read_bracket_args(stream, char_env, token_env, begin_stack)
     labelname = parse_one(stream, global_char_env, token_env, begin_stack)
     return make_reference(token_env, labelname, barg)
@@ -213,14 +302,14 @@ def make_reference(token_env, labelname, barg) :
         ln = ln.s
         if ln.startswith("#") :
             ln = token_env["_curr_page_label"]+ln
-        if not _references.has_key(ln) :
-            if not _old_references.has_key(ln) :
-                print "No such reference "+repr(ln)+"."
-                return StringToken("<B>(?? reference ??)</B>")
-            else :
-                ref = _old_references[ln]
-        else :
-            ref = _references[ln]
+        pagepool.settle()
+        if not label_made(ln) :
+            text = None
+            if barg is not None :
+                text = _text(barg.eval(env))
+            return StringToken(placeholder(PendingLink("ref", ln, token_env["_curr_out_dir"], text)))
+        ref = find_reference(ln)
+        pagedeps.record_reference(ln, ref)
         if barg is not None :
             text = barg
         else :
@@ -229,12 +318,114 @@ def make_reference(token_env, labelname, barg) :
         return a
     return LambdaToken(_handler)
 
+###
+### Placeholders
+###
+
+# A reference to a label which hasn't been made yet is put in the text
+# as a placeholder, which is replaced by the reference when the page is
+# written if the label has been made by then, and otherwise once every
+# page has been written (see textmarkup.write_deferred_pages).  So a
+# single run gets every reference right, without going by the labels
+# of the last run.  Anchors are always known by the time their page is
+# written, since the label for something comes within its page.
+
+class PendingLink(object) :
+    def __init__(self, kind, name, fromdir=None, text=None) :
+        self.kind = kind # "ref", "autoname" or "anchor"
+        self.name = name # a label name, or an id for an anchor
+        self.fromdir = fromdir
+        self.text = text
+    def resolve(self, final) :
+        """Returns the text to put in place of the placeholder, or None
+        if its label hasn't been made yet and final is False."""
+        if self.kind == "anchor" :
+            ref = find_reference_by_id(self.name) if id_made(self.name) else None
+            pagedeps.record_anchor(self.name, ref)
+            if ref is None :
+                return "" # this happens when the object never gets a label
+            return ref.make_anchor().s
+        if not label_made(self.name) :
+            if not final :
+                return None
+            pagedeps.record_reference(self.name, None)
+            if self.kind == "ref" :
+                print "No such reference "+repr(self.name)+"."
+            return "<B>(?? reference ??)</B>"
+        ref = find_reference(self.name)
+        pagedeps.record_reference(self.name, ref)
+        if self.kind == "autoname" :
+            return _text(ref.autoname)
+        if self.text is not None :
+            text = StringToken(self.text)
+        else :
+            text = ref.autoname
+        return _text(ref.relative_link(self.fromdir, text))
+    def __repr__(self) :
+        return "<PendingLink "+self.kind+" "+repr(self.name)+">"
+
+_links = dict()
+_link_count = 0
+_placeholder_re = re.compile("\x01([0-9.]+)\x02")
+
+def placeholder(link) :
+    """Returns the placeholder text for link.  These are unique even
+    across the processes of pagepool."""
+    global _link_count
+    _link_count += 1
+    key = "%d.%d" % (os.getpid(), _link_count)
+    _add_link(key, link)
+    pagepool.effect(_add_link, key, link)
+    return "\x01" + key + "\x02"
+
+def _add_link(key, link) :
+    _links[key] = link
+
+def resolve_placeholders(text, final=False) :
+    """Replaces the placeholders in text by what they refer to.  Unless
+    final, those whose labels haven't been made are left in."""
+    def _resolve(match) :
+        link = _links.get(match.group(1))
+        if link is None :
+            return "" if final else match.group(0)
+        resolved = link.resolve(final)
+        return match.group(0) if resolved is None else resolved
+    # what a placeholder is replaced by can have placeholders in it
+    # (an autoname with a \ref), but not without end
+    for i in range(0, 10) :
+        if "\x01" not in text :
+            break
+        new = _placeholder_re.sub(_resolve, text)
+        if new == text :
+            break
+        text = new
+    return text
+
+def has_placeholders(text) :
+    return "\x01" in text
+
+def _text(token) :
+    # the HTML of an evaluated token which goes in a line of text,
+    # written as textmarkup.write_paragraphing would inside a paragraph
+    token = token.eval({})
+    parts = []
+    for t in (token.tokens if type(token) is ListToken else [token]) :
+        if type(t) is StringToken :
+            parts.append(t.s)
+        elif type(t) is LineBreakToken :
+            parts.append("<BR>")
+        elif type(t) is HorizontalLineToken :
+            parts.append("\n<HR>\n")
+        elif type(t) is not InhibitParagraphToken :
+            raise Exception("Can't put "+repr(t)+" in the text of a reference.")
+    return "".join(parts)
+
 # for external links
 @add_token_handler(token_handlers, "link")
+@impure
 def link_handler(stream, char_env, token_env, begin_stack) :
-    poss_err = stream.failure()
     barg = read_bracket_args(stream, char_env, token_env, begin_stack)
     linkurl = parse_one(stream, global_char_env, token_env, begin_stack)
     if barg is None :
         barg = linkurl
-    return StringToken("<A HREF=\"") + linkurl + StringToken("\">") + barg + StringToken("</A>")
+    return const_string("<A HREF=\"") + linkurl + const_string("\">") + barg + const_string("</A>")
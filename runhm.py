@@ -1,28 +1,90 @@
 #!/usr/bin/env python
 import parser
-import streams
 import references
+import textmarkup
+import pagedeps
+import pagepool
+import watch
+import profiling
+import tracing
+import memstats
 import os
 import sys
+import optparse
 
 def runhm(inpfile, outdir) :
     parser.set_input_dir(os.path.split(inpfile)[0])
     parser.set_global_output_dir(outdir)
-    references.unserialize_link_references(inpfile)
-    parser.global_parse(streams.fileStream(inpfile))
-    references.serialize_link_references(inpfile)
+    with tracing.span("unserialize_link_references") :
+        references.unserialize_link_references(inpfile)
+    if pagedeps.enabled :
+        with tracing.span("load page dependencies") :
+            pagedeps.load_database(inpfile + ".deps", outdir)
+    with tracing.span("parse "+inpfile, file=os.path.abspath(inpfile)) :
+        parser.global_parse_file(inpfile)
+    with tracing.span("wait for pages") :
+        pagepool.settle()
+    with tracing.span("write deferred pages") :
+        textmarkup.write_deferred_pages()
+    with tracing.span("serialize_link_references") :
+        references.serialize_link_references(inpfile)
+    if pagedeps.enabled :
+        with tracing.span("save page dependencies") :
+            pagedeps.save_database(inpfile + ".deps")
 
 #    print "\nFinal references:"
 #    print "_references",references._references,"\n"
 #    print "_id_to_reference_name",references._id_to_reference_name
 
-    if references._labels_changed :
-        print "\n***Run again to get labels right.***\n"
-    else :
-        print "\n***Done***\n"
+    print "\n***Done***\n"
 
 if __name__=="__main__" :
-    if len(sys.argv) != 3 :
-        print "Usage: %s inpfile outdir" % sys.argv[0]
+    optparser = optparse.OptionParser(usage="%prog [options] inpfile outdir")
+    optparser.add_option("--parse-cache", metavar="DIR",
+                         help="save parsed files in DIR, and replay them in later runs rather than parse them again")
+    optparser.add_option("--incremental", action="store_true", default=False,
+                         help="only write the pages for which something they depend on has changed since the last run")
+    optparser.add_option("-j", "--jobs", type="int", default=1, metavar="N",
+                         help="evaluate and write pages in up to N processes at once")
+    optparser.add_option("--watch", action="store_true", default=False,
+                         help="build again, incrementally, whenever a file in the directory of inpfile changes")
+    optparser.add_option("--serve", type="int", metavar="PORT",
+                         help="with --watch, serve outdir at http://localhost:PORT/")
+    optparser.add_option("--profile", action="store_true", default=False,
+                         help="time each macro, environment and character handler, and save the times in inpfile.profile.json")
+    optparser.add_option("--trace", metavar="FILE",
+                         help="save a timeline of the build in FILE, as Chrome trace events")
+    optparser.add_option("--memstats", action="store_true", default=False,
+                         help="count the tokens and memory held while each page is written, and save this in inpfile.memstats.json")
+    (options, args) = optparser.parse_args()
+    if len(args) != 2 :
+        optparser.print_usage()
+    elif options.serve is not None and not options.watch :
+        optparser.error("--serve only goes with --watch")
+    elif options.profile and (options.jobs > 1 or options.watch) :
+        optparser.error("--profile only goes with neither -j nor --watch")
+    elif options.memstats and (options.jobs > 1 or options.watch) :
+        optparser.error("--memstats only goes with neither -j nor --watch")
     else :
-        runhm(sys.argv[1], sys.argv[2])
+        parser.parse_cache_dir = options.parse_cache
+        pagedeps.enabled = options.incremental or options.watch
+        pagepool.jobs = options.jobs
+        if options.watch :
+            if options.serve is not None :
+                watch.serve(args[1], options.serve)
+            watch.watch(lambda : runhm(args[0], args[1]), args[0],
+                        [args[1]] + ([options.parse_cache] if options.parse_cache else []))
+        else :
+            if options.profile :
+                profiling.install()
+            tracing.enabled = options.trace is not None
+            memstats.enabled = options.memstats
+            try :
+                runhm(args[0], args[1])
+            finally :
+                if options.trace is not None :
+                    tracing.save(options.trace)
+            if options.profile :
+                profiling.report(args[0] + ".profile.json")
+            if options.memstats :
+                memstats.report(args[0] + ".memstats.json")
@@ -2,51 +2,179 @@
 #
 # supports peeking in a file
 
+import re
+import bisect
+
 class ParseException(Exception) :
-    def __init__(self, msg, line=None, name="*unspecified*") :
+    def __init__(self, msg, line=None, name="*unspecified*", column=None) :
         self.msg = msg
         self.line = line
         self.name = name
+        self.column = column
     def with_message(self, msg) :
-        return ParseException(msg, self.line, self.name)
+        return ParseException(msg, self.line, self.name, self.column)
     def __str__(self) :
         if self.line :
-            return "Line "+str(self.line)+" in "+repr(self.name)+". "+str(self.msg)
+            if self.column :
+                where = "Line "+str(self.line)+", column "+str(self.column)
+            else :
+                where = "Line "+str(self.line)
+            return where+" in "+repr(self.name)+". "+str(self.msg)
+        else :
+            return str(self.msg)
+
+# The offsets of the newlines in a text, so that an offset can be
+# turned into a line and column without streams having to count
+# newlines as they read.
+class LineIndex(object) :
+    def __init__(self, text) :
+        self.newlines = [m.start() for m in re.finditer("\n", text)]
+    def position(self, offset) :
+        """Returns the (line, column) of offset, both starting at 1."""
+        line = bisect.bisect_left(self.newlines, offset)
+        if line == 0 :
+            start = 0
         else :
-            return str(msg)
+            start = self.newlines[line-1] + 1
+        return (line + 1, offset - start + 1)
+
+# Where something was in a stream.  These are cheap to make, so tokens
+# and handlers keep one around, and the line and column are only
+# worked out if a ParseException actually needs to be made.
+class SourceLocation(object) :
+    __slots__ = ("stream", "offset")
+    def __init__(self, stream, offset) :
+        self.stream = stream
+        self.offset = offset
+    @property
+    def name(self) :
+        return self.stream.name
+    def position(self) :
+        return self.stream.position(self.offset)
+    def failure(self, msg="Unknown error.") : # returns an exception object which can be raised
+        line, column = self.position()
+        return ParseException(msg, line, self.stream.name, column)
+    # so it can be used where a ParseException was saved for later
+    with_message = failure
+    def __reduce__(self) :
+        # streams can't be pickled, so pickle where this is instead
+        line, column = self.position()
+        return (FixedLocation, (self.stream.name, line, column))
+    def __repr__(self) :
+        return "<SourceLocation "+repr(self.stream.name)+" offset="+repr(self.offset)+">"
+
+# A SourceLocation which has been cut loose from its stream by pickling.
+class FixedLocation(object) :
+    __slots__ = ("name", "line", "column")
+    def __init__(self, name, line, column) :
+        self.name = name
+        self.line = line
+        self.column = column
+    def position(self) :
+        return (self.line, self.column)
+    def failure(self, msg="Unknown error.") :
+        return ParseException(msg, self.line, self.name, self.column)
+    with_message = failure
+    def __reduce__(self) :
+        return (FixedLocation, (self.name, self.line, self.column))
+    def __repr__(self) :
+        return "<FixedLocation "+repr(self.name)+" line="+repr(self.line)+" column="+repr(self.column)+">"
 
 class Stream(object) :
+    # streams which record or replay a parse (see parsecache) set this,
+    # and parser.parse_one then hands the parse to their parse_one
+    taped = False
     def __init__(self, name) :
         self.name = name
-        self.row = 1
+        self._line_index = None
+        self._source = None
     def read(self) :
         raise NotImplementedError("Stream needs read.")
     def peek(self) :
         raise NotImplementedError("Stream needs peek.")
+    def tell(self) :
+        """Returns the offset of the next character to be read."""
+        raise NotImplementedError("Stream needs tell.")
+    def source(self) :
+        """Returns the whole text of the stream, or None if it can't be
+        gotten.  Only used to find line numbers."""
+        return None
+    def position(self, offset=None) :
+        """Returns the (line, column) of offset (by default, the current
+        offset), or (None, None) if the stream can't tell."""
+        if offset is None :
+            offset = self.tell()
+        if self._line_index is None :
+            text = self.source()
+            if text is None :
+                return (None, None)
+            self._line_index = LineIndex(text)
+        return self._line_index.position(offset)
+    def text(self, start, end) :
+        """Returns the text from offset start up to offset end, or None
+        if the stream can't tell."""
+        if self._source is None :
+            self._source = self.source()
+            if self._source is None :
+                return None
+        return self._source[start:end]
+    @property
+    def row(self) :
+        return self.position()[0]
+    def location(self) :
+        return SourceLocation(self, self.tell())
     def failure(self, msg="Unknown error.") : # returns an exception object which can be raised
-        return ParseException(msg, self.row, self.name)
+        return self.location().failure(msg)
     
     def read_while(self, chars) :
-        s = ""
-        c = self.peek()
-        while c != "" and c[0] in chars :
-            s += self.read()
-            c = self.peek()
-        return s
+        cc = char_class(chars)
+        return self.read_while_p(lambda c : c in cc.chars)
     def read_while_not(self, chars) :
-        s = ""
-        c = self.peek()
-        while c != "" and c[0] not in chars :
-            s += self.read()
-            c = self.peek()
-        return s
+        cc = char_class(chars)
+        return self.read_while_p(lambda c : c not in cc.chars)
     def read_while_p(self, predicate) :
-        s = ""
+        s = []
         c = self.peek()
         while c != "" and predicate(c[0]) :
-            s += self.read()
+            s.append(self.read())
             c = self.peek()
-        return s
+        return "".join(s)
+
+# A set of characters to scan over or up to, along with compiled
+# regular expressions which match a (possibly empty) run of characters
+# in the set or not in the set.  Get these through char_class so that
+# they are compiled only once per set.
+class CharClass(object) :
+    def __init__(self, chars) :
+        self.chars = chars
+        if chars :
+            inside = "".join(re.escape(c) for c in sorted(chars))
+            self.run = re.compile("[" + inside + "]*")
+            self.run_not = re.compile("[^" + inside + "]*")
+        else :
+            self.run = re.compile("")
+            self.run_not = re.compile("(?s).*")
+    def __repr__(self) :
+        return "<CharClass "+repr("".join(sorted(self.chars)))+">"
+
+_char_classes = dict()
+
+def char_class(chars) :
+    """Returns the CharClass for chars, which is a string or any
+    iterable of strings (like a dictionary of character handlers).
+    Only strings of length one are considered to be in the class."""
+    if type(chars) is CharClass :
+        return chars
+    if isinstance(chars, basestring) :
+        key = chars
+    else :
+        key = frozenset(c for c in chars if len(c) == 1)
+    try :
+        return _char_classes[key]
+    except KeyError :
+        cc = CharClass(frozenset(c for c in key if len(c) == 1))
+        _char_classes[key] = cc
+        return cc
 
 class StringStream(Stream) :
     def __init__(self, str) :
@@ -58,14 +186,44 @@ class StringStream(Stream) :
             return ''
         else :
             self.i += 1
-            if self.str[self.i-1] == '\n' :
-                self.row += 1
             return self.str[self.i-1]
     def peek(self) :
         if self.i == len(self.str) :
             return ''
         else :
             return self.str[self.i]
+    def tell(self) :
+        return self.i
+    def source(self) :
+        return self.str
+    def text(self, start, end) :
+        return self.str[start:end]
+    def _take(self, j) :
+        run = self.str[self.i:j]
+        self.i = j
+        return run
+    def read_while(self, chars) :
+        return self._take(char_class(chars).run.match(self.str, self.i).end())
+    def read_while_not(self, chars) :
+        return self._take(char_class(chars).run_not.match(self.str, self.i).end())
+    def read_while_p(self, predicate) :
+        j = self.i
+        end = len(self.str)
+        while j < end and predicate(self.str[j]) :
+            j += 1
+        return self._take(j)
+
+# reads the whole of an open file without disturbing where it is
+# being read from.  Returns None for files which can't seek.
+def _file_source(file) :
+    try :
+        here = file.tell()
+        file.seek(0)
+        text = file.read()
+        file.seek(here)
+        return text
+    except (AttributeError, IOError) :
+        return None
 
 class PeekStream(Stream) :
     def __init__(self, file) :
@@ -73,25 +231,90 @@ class PeekStream(Stream) :
         self.file = file
         self.peeked = False
         self.peek_char = ''
+        self.offset = 0
     def read(self) :
         if self.peeked :
             self.peeked = False
-            return self.peek_char
+            ret = self.peek_char
         else :
             ret = self.file.read(1) # is '' when EOF
-            if ret == '\n' :
-                self.row += 1
-            return ret
+        if ret != '' :
+            self.offset += 1
+        return ret
     def peek(self) :
-        if self.peeked :
-            return self.peek_char
-        else :
-            self.peek_char = self.read()
+        if not self.peeked :
+            self.peek_char = self.file.read(1)
             self.peeked = True
-            return self.peek_char
+        return self.peek_char
+    def tell(self) :
+        return self.offset
+    def source(self) :
+        return _file_source(self.file)
+
+# reads the file a block at a time so that peek/read are just
+# indexing into a string, and runs of characters come back as slices
+# of the buffer.
+class BufferedStream(Stream) :
+    def __init__(self, file, blocksize=65536) :
+        Stream.__init__(self, repr(file))
+        self.file = file
+        self.blocksize = blocksize
+        self.buf = ''
+        self.i = 0
+        self.base = 0 # offset of the start of buf
+    def fill(self) :
+        """Makes sure there is at least one unread character in the
+        buffer.  Returns False at EOF."""
+        if self.i < len(self.buf) :
+            return True
+        self.base += len(self.buf)
+        self.buf = self.file.read(self.blocksize) # is '' when EOF
+        self.i = 0
+        return self.buf != ''
+    def read(self) :
+        if self.i == len(self.buf) and not self.fill() :
+            return ''
+        self.i += 1
+        return self.buf[self.i-1]
+    def peek(self) :
+        if self.i == len(self.buf) and not self.fill() :
+            return ''
+        return self.buf[self.i]
+    def tell(self) :
+        return self.base + self.i
+    def source(self) :
+        return _file_source(self.file)
+    def _read_run(self, regex) :
+        # reads a run matched by regex, a buffer at a time
+        parts = []
+        while self.fill() :
+            buf = self.buf
+            j = regex.match(buf, self.i).end()
+            parts.append(buf[self.i:j])
+            self.i = j
+            if j < len(buf) :
+                break
+        return "".join(parts)
+    def read_while(self, chars) :
+        return self._read_run(char_class(chars).run)
+    def read_while_not(self, chars) :
+        return self._read_run(char_class(chars).run_not)
+    def read_while_p(self, predicate) :
+        parts = []
+        while self.fill() :
+            buf = self.buf
+            start = j = self.i
+            end = len(buf)
+            while j < end and predicate(buf[j]) :
+                j += 1
+            parts.append(buf[start:j])
+            self.i = j
+            if j < end :
+                break
+        return "".join(parts)
 
 # this is like the open(...) function, but only for reading
 def fileStream(filename) :
-    stream = PeekStream(open(filename, "r"))
+    stream = BufferedStream(open(filename, "r"))
     stream.name = filename
     return stream
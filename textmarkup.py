@@ -2,13 +2,20 @@
 #
 # for handling plain text and its fonts, formatting, etc.
 
-from lazytokens import (StringToken, LambdaToken, ListToken, VariableToken, SelfEvaluatingToken, EndEnvToken)
-from lazytokens import (ParagraphToken, InhibitParagraphToken, ItemToken, LineBreakToken, ColumnBreakToken, HorizontalLineToken)
-from environments import (DefaultCharacterEnvironment, CharacterEnvironment, add_char_handler, add_token_handler)
+from lazytokens import (StringToken, LambdaToken, ListToken, VariableToken, SelfEvaluatingToken, EndEnvToken, ThenToken, fold, const_string)
+from lazytokens import (ParagraphToken, InhibitParagraphToken, ItemToken, LineBreakToken, ColumnBreakToken, HorizontalLineToken, MarkerToken)
+from environments import (DefaultCharacterEnvironment, CharacterEnvironment, add_char_handler, add_token_handler, impure)
+import parser
 from parser import (make_handler, global_char_env, parse_one, parse_all, read_bracket_args)
 from references import (add_counter, get_counter, set_page_reference, set_anchor_reference, make_reference, make_label)
 from references import (generate_id, get_anchor_by_id, counters_to_string, get_autoname_by_ref_name)
-from streams import fileStream
+from references import (find_reference, find_reference_by_id, add_reference, label_made)
+from references import (resolve_placeholders, has_placeholders)
+import pagedeps
+import pagepool
+import tracing
+import memstats
+import hashlib
 import shutil
 import os.path
 
@@ -25,7 +32,7 @@ def html_handler(tokenname, html) :
     @add_token_handler(token_handlers, tokenname)
     @make_handler(1)
     def _handler(inside) :
-        return StringToken("<"+html+">") + inside + StringToken("</"+html+">")
+        return const_string("<"+html+">") + inside + const_string("</"+html+">")
     return _handler
 
 textit = html_handler("textit", "I")
@@ -41,9 +48,9 @@ def emph_handler(stream, char_env, token_env, begin_stack) :
         in_emph = False
     emphed = parse_one(stream, char_env, token_env.extend({"_in_emph" : not in_emph}), begin_stack)
     if in_emph :
-        return StringToken("<SPAN CLASS=\"de_em\">") + emphed + StringToken("</SPAN>")
+        return const_string("<SPAN CLASS=\"de_em\">") + emphed + const_string("</SPAN>")
     else :
-        return StringToken("<EM>") + emphed + StringToken("</EM>")
+        return const_string("<EM>") + emphed + const_string("</EM>")
 
 ###
 ### Breaks
@@ -65,8 +72,8 @@ def make_accent_handler(token, html_postfix) :
     def _handler(char) :
         def __handler(env) :
             c = char.eval(env).s[0]
-            return StringToken("&"+c+html_postfix+";")
-        return LambdaToken(__handler)
+            return const_string("&"+c+html_postfix+";")
+        return LambdaToken(__handler, [char])
     return add_token_handler(token_handlers, token)(make_handler(1)(_handler))
 
 make_accent_handler('`', 'grave')
@@ -83,7 +90,7 @@ make_accent_handler('c', 'cedil')
 
 def make_spec_char_handler(token, html_entity) :
     def _handler() :
-        return StringToken(html_entity)
+        return const_string(html_entity)
     return add_token_handler(token_handlers, token)(make_handler(0)(_handler))
 
 make_spec_char_handler('copyright', '&copy;')
@@ -92,7 +99,7 @@ make_spec_char_handler('nbsp', '&nbsp;')
 @add_token_handler(token_handlers, "char")
 @make_handler(1)
 def char_handler(inside) :
-    return StringToken("&")+inside+StringToken(";")
+    return const_string("&")+inside+const_string(";")
 
 ###
 ### Text prettification
@@ -105,18 +112,18 @@ def open_quote_handler(stream, char_env, token_env, begin_stack) :
     stream.read()
     if stream.peek() == '`' :
         stream.read()
-        return StringToken("&ldquo;")
+        return const_string("&ldquo;")
     else :
-        return StringToken("&lsquo;")
+        return const_string("&lsquo;")
 
 @add_char_handler(char_pretty_text, '\'')
 def close_quote_handler(stream, char_env, token_env, begin_stack) :
     stream.read()
     if stream.peek() == '\'' :
         stream.read()
-        return StringToken("&rdquo;")
+        return const_string("&rdquo;")
     else :
-        return StringToken("&rsquo;")
+        return const_string("&rsquo;")
 
 @add_char_handler(char_pretty_text, '\n')
 def newline_handler(stream, char_env, token_env, begin_stack) :
@@ -139,17 +146,26 @@ def close_quote_handler(stream, char_env, token_env, begin_stack) :
         stream.read()
         if stream.peek() == '-' :
             stream.read()
-            return StringToken("&mdash;")
+            return const_string("&mdash;")
         else :
-            return StringToken("&ndash;")
+            return const_string("&ndash;")
     else :
-        return StringToken("-")
+        return const_string("-")
 
 _page_filenames = []
 
+# Where \var{pagecontent} goes in the evaluated page template.
+class PageContentToken(MarkerToken) :
+    __slots__ = ()
+
+# how much of a page is buffered before it is written to its file
+_page_write_buffer = 65536
+
 # \begin{page} ... \end{page} switches to pretty mode and does
 # paragraphing, among other things like setting up labels.
+@impure
 def begin_page_environment(stream, char_env, escape_env) :
+    start = stream.tell()
     file = parse_one(stream, char_env, escape_env, [])
     try :
         file = file.eval({})
@@ -164,48 +180,136 @@ def begin_page_environment(stream, char_env, escape_env) :
     add_counter("footnote")
 
     set_page_reference(escape_env, pageid, file.s)
+    tracing.begin("page "+file.s, "page")
+    tracing.begin("parse", "page")
+    if pagedeps.enabled :
+        # gathers the macros the page calls, for end_page_environment
+        parser._parse_uses.append(parser.ParseUses())
     return (char_pretty_text,
-            escape_env.extend({"_page_footnotes" : []}))
+            escape_env.extend({"_page_footnotes" : [],
+                               "_page_source" : (stream, start),
+                               "_page_path" : os.path.join(escape_env["_curr_out_dir"], file.s)}))
 def end_page_environment(char_env, token_env, outer_token_env, out) :
+    (stream, start) = token_env["_page_source"]
+    end = stream.tell() # either way, so parse cache entries are the same
+    tracing.end()
+    if not pagedeps.enabled :
+        pagepool.render(lambda : write_page(token_env, out), token_env)
+        memstats.page_ended(token_env, out)
+        tracing.end()
+        return const_string("")
+    uses = parser._parse_uses.pop()
+    if parser._parse_uses :
+        parser._parse_uses[-1].update(uses)
+    inputs = {"source" : pagedeps.digest(stream.text(start, end)),
+              "page number" : token_env["_curr_pageid"],
+              "input directory" : token_env["_global_input_dir"],
+              "page template" : token_env.get("_page_template_digest"),
+              "breadcrumbs" : _breadcrumbs_structure(token_env.get("_breadcrumbs", []))}
+    if token_env.has_key("_page_css") :
+        inputs["stylesheet"] = pagedeps.file_digest(token_env["_page_css"])
+    for name, digest in pagedeps.macro_digests(uses.handlers).iteritems() :
+        inputs["macro \\"+name] = digest
+    deps = pagedeps.PageDependencies(token_env["_page_path"], inputs)
+    pagepool.render(lambda : write_changed_page(token_env, out, deps), token_env)
+    memstats.page_ended(token_env, out)
+    tracing.end()
+    return const_string("")
+
+# Writes the page unless nothing deps says it depends on has changed
+# since the last run.  What labels made after the page look like isn't
+# known yet, so a page which refers to some is only skipped for now,
+# and checked again in write_deferred_pages.  A process of pagepool
+# can't keep the page for then, so writes it.
+def write_changed_page(token_env, out, deps) :
+    (last, reason, waiting) = pagedeps.unchanged(deps, find_reference, find_reference_by_id, label_made)
+    if last is not None and waiting and pagepool.in_other_process() :
+        (last, reason) = (None, "it refers to labels made after it")
+    if last is not None :
+        _claim_page_filename(deps.path)
+        for lr in last.labels :
+            add_reference(lr)
+        pagedeps.keep(last)
+        if waiting :
+            _unsure_pages.append((pagepool.keep_for_later(lambda : _write_recording(token_env, out, deps), token_env),
+                                  last, waiting))
+            print "Skipped page",deps.path,"for now (it refers to labels made after it)"
+        else :
+            print "Skipped page",deps.path,"("+reason+")"
+        return
+    print "Writing page",deps.path,"("+reason+")"
+    _write_recording(token_env, out, deps)
+
+def _write_recording(token_env, out, deps) :
+    pagedeps.current = deps
+    try :
+        write_page(token_env, out, deps)
+    finally :
+        pagedeps.current = None
+    pagedeps.keep(deps)
+
+def _breadcrumbs_structure(crumbs) :
+    # what the breadcrumbs a page starts with look like, or None if
+    # they can't be compared
+    parts = []
+    for (name, label) in crumbs :
+        for t in (name, label) :
+            s = (None,) if t is None else t.structure()
+            if s is None :
+                return None
+            parts.append(s)
+    return tuple(parts)
+
+def _claim_page_filename(pagepath) :
+    if pagepath in _page_filenames :
+        raise Exception("Two pages have the same filename "+repr(pagepath))
+    _page_filenames.append(pagepath)
+    pagepool.effect(_claim_page_filename, pagepath)
+
+# Evaluates the page and writes it out.  If deps is given, it gets the
+# digest of what was written.
+def write_page(token_env, out, deps=None) :
+    with tracing.span("write page", "page", path=token_env["_page_path"]), memstats.page(token_env) :
+        return _write_page(token_env, out, deps)
+def _write_page(token_env, out, deps) :
     def eval_footnotes(footnotes) :
         oldlenfoot = 0
         lenfoot = 0
-        fout = StringToken("")
+        fout = const_string("")
         while len(footnotes) > lenfoot :
             oldlenfoot = lenfoot
             lenfoot = len(footnotes)
-            out = StringToken("")
+            out = const_string("")
             for (num, (id, footnote)) in zip(xrange(oldlenfoot+1,lenfoot+1), footnotes[oldlenfoot:lenfoot]) :
                 make_label(token_env, id, id, StringToken("[%d]" % num))
                 
                 out += HorizontalLineToken() + InhibitParagraphToken() + get_anchor_by_id(id) \
                     + InhibitParagraphToken() \
-                    + StringToken("<div class=\"footnote\">\n<sup>") \
+                    + const_string("<div class=\"footnote\">\n<sup>") \
                     + make_reference(token_env, StringToken("#ref_" + id), StringToken("[%d]" % num)) \
-                    + StringToken("</sup> ") \
+                    + const_string("</sup> ") \
                     + footnote \
-                    + StringToken("</div>\n")
+                    + const_string("</div>\n")
             fout += out.eval({})
         return fout
     if token_env.has_key("_page_template") :
-        out2 = out.eval({})
-        if token_env["_page_footnotes"] :
-            out2 += eval_footnotes(token_env["_page_footnotes"])
-        rout = render_paragraphing(InhibitParagraphToken()+out2)
+        with tracing.span("evaluate", "page") :
+            out2 = out.eval({})
+            if token_env["_page_footnotes"] :
+                out2 += eval_footnotes(token_env["_page_footnotes"])
+        page = InhibitParagraphToken()+out2
         if False : # set to True to debug render_paragraphing
             print "out =",out
             print
-            print "rout =",rout
+            print "rout =",render_paragraphing(page)
             print
         pageref = token_env["_curr_page_reference"]
         if not os.path.isdir(pageref.dir) :
             os.makedirs(pageref.dir, 0755)
         pagepath = pageref.path()
-        if pagepath in _page_filenames :
-            raise Exception("Two pages have the same filename "+repr(pagepath))
-        _page_filenames.append(pagepath)
+        _claim_page_filename(pagepath)
         relpagepath = os.path.relpath(pagepath, token_env["_global_base_out_dir"])
-        css = StringToken("")
+        css = const_string("")
         if token_env.has_key("_page_css") :
             css = StringToken("<LINK REL=\"stylesheet\" HREF=\""
                               +os.path.relpath(token_env["_page_css"], os.path.split(pagepath)[0])
@@ -228,39 +332,126 @@ def end_page_environment(char_env, token_env, outer_token_env, out) :
             else :
                 breadcrumbs = mybc[0][2]
             for crumb in mybc[1:] :
-                breadcrumbs += StringToken(" > ")
+                breadcrumbs += const_string(" > ")
                 if crumb[0].s == pageref.labelname :
                     breadcrumbs += _get_name(crumb[1], crumb[0].s)
                 else :
                     breadcrumbs += crumb[2]
             if token_env["_breadcrumbs"][-1][1].s != pageref.labelname :
-                breadcrumbs += StringToken(" > ") + pageref.autoname
-        # make page now
-        pagetoken = token_env["_page_template"].eval({"pagetitle": token_env["_page_title"],
-                                                      "pagecontent" : rout,
-                                                      "pagepath" : StringToken(pagepath),
-                                                      "relpagepath" : StringToken(relpagepath),
-                                                      "css" : css,
-                                                      "pagemodified" : token_env["_page_modified"],
-                                                      "breadcrumbs" : breadcrumbs.eval({})})
-        if type(pagetoken) == StringToken :
-            f = open(pagepath, "w")
-            f.write(pagetoken.s)
-            f.close()
-            print "Wrote page",pagepath
-            return StringToken("")
+                breadcrumbs += const_string(" > ") + pageref.autoname
+        # make page now.  The page content is only put in when the page
+        # is written out, wherever the template has a PageContentToken.
+        with tracing.span("fill template", "page") :
+            pagetoken = token_env["_page_template"].eval({"pagetitle": token_env["_page_title"],
+                                                          "pagecontent" : PageContentToken(),
+                                                          "pagepath" : StringToken(pagepath),
+                                                          "relpagepath" : StringToken(relpagepath),
+                                                          "css" : css,
+                                                          "pagemodified" : token_env["_page_modified"],
+                                                          "breadcrumbs" : breadcrumbs.eval({})})
+        if type(pagetoken) == ListToken :
+            parts = pagetoken.tokens
         else :
-            print "Token which caused error: ",pagetoken
-            raise Exception("Page not a single string.")
+            parts = [pagetoken]
+        for part in parts :
+            if type(part) != StringToken and type(part) != PageContentToken :
+                print "Token which caused error: ",pagetoken
+                raise Exception("Page not a single string.")
+        # written into a file next to it, which only replaces it once
+        # the whole page has been written, so a page which fails leaves
+        # the last good one in place
+        tmppath = pagepath + ".tmp"
+        f = open(tmppath, "w", _page_write_buffer)
+        h = hashlib.sha1()
+        unresolved = []
+        def write(s) :
+            if has_placeholders(s) :
+                s = resolve_placeholders(s)
+                if has_placeholders(s) :
+                    unresolved.append(s)
+            h.update(s)
+            f.write(s)
+        try :
+            with tracing.span("write", "page") :
+                for part in parts :
+                    if type(part) == StringToken :
+                        write(part.s)
+                    else :
+                        with tracing.span("render_paragraphing", "page") :
+                            write_paragraphing(page, write)
+        except :
+            f.close()
+            os.remove(tmppath)
+            raise
+        f.close()
+        os.rename(tmppath, pagepath)
+        if unresolved :
+            _defer_page(pagepath, deps)
+        elif deps is not None :
+            deps.output = h.hexdigest()
+        print "Wrote page",pagepath
+        return const_string("")
     else :
         raise Exception("No page template has been specified to make pages.")
 environment_handlers["page"] = (begin_page_environment, end_page_environment)
 
+# the pages which refer to labels made after them, as (path, deps)
+_deferred_pages = []
+
+def _defer_page(pagepath, deps) :
+    _deferred_pages.append((pagepath, deps))
+    pagepool.effect(_defer_page, pagepath, deps)
+
+# the pages skipped for now by write_changed_page, as (what
+# pagepool.write_later takes, what the page depended on when it was
+# last written, the labels made after it)
+_unsure_pages = []
+
+def _made_reference(name) :
+    return find_reference(name) if label_made(name) else None
+
+def write_deferred_pages() :
+    """Puts the references to labels which were made after the pages
+    they are in into those pages, once every label has been made.  The
+    pages skipped for now are written after all if one of those labels
+    changed."""
+    for (page, last, waiting) in _unsure_pages :
+        reason = pagedeps.recheck(last, waiting, _made_reference)
+        if reason is not None :
+            print "Writing page",last.path,"("+reason+")"
+            _page_filenames.remove(last.path)
+            pagepool.write_later(page)
+    del _unsure_pages[:]
+    for (pagepath, deps) in _deferred_pages :
+        f = open(pagepath, "r")
+        text = f.read()
+        f.close()
+        pagedeps.current = deps
+        try :
+            text = resolve_placeholders(text, final=True)
+        finally :
+            pagedeps.current = None
+        # as in _write_page, the page is only replaced once written
+        f = open(pagepath + ".tmp", "w")
+        f.write(text)
+        f.close()
+        os.rename(pagepath + ".tmp", pagepath)
+        if deps is not None :
+            deps.output = hashlib.sha1(text).hexdigest()
+    del _deferred_pages[:]
+
+def reset() :
+    """Forgets the pages written in the last run (see references.reset)."""
+    del _page_filenames[:]
+    del _deferred_pages[:]
+    del _unsure_pages[:]
+
 # Sets the title of the current page.
 @add_token_handler(token_handlers, "title")
+@impure
 def title_handler(stream, char_env, token_env, begin_stack) :
     title = parse_one(stream, char_env, token_env, begin_stack)
-    possible_error = stream.failure()
+    possible_error = stream.location()
     def _handler(env) :
         if token_env.has_key("_page_title") :
             raise possible_error.with_message("Page has two titles.")
@@ -271,19 +462,21 @@ def title_handler(stream, char_env, token_env, begin_stack) :
         else :
             raise stream.failure("No page for title.")
 #        return StringToken("<H1>")+title+StringToken("</H1>") + InhibitParagraphToken()
-        return StringToken("")
+        return const_string("")
     return LambdaToken(_handler)
 
 # Sets the modified date of the current page.
 @add_token_handler(token_handlers, "modified")
+@impure
 def modified_handler(stream, char_env, token_env, begin_stack) :
     modified = parse_one(stream, char_env, token_env, begin_stack)
     def _handler(env) :
         token_env["_page_modified"] = modified
-        return StringToken("")
+        return const_string("")
     return LambdaToken(_handler)
 
 @add_token_handler(token_handlers, "footnote")
+@impure
 def footnote_handler(stream, char_env, token_env, begin_stack) :
     footnote = parse_one(stream, char_env, token_env, begin_stack)
     def _handler(env) :
@@ -293,9 +486,9 @@ def footnote_handler(stream, char_env, token_env, begin_stack) :
         id = generate_id("footnote", get_counter("page"), get_counter("footnote"))
         make_label(token_env, "ref_"+id, "ref_"+id, "^")
         token_env["_page_footnotes"].append((id, footnote))
-        return get_anchor_by_id("ref_"+id) + StringToken("<sup>") \
+        return get_anchor_by_id("ref_"+id) + const_string("<sup>") \
             + make_reference(token_env, StringToken("#" + id), None) \
-            + StringToken("</sup>")
+            + const_string("</sup>")
     return LambdaToken(_handler)
 
 # takes a (list) token and handles ParagraphToken, InhibitParagraphToken, and LineBreakToken
@@ -303,46 +496,53 @@ def render_paragraphing(tokens) :
     if type(tokens) == StringToken :
         return tokens # if it's just a simple string with no newlines, don't wrap it in P tag
     elif type(tokens) != ListToken :
-        return StringToken("")
+        return const_string("")
     else :
-        rendered_out = StringToken("")
+        rendered_out = []
+        write_paragraphing(tokens, rendered_out.append)
+        return StringToken("".join(rendered_out))
+
+# does render_paragraphing, but gives the rendered text to write a
+# piece at a time rather than returning it
+def write_paragraphing(tokens, write) :
+    if type(tokens) == StringToken :
+        write(tokens.s)
+    elif type(tokens) == ListToken :
         in_paragraph = False
         inhibit_paragraph = False
         for token in tokens.tokens :
             if type(token) == LineBreakToken :
-                rendered_out += StringToken("<BR>")
+                write("<BR>")
             elif type(token) == HorizontalLineToken :
-                rendered_out += StringToken("\n<HR>\n")
+                write("\n<HR>\n")
             elif type(token) is StringToken :
                 if token.s.strip() == "" :
-                    rendered_out += token
+                    write(token.s)
                 elif in_paragraph or inhibit_paragraph :
-                    rendered_out += token
+                    write(token.s)
                     inhibit_paragraph = False
                 else :
                     in_paragraph = True
                     inhibit_paragraph = False
-                    rendered_out += StringToken("<P>") + token
+                    write("<P>")
+                    write(token.s)
             elif type(token) is InhibitParagraphToken :
                 inhibit_paragraph = True
             elif type(token) is ParagraphToken :
                 if inhibit_paragraph :
                     inhibit_paragraph = False
                 elif in_paragraph :
-                    rendered_out += StringToken("</P>\n\n")
+                    write("</P>\n\n")
                     in_paragraph = False
                 else :
                     pass #nothing
             else :
                 token.fail("Page cannot render token "+repr(token))
         if in_paragraph :
-            rendered_out += StringToken("</P>\n\n")
-        return rendered_out
+            write("</P>\n\n")
 
 def delay_render_paragraphing(tokens) :
-    def _handler(env) :
-        return render_paragraphing(tokens.eval(env))
-    return LambdaToken(_handler)
+    return ThenToken(tokens, lambda evaled, env : render_paragraphing(evaled))
 
 
 ###
@@ -364,7 +564,7 @@ def end_listing_environment(tag_name, listtagnames) :
     def _end_listing_environment(char_env, token_env, outer_token_env, out) :
         if type(out) is not ListToken :
             raise Exception("Itemize or enumerate has no \\item.")
-        next_item = StringToken("")
+        next_item = const_string("")
         in_item = False
         rout = StringToken("<"+tag_name+">")
         for token in out.tokens :
@@ -378,11 +578,11 @@ def end_listing_environment(tag_name, listtagnames) :
                     if len(listtagnames) == 1 :
                         rout += StringToken("\n<"+listtagnames[0]+">")
                         if token.textlabel is not None :
-                            rout += StringToken("<b>")+token.textlabel+StringToken("</b> ")
+                            rout += const_string("<b>")+token.textlabel+const_string("</b> ")
                     else :
                         ls = token.textlabel
                         if ls is None :
-                            ls = StringToken("")
+                            ls = const_string("")
                         rout += StringToken("\n<"+listtagnames[0]+">") + ls + StringToken("</"+listtagnames[0]+"><"+listtagnames[1]+">")
             else :
                 if type(token) is ItemToken :
@@ -390,13 +590,13 @@ def end_listing_environment(tag_name, listtagnames) :
                     if len(listtagnames) == 1 :
                         rout += StringToken("</"+listtagnames[0]+">\n<"+listtagnames[0]+">")
                         if token.textlabel is not None :
-                            rout += StringToken("<b>")+token.textlabel+StringToken("</b> ")
+                            rout += const_string("<b>")+token.textlabel+const_string("</b> ")
                     else :
                         ls = token.textlabel
                         if ls is None :
-                            ls = StringToken("")
+                            ls = const_string("")
                         rout += StringToken("</"+listtagnames[1]+">\n<"+listtagnames[0]+">") + ls + StringToken("</"+listtagnames[0]+"><"+listtagnames[1]+">")
-                    next_item = StringToken("")
+                    next_item = const_string("")
                 else :
                     next_item += token
         if in_item :
@@ -422,7 +622,7 @@ def default_col_break_handler(stream, char_env, escape_env, begin_stack) :
 # but I might wanna type an ampersand
 @add_token_handler(token_handlers, "&")
 def escape_amp_handler(stream, char_env, escape_env, begin_stack) :
-    return StringToken("&amp;")
+    return const_string("&amp;")
 
 def begin_tabular_environment(stream, char_env, escape_env) :
     def col_break_handler(stream, char_env, escape_env, begin_stack) :
@@ -448,17 +648,17 @@ def end_tabular_environment(char_env, token_env, outer_token_env, out) :
         rowformats = [dict()]
     else : # basically to handle hlines and make the table variable the contents of the table.
         currrow = dict()
-        celltokens = StringToken("")
+        celltokens = const_string("")
         rowtokens = []
         cellformat = [[1,1], dict()] # [[rowspan, colspan], style]
         rowofcellformats = []
         for token in out.tokens :
             if type(token) == ColumnBreakToken or type(token) == LineBreakToken :
                 rowtokens.append(celltokens)
-                celltokens = StringToken("")
+                celltokens = const_string("")
                 rowofcellformats.append(cellformat)
                 for i in range(1,cellformat[0][1]) : # puts in bunk cells when there's a colspan
-                    rowtokens.append(StringToken(""))
+                    rowtokens.append(const_string(""))
                     rowofcellformats.append([[1,1],dict()])
                 cellformat = [[1,1], dict()]
                 if type(token) == LineBreakToken :
@@ -494,20 +694,20 @@ def end_tabular_environment(char_env, token_env, outer_token_env, out) :
                 elif key == "border-top-width" :
                     rowformats[-1]["border-bottom-width"] = value
         else : # otherwise it's actually content.
-            if celltokens != StringToken("") :
+            if celltokens != const_string("") :
                 rowtokens.append(celltokens)
                 rowofcellformats.append(cellformat)
             if len(rowtokens) != 0 :
                 for i in range(1,cellformat[0][1]) :
-                    rowtokens.append(StringToken(""))
+                    rowtokens.append(const_string(""))
                     rowofcellformats.append([[1,1],dict()])
                 rowformats.append(currrow)
                 table.append(rowtokens)
                 cellformats.append(rowofcellformats)
-    rout = StringToken("<TABLE class=\"tabular\" style=\"border-collapse: collapse;\">\n")
+    rout = const_string("<TABLE class=\"tabular\" style=\"border-collapse: collapse;\">\n")
     ignore = [[False for c in row] for row in table]
     for r in range(0, len(table)) :
-        rout += StringToken("<TR>")
+        rout += const_string("<TR>")
         for c in range(0, len(table[r])) :
             if not ignore[r][c] :
                 style = rowformats[r].copy()
@@ -533,18 +733,22 @@ def end_tabular_environment(char_env, token_env, outer_token_env, out) :
                             ignore[r][c+i] = True
                     spanstring += "COLSPAN="+str(colspan) + " "
                 s = "; ".join([key+": "+value for key,value in style.iteritems()])
-                rout += StringToken("<TD "+spanstring+"style=\""+s+"\">") + table[r][c] + StringToken("</TD>")
-        rout += StringToken("</TR>\n")
-    rout += StringToken("</TABLE>\n")
+                rout += StringToken("<TD "+spanstring+"style=\""+s+"\">") + table[r][c] + const_string("</TD>")
+        rout += const_string("</TR>\n")
+    rout += const_string("</TABLE>\n")
     return ParagraphToken() + InhibitParagraphToken() + rout
 environment_handlers["tabular"] = (begin_tabular_environment, end_tabular_environment)
 
 class RowSpanToken(SelfEvaluatingToken) :
+    __slots__ = ("rows", "width")
     def __init__(self, rows, width) :
+        SelfEvaluatingToken.__init__(self, None)
         self.rows = rows
         self.width = width
 class ColSpanToken(SelfEvaluatingToken) :
+    __slots__ = ("cols", "formatting")
     def __init__(self, cols, formatting) :
+        SelfEvaluatingToken.__init__(self, None)
         self.cols = cols
         self.formatting = formatting
 @add_token_handler(token_handlers, "multicolumn")
@@ -619,27 +823,28 @@ def decode_column_formats(formatting) :
 def begin_center_environment(stream, char_env, escape_env) :
     return (char_env, escape_env)
 def end_center_environment(char_env, escape_env, outer_token_env, out) :
-    return InhibitParagraphToken()+StringToken("<CENTER>") + out + StringToken("</CENTER>\n")
+    return InhibitParagraphToken()+const_string("<CENTER>") + out + const_string("</CENTER>\n")
 environment_handlers["center"] = (begin_center_environment, end_center_environment)
 
 def begin_quote_environment(stream, char_env, escape_env) :
     return (char_env, escape_env)
 def end_quote_environment(char_env, escape_env, outer_token_env, out) :
-    return (InhibitParagraphToken()+StringToken("<BLOCKQUOTE>") +
-            ParagraphToken() + out + StringToken("</BLOCKQUOTE>\n"))
+    return (InhibitParagraphToken()+const_string("<BLOCKQUOTE>") +
+            ParagraphToken() + out + const_string("</BLOCKQUOTE>\n"))
 environment_handlers["quote"] = (begin_quote_environment, end_quote_environment)
 
 def begin_abstract_environment(stream, char_env, escape_env) :
     return (char_env, escape_env)
 def end_abstract_environment(char_env, escape_env, outer_token_env, out) :
     return (InhibitParagraphToken()+
-            StringToken("<DIV CLASS=\"abstract\"><DIV CLASS=\"abstractcaption\">Abstract</DIV>") +
-            ParagraphToken() + out + StringToken("</DIV>\n"))
+            const_string("<DIV CLASS=\"abstract\"><DIV CLASS=\"abstractcaption\">Abstract</DIV>") +
+            ParagraphToken() + out + const_string("</DIV>\n"))
 environment_handlers["abstract"] = (begin_abstract_environment, end_abstract_environment)
 
 
 add_counter("figure", "page")
 
+@impure
 def begin_figure_environment(stream, char_env, escape_env) :
     placement = read_bracket_args(stream, char_env, escape_env, [])
     newenv = escape_env.extend({})
@@ -654,26 +859,27 @@ def end_figure_environment(char_env, escape_env, outer_token_env, out) :
         if type(p) is not StringToken :
             p.fail("Figure placement must be a string.")
         o = (ParagraphToken() + InhibitParagraphToken() + get_anchor_by_id(id) + InhibitParagraphToken()
-             + StringToken("<div class=\"figure figure_"+p.s+"\">") + out + StringToken("</div>")
+             + StringToken("<div class=\"figure figure_"+p.s+"\">") + out + const_string("</div>")
              + ParagraphToken())
         return o
     return LambdaToken(_handler)
 environment_handlers["figure"] = (begin_figure_environment, end_figure_environment)
 
 @add_token_handler(token_handlers, "caption")
+@impure
 def caption_handler(stream, char_env, escape_env, begin_stack) :
     text = parse_one(stream, char_env, escape_env, begin_stack)
     def _handler(env) :
         teval = text.eval(env)
         return (StringToken("<div class=\"caption\"><b>Figure "+counters_to_string("figure")+".</b> ")+teval
-                +StringToken("</div>"))
+                +const_string("</div>"))
     return LambdaToken(_handler)
 
 @add_token_handler(token_handlers, "framebox")
 @add_token_handler(token_handlers, "fbox")
 @make_handler(1)
 def framebox_handler(text) :
-    return StringToken("<SPAN CLASS=\"framebox\">") + text + StringToken("</SPAN>")
+    return const_string("<SPAN CLASS=\"framebox\">") + text + const_string("</SPAN>")
 
 ###
 ### Verbatim text
@@ -736,6 +942,7 @@ environment_handlers["verbatim"] = (begin_verbatim_environment, end_verbatim_env
 
 # \setpagetemplate
 @add_token_handler(token_handlers, "setpagetemplate")
+@impure
 def set_page_template(stream, char_env, token_env, begin_stack) :
     name = parse_one(stream, char_env, token_env, begin_stack)
     try :
@@ -746,14 +953,28 @@ def set_page_template(stream, char_env, token_env, begin_stack) :
         raise stream.failure("Name for \\setpagetemplate must be a string.")
     old = token_env["_global_input_dir"]
     fn = os.path.abspath(os.path.join(token_env["_global_input_dir"], name.s))
+    pagedeps.record_read(fn)
     token_env["_global_input_dir"] = os.path.split(fn)[0]
-    token_env["_page_template"] = parse_all(fileStream(fn), char_env, token_env, [], execute=False)
+    uses = parser.ParseUses() # the macros the template calls, for pagedeps
+    parser._parse_uses.append(uses)
+    try :
+        template = parser.parse_file(fn, char_env, token_env)
+    finally :
+        parser._parse_uses.pop()
+    if parser._parse_uses :
+        parser._parse_uses[-1].update(uses)
+    if parser.partial_evaluation :
+        template = fold(template)
+    token_env["_page_template"] = template
+    if pagedeps.enabled :
+        token_env["_page_template_digest"] = pagedeps.digest(pagedeps.file_digest(fn), uses.handlers)
     token_env["_global_input_dir"] = old
-    return StringToken("")
+    return const_string("")
 
 # \setstylesheet{filename}.  Filename must be unique, otherwise things
 # will get overwritten!
 @add_token_handler(token_handlers, "setstylesheet")
+@impure
 def set_stylesheet_handler(stream, char_env, token_env, begin_stack) :
     name = parse_one(stream, char_env, token_env, begin_stack)
     try :
@@ -763,6 +984,7 @@ def set_stylesheet_handler(stream, char_env, token_env, begin_stack) :
     if type(name) != StringToken :
         raise stream.failure("Name for \\setstylesheet must be a string.")
     filename = os.path.abspath(os.path.join(token_env["_global_input_dir"], name.s))
+    pagedeps.record_read(filename)
     cssdir = os.path.join(token_env["_global_base_out_dir"], "css")
     if not os.path.isdir(cssdir) :
         os.makedirs(cssdir, 0755)
@@ -770,11 +992,12 @@ def set_stylesheet_handler(stream, char_env, token_env, begin_stack) :
     destname = os.path.join(cssdir, filestail)
     shutil.copy(filename, destname)
     token_env["_page_css"] = destname
-    return StringToken("")
+    return const_string("")
 
 # sections
 
 @add_token_handler(token_handlers, "section")
+@impure
 def section_handler(stream, char_env, token_env, begin_stack) :
     text = parse_one(stream, char_env, token_env, begin_stack)
     def _handler(env) :
@@ -782,11 +1005,12 @@ def section_handler(stream, char_env, token_env, begin_stack) :
         id = generate_id("section", get_counter("page"), get_counter("section"))
         set_anchor_reference(token_env, id, text)
         return (ParagraphToken() + InhibitParagraphToken() + get_anchor_by_id(id) + InhibitParagraphToken()
-                + StringToken("<H2>"+counters_to_string("section")+". ") + text + StringToken("</H2>")
+                + StringToken("<H2>"+counters_to_string("section")+". ") + text + const_string("</H2>")
                 + ParagraphToken())
     return LambdaToken(_handler)
 
 @add_token_handler(token_handlers, "subsection")
+@impure
 def subsection_handler(stream, char_env, token_env, begin_stack) :
     text = parse_one(stream, char_env, token_env, begin_stack)
     def _handler(env) :
@@ -794,11 +1018,12 @@ def subsection_handler(stream, char_env, token_env, begin_stack) :
         id = generate_id("subsection", get_counter("page"), get_counter("section"), get_counter("subsection"))
         set_anchor_reference(token_env, id, text)
         return (ParagraphToken() + InhibitParagraphToken() + get_anchor_by_id(id) + InhibitParagraphToken()
-                + StringToken("<H3>"+counters_to_string("section", "subsection")+". ") + text + StringToken("</H3>")
+                + StringToken("<H3>"+counters_to_string("section", "subsection")+". ") + text + const_string("</H3>")
                 + ParagraphToken())
     return LambdaToken(_handler)
 
 @add_token_handler(token_handlers, "subsubsection")
+@impure
 def subsection_handler(stream, char_env, token_env, begin_stack) :
     text = parse_one(stream, char_env, token_env, begin_stack)
     def _handler(env) :
@@ -806,7 +1031,7 @@ def subsection_handler(stream, char_env, token_env, begin_stack) :
         id = generate_id("subsubsection", get_counter("page"), get_counter("section"), get_counter("subsection"), get_counter("subsubsection"))
         set_anchor_reference(token_env, id, text)
         return (ParagraphToken() + InhibitParagraphToken() + get_anchor_by_id(id) + InhibitParagraphToken()
-                + StringToken("<H4>"+counters_to_string("section", "subsection", "subsubsection")+". ") + text + StringToken("</H4>")
+                + StringToken("<H4>"+counters_to_string("section", "subsection", "subsubsection")+". ") + text + const_string("</H4>")
                 + ParagraphToken())
     return LambdaToken(_handler)
 
@@ -815,6 +1040,7 @@ def subsection_handler(stream, char_env, token_env, begin_stack) :
 ###
 
 @add_token_handler(token_handlers, "addbreadcrumb")
+@impure
 def breadcrumb_handler(stream, char_env, token_env, begin_stack) :
     name = read_bracket_args(stream, char_env, token_env, begin_stack)
     label = parse_one(stream, global_char_env, token_env, begin_stack)
@@ -824,12 +1050,13 @@ def breadcrumb_handler(stream, char_env, token_env, begin_stack) :
             token_env["_breadcrumbs"] = []
         token_env["_breadcrumbs"] = (token_env["_breadcrumbs"]
                                      + [(name if name is None else name.eval(env),label.eval(env))])
-        return StringToken("")
+        return const_string("")
     return LambdaToken(_handler)
 
 @add_token_handler(token_handlers, "popbreadcrumb")
+@impure
 def popbreadcrumb_handler(stream, char_env, token_env, begin_stack) :
     def _handler(env) :
         token_env["_breadcrumbs"] = token_env["_breadcrumbs"][0:-1]
-        return StringToken("")
+        return const_string("")
     return LambdaToken(_handler)
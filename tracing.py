@@ -0,0 +1,73 @@
+# tracing.py
+#
+# writes a timeline of a build (runhm.py --trace) as Chrome trace
+# events, which chrome://tracing or ui.perfetto.dev can show.  Each
+# phase is a span, from a "B" event to an "E" event, and spans nest:
+# the pages in an \include are in its span, and the parts of writing a
+# page are in the page's span.  Pages written by the processes of
+# pagepool show up as those processes.
+
+import os
+import time
+import json
+
+import pagepool
+
+# whether spans are recorded (runhm.py --trace)
+enabled = False
+
+_events = []
+
+def _emit(phase, name=None, category=None, args=None) :
+    pid = os.getpid()
+    event = {"ph" : phase, "ts" : time.time() * 1e6, "pid" : pid, "tid" : pid}
+    if name is not None :
+        # an "E" event ends whatever span began last, so needs no name
+        event["name"] = name
+        event["cat"] = category
+    if args :
+        event["args"] = args
+    _add_event(event)
+    pagepool.effect(_add_event, event)
+
+def _add_event(event) :
+    _events.append(event)
+
+def begin(name, category="build", **args) :
+    """Starts a span, which the next end to be called ends."""
+    if enabled :
+        _emit("B", name, category, args)
+
+def end() :
+    if enabled :
+        _emit("E")
+
+class span(object) :
+    """A span around a with block:  with tracing.span("name") : ..."""
+    def __init__(self, name, category="build", **args) :
+        self.name = name
+        self.category = category
+        self.args = args
+    def __enter__(self) :
+        if enabled :
+            _emit("B", self.name, self.category, self.args)
+    def __exit__(self, type, value, traceback) :
+        if enabled :
+            _emit("E")
+
+def take_events() :
+    """Returns the events so far, and forgets them."""
+    events = list(_events)
+    del _events[:]
+    return events
+
+def save(filename) :
+    """Writes the events so far into filename."""
+    names = [{"name" : "process_name", "ph" : "M", "pid" : pid, "tid" : pid,
+              "args" : {"name" : "runhm.py" if pid == os.getpid() else "pagepool %d" % pid}}
+             for pid in sorted(set(e["pid"] for e in _events))]
+    f = open(filename, "w")
+    try :
+        json.dump({"traceEvents" : names + _events, "displayTimeUnit" : "ms"}, f)
+    finally :
+        f.close()
@@ -0,0 +1,113 @@
+# watch.py
+#
+# builds a site again each time one of its input files changes
+# (runhm.py --watch).  The builds are done in the one process, so only
+# the first pays for starting up, and the modules are put back as they
+# were before each one.  Pages are only written again when something
+# they depend on has changed (see pagedeps).  The output directory can
+# also be served over HTTP meanwhile.
+
+import os
+import time
+import threading
+import traceback
+import BaseHTTPServer
+import SimpleHTTPServer
+
+import parser
+import references
+import textmarkup
+import pagedeps
+import pagepool
+
+# seconds between looks at the input files
+interval = 0.5
+
+def reset() :
+    """Forgets everything the last build left behind in the modules."""
+    pagepool.reset()
+    pagedeps.reset()
+    parser.reset()
+    references.reset()
+    textmarkup.reset()
+
+def input_files(inpfile, skip=()) :
+    """Returns a dict of each file the last build read (see
+    pagedeps.files_read), wherever it is, to its size and modification
+    time.  So that files which haven't been read yet (like one a change
+    starts including) are noticed too, so is each file in the
+    directory of inpfile, or below it, other than in hidden
+    directories, the directories in skip (like the output directory),
+    and the files a build writes next to inpfile."""
+    inpfile = os.path.abspath(inpfile)
+    skip = set(os.path.abspath(d) for d in skip)
+    written = set([inpfile + ".ref", inpfile + ".deps"])
+    stamps = dict()
+    for filename in pagedeps.files_read() :
+        stamps[filename] = pagedeps.file_stamp(filename)
+    for (dirpath, dirnames, filenames) in os.walk(os.path.dirname(inpfile)) :
+        dirnames[:] = [d for d in dirnames
+                       if not d.startswith(".") and os.path.join(dirpath, d) not in skip]
+        for name in filenames :
+            filename = os.path.join(dirpath, name)
+            if filename not in written :
+                stamps[filename] = pagedeps.file_stamp(filename)
+    return stamps
+
+def build_once(build) :
+    """Calls build() after a reset, printing rather than raising what
+    went wrong, so that watching goes on."""
+    reset()
+    start = time.time()
+    try :
+        build()
+    except Exception :
+        traceback.print_exc()
+        print "***Build failed***"
+    print "Built in %.2fs, watching for changes." % (time.time() - start)
+
+def built(stamps, inpfile, skip) :
+    """Returns the files to watch after a build: stamps, which were
+    looked at before it, so that changes made during the build start
+    another one, along with the files the build was found to read."""
+    found = input_files(inpfile, skip)
+    return dict((f, stamps.get(f, stamp)) for (f, stamp) in found.iteritems())
+
+def watch(build, inpfile, skip=()) :
+    """Calls build() now, and again each time the files found by
+    input_files change, until interrupted."""
+    stamps = input_files(inpfile, skip)
+    build_once(build)
+    stamps = built(stamps, inpfile, skip)
+    try :
+        while True :
+            time.sleep(interval)
+            # looked at before building, so changes made during a build
+            # start another one
+            new = input_files(inpfile, skip)
+            if new != stamps :
+                changed = sorted(f for f in set(new) | set(stamps) if new.get(f) != stamps.get(f))
+                print "\nChanged:", ", ".join(os.path.relpath(f) for f in changed)
+                stamps = new
+                build_once(build)
+                stamps = built(stamps, inpfile, skip)
+    except KeyboardInterrupt :
+        print
+
+def serve(outdir, port) :
+    """Serves the files in outdir at http://localhost:port/ from another
+    thread, and returns the server."""
+    root = os.path.abspath(outdir)
+    class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler) :
+        def translate_path(self, path) :
+            # the handler serves the current directory
+            path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+            return os.path.join(root, os.path.relpath(path, os.getcwd()))
+        def log_message(self, format, *args) :
+            pass
+    server = BaseHTTPServer.HTTPServer(("localhost", port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print "Serving", root, "at http://localhost:%d/" % server.server_port
+    return server